@@ -42,7 +42,8 @@ sup_aug_pipeline = [
         ]),
     dict(type='RandomErasing', n_patches=(1, 5), ratio=(0, 0.2)),
     dict(type='AlbuDomainAdaption', domain_adaption_type='ALL',
-         target_dir='data/clipart/JPEGImages', p=0.5),
+         target_dir='data/clipart/JPEGImages', p=0.5,
+         style_bank='data/style_bank/clipart'),
     dict(type='FilterAnnotations', min_gt_bbox_wh=(1e-2, 1e-2)),
     dict(
         type='PackDetInputs',
@@ -89,6 +90,7 @@ sup_pipeline = [
     dict(
         type='MultiBranch',
         branch_field=branch_field,
+        copy_on_write=True,
         sup=sup_aug_pipeline,
     )
 ]
@@ -108,6 +110,7 @@ unsup_pipeline = [
     dict(
         type='MultiBranch',
         branch_field=branch_field,
+        copy_on_write=True,
         unsup_teacher=weak_pipeline,
         unsup_student=strong_pipeline,
     )
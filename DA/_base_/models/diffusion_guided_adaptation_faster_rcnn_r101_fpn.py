@@ -25,7 +25,13 @@ model = dict(
         sup_weight=1.0,
         unsup_weight=1.0,
         cls_pseudo_thr=0.5,
-        min_pseudo_bbox_wh=(1e-2, 1e-2)),
+        min_pseudo_bbox_wh=(1e-2, 1e-2),
+        # directory built by tools/misc/build_pseudo_label_bank.py, replaces
+        # the diffusion detector predictions on the unsup_teacher views
+        pseudo_label_bank=None,
+        # one student backbone/neck forward for the sup, unsup_student and
+        # unsup_teacher views, needs norm layers without batch statistics
+        fused_student_forward=True),
     semi_test_cfg=dict(predict_on='teacher'),
 
 )
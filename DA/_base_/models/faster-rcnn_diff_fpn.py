@@ -28,6 +28,10 @@ model = dict(
                          s_tmin=10,
                          s_tmax=250,
                          do_mask_steps=True,
+                         # checkpoints keep model_id instead of the frozen SD weights
+                         save_frozen_weights=False,
+                         # UNet hooks write the stride features into preallocated buffers
+                         feature_buffers=True,
                          classes=('bicycle', 'bus', 'car', 'motorcycle',
                                   'person', 'rider', 'train', 'truck')
                          )
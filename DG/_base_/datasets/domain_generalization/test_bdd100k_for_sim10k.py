@@ -29,6 +29,7 @@ val_dataloader = dict(
         ann_file='BDD100K/bdd100k/val.json',
         data_prefix=dict(img='BDD100K/bdd100k/bdd100k/bdd100k/images/100k/val/'),
         test_mode=True,
+        data_list_cache='data/data_list_cache',
         filter_cfg=dict(filter_empty_gt=True),
         pipeline=test_pipeline,
         return_classes=True))
@@ -29,6 +29,7 @@ val_dataloader = dict(
         ann_file='cityscapes/test.json',
         data_prefix=dict(img='cityscapes/JPEGImages/'),
         test_mode=True,
+        data_list_cache='data/data_list_cache',
         filter_cfg=dict(filter_empty_gt=True),
         pipeline=test_pipeline,
         return_classes=True))
@@ -28,6 +28,7 @@ val_dataloader = dict(
         ann_file='DWD/Daytime_Sunny/test.json',
         data_prefix=dict(img='DWD/Daytime_Sunny/JPEGImages/'),
         test_mode=True,
+        data_list_cache='data/data_list_cache',
         filter_cfg=dict(filter_empty_gt=True),
         pipeline=test_pipeline,
         return_classes=True))
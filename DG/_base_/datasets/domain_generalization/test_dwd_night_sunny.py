@@ -29,6 +29,7 @@ val_dataloader = dict(
         ann_file='DWD/Night_Sunny/all.json',
         data_prefix=dict(img='DWD/Night_Sunny/JPEGImages/'),
         test_mode=True,
+        data_list_cache='data/data_list_cache',
         filter_cfg=dict(filter_empty_gt=True),
         pipeline=test_pipeline,
         return_classes=True))
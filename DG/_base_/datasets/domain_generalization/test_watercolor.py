@@ -33,6 +33,7 @@ val_dataloader = dict(
         ann_file='watercolor/test_dg.json',
         data_prefix=dict(img='watercolor/JPEGImages/'),
         test_mode=True,
+        data_list_cache='data/data_list_cache',
         filter_cfg=dict(filter_empty_gt=True),
         pipeline=test_pipeline,
         return_classes=True))
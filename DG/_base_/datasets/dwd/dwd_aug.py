@@ -37,7 +37,8 @@ train_pipeline = [
     dict(type='RandAugment', aug_space=color_space, aug_num=1),
     dict(type='RandomErasing', n_patches=(1, 5), ratio=(0, 0.2)),
     dict(type='AlbuDomainAdaption', domain_adaption_type='ALL',
-         target_dir='data/DWD/Daytime_Sunny/JPEGImages', p=0.5),
+         target_dir='data/DWD/Daytime_Sunny/JPEGImages', p=0.5,
+         style_bank='data/style_bank/dwd_daytime_sunny'),
     dict(
         type='PackDetInputs',
         meta_keys=('img_id', 'img_path', 'ori_shape', 'img_shape',
@@ -43,7 +43,8 @@ train_pipeline = [
     dict(type='RandomFlip', prob=0.5),
     dict(type='RandAugment', aug_space=color_space, aug_num=1),
     dict(type='AlbuDomainAdaption', domain_adaption_type='ALL',
-         target_dir='data/VOC/VOC0712/JPEGImages', p=0.5),
+         target_dir='data/VOC/VOC0712/JPEGImages', p=0.5,
+         style_bank='data/style_bank/voc0712'),
     dict(type='RandomErasing', n_patches=(1, 5), ratio=(0, 0.2)),
     dict(
         type='PackDetInputs',
@@ -34,7 +34,13 @@ resume = False
 # 如果burn_up_iters>max_iters, 则模型只进行源域训练
 
 burn_up_iters = 0
-train_cfg = dict(type='IterBasedTrainLoop', max_iters=20000, val_interval=1000)
+# teacher_producer=dict(mode='thread') runs the frozen diffusion teacher one
+# batch ahead of the student, mode='process' runs it in a worker process
+train_cfg = dict(
+    type='TeacherPipelineTrainLoop',
+    max_iters=20000,
+    val_interval=1000,
+    teacher_producer=None)
 val_cfg = dict(type='TeacherStudentValLoop')
 test_cfg = dict(type='TestLoop')
 param_scheduler = [
@@ -36,7 +36,8 @@ train_pipeline = [
     dict(type='RandAugment', aug_space=color_space, aug_num=1),
     dict(type='RandomErasing', n_patches=(1, 5), ratio=(0, 0.2)),
     dict(type='AlbuDomainAdaption', domain_adaption_type='ALL',
-         target_dir='data/COCO2017/train2017/', p=0.5),
+         target_dir='data/COCO2017/train2017/', p=0.5,
+         style_bank='data/style_bank/coco_train2017'),
     # dict(type='RandomCrop', crop_type='absolute', crop_size=(512, 512),
     #      recompute_bbox=True, allow_negative_crop=True),
     dict(type='RandomFlip', prob=0.5),
@@ -1,7 +1,13 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+import hashlib
+import json
+import os
 import os.path as osp
+import pickle
+import shutil
 from typing import List, Optional
 
+import numpy as np
 from mmengine.dataset import BaseDataset
 from mmengine.fileio import load
 from mmengine.utils import is_abs
@@ -23,8 +29,19 @@ class BaseDetDataset(BaseDataset):
             for open vocabulary-based algorithms. Defaults to False.
         caption_prompt (dict, optional): Prompt for captioning.
             Defaults to None.
+        data_list_cache (str, optional): Directory of the persistent cache
+            of the loaded and filtered ``data_list``. It is stored in the
+            serialized layout of :class:`BaseDataset` and memory-mapped,
+            so every worker and rank shares one copy through the page
+            cache. Entries are keyed by the annotation files and their
+            mtime and size, and by the dataset settings. Only the dataset
+            is cached, e.g. ``CocoMetric`` still loads its ``ann_file``.
+            Defaults to None.
     """
 
+    # attributes set by ``load_data_list`` that are cached with the data list
+    DATA_LIST_CACHE_ATTRS = ()
+
     def __init__(self,
                  *args,
                  seg_map_suffix: str = '.png',
@@ -33,8 +50,10 @@ class BaseDetDataset(BaseDataset):
                  backend_args: dict = None,
                  return_classes: bool = False,
                  caption_prompt: Optional[dict] = None,
+                 data_list_cache: Optional[str] = None,
                  **kwargs) -> None:
         self.seg_map_suffix = seg_map_suffix
+        self.data_list_cache = data_list_cache
         self.proposal_file = proposal_file
         self.backend_args = backend_args
         self.return_classes = return_classes
@@ -72,6 +91,9 @@ class BaseDetDataset(BaseDataset):
         """
         if self._fully_initialized:
             return
+        if self.data_list_cache is not None and self._load_data_list_cache():
+            self._fully_initialized = True
+            return
         # load data information
         self.data_list = self.load_data_list()
         # get proposals from file
@@ -88,8 +110,110 @@ class BaseDetDataset(BaseDataset):
         if self.serialize_data:
             self.data_bytes, self.data_address = self._serialize_data()
 
+        if self.data_list_cache is not None:
+            self._save_data_list_cache()
+
         self._fully_initialized = True
 
+    def _data_list_cache_key(self) -> str:
+        """Key of the data list of this dataset in ``data_list_cache``."""
+
+        def file_stat(file):
+            if file is None or not osp.exists(file):
+                return None
+            stat = os.stat(file)
+            return [stat.st_mtime_ns, stat.st_size]
+
+        proposal_file = self.proposal_file
+        if proposal_file is not None and not is_abs(proposal_file):
+            proposal_file = osp.join(self.data_root, proposal_file)
+        settings = dict(
+            type=type(self).__name__,
+            ann_file=osp.abspath(self.ann_file),
+            ann_file_stat=file_stat(self.ann_file),
+            proposal_file=proposal_file,
+            proposal_file_stat=file_stat(proposal_file),
+            data_root=self.data_root,
+            data_prefix=self.data_prefix,
+            filter_cfg=self.filter_cfg,
+            metainfo=self._metainfo,
+            test_mode=self.test_mode,
+            indices=self._indices,
+            seg_map_suffix=self.seg_map_suffix,
+            return_classes=self.return_classes,
+            caption_prompt=self.caption_prompt)
+        settings.update(self._data_list_cache_settings())
+        settings = json.dumps(settings, sort_keys=True, default=str)
+        return hashlib.sha1(settings.encode()).hexdigest()
+
+    def _data_list_cache_settings(self) -> dict:
+        """Settings of subclasses that change the data list."""
+        return dict()
+
+    def _load_data_list_cache(self) -> bool:
+        """Take the data list from ``data_list_cache`` if it is there."""
+        root = osp.join(self.data_list_cache, self._data_list_cache_key())
+        if not osp.exists(osp.join(root, 'meta.json')):
+            return False
+        data_bytes = np.load(osp.join(root, 'data_bytes.npy'), mmap_mode='r')
+        data_address = np.load(
+            osp.join(root, 'data_address.npy'), mmap_mode='r')
+        with open(osp.join(root, 'attrs.pkl'), 'rb') as f:
+            for name, value in pickle.load(f).items():
+                setattr(self, name, value)
+        if self.serialize_data:
+            self.data_bytes, self.data_address = data_bytes, data_address
+            self.data_list = []
+        else:
+            starts = np.concatenate([[0], data_address[:-1]])
+            self.data_list = [
+                pickle.loads(memoryview(data_bytes[start:end]))
+                for start, end in zip(starts, data_address)
+            ]
+        return True
+
+    def _save_data_list_cache(self) -> None:
+        """Write the data list to ``data_list_cache``.
+
+        The entry is written to a temporary directory and renamed, so ranks
+        building the same entry at once never read a partial one.
+        """
+        root = osp.join(self.data_list_cache, self._data_list_cache_key())
+        if osp.exists(osp.join(root, 'meta.json')):
+            return
+        if self.serialize_data:
+            data_bytes, data_address = self.data_bytes, self.data_address
+        else:
+            data = [
+                np.frombuffer(pickle.dumps(x, protocol=4), dtype=np.uint8)
+                for x in self.data_list
+            ]
+            data_address = np.cumsum([len(x) for x in data], dtype=np.int64)
+            data_bytes = np.concatenate(data) if data else np.zeros(
+                0, dtype=np.uint8)
+        tmp_root = f'{root}.tmp{os.getpid()}'
+        os.makedirs(tmp_root, exist_ok=True)
+        np.save(osp.join(tmp_root, 'data_bytes.npy'), data_bytes)
+        np.save(osp.join(tmp_root, 'data_address.npy'), data_address)
+        with open(osp.join(tmp_root, 'attrs.pkl'), 'wb') as f:
+            pickle.dump({
+                name: getattr(self, name)
+                for name in self.DATA_LIST_CACHE_ATTRS if hasattr(self, name)
+            }, f, protocol=4)
+        with open(osp.join(tmp_root, 'meta.json'), 'w') as f:
+            json.dump(
+                dict(
+                    type=type(self).__name__,
+                    ann_file=self.ann_file,
+                    num_images=len(data_address)),
+                f,
+                indent=2)
+        try:
+            os.rename(tmp_root, root)
+        except OSError:
+            # written by another process meanwhile
+            shutil.rmtree(tmp_root, ignore_errors=True)
+
     def load_proposals(self) -> None:
         """Load proposals from proposals file.
 
@@ -55,6 +55,7 @@ class CocoDataset(BaseDetDataset):
     COCOAPI = COCO
     # ann_id is unique in coco dataset.
     ANN_ID_UNIQUE = True
+    DATA_LIST_CACHE_ATTRS = ('cat_ids', 'cat2label', 'cat_img_map')
 
     def load_data_list(self) -> List[dict]:
         """Load annotations from an annotation file named as ``self.ann_file``
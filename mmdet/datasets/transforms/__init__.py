@@ -10,7 +10,8 @@ from .geometric import (GeomTransform, Rotate, ShearX, ShearY, TranslateX,
                         TranslateY)
 from .instaboost import InstaBoost
 from .loading import (FilterAnnotations, InferencerLoader, LoadAnnotations,
-                      LoadEmptyAnnotations, LoadImageFromNDArray,
+                      LoadEmptyAnnotations, LoadImageFromCache,
+                      LoadImageFromNDArray,
                       LoadMultiChannelImageFromFiles, LoadPanopticAnnotations,
                       LoadProposals, LoadTrackAnnotations)
 from .text_transformers import LoadTextAnnotations, RandomSamplingNegPos
@@ -44,5 +45,5 @@ __all__ = [
     'PackTrackInputs', 'PackReIDInputs', 'FixScaleResize',
     'ResizeShortestEdge', 'GTBoxSubOne_GLIP', 'RandomFlip_GLIP',
     'RandomSamplingNegPos', 'LoadTextAnnotations', 'AlbuDomainAdaption',
-    'at_strong_augmentation', 'at_weak_augmentation'
+    'at_strong_augmentation', 'at_weak_augmentation', 'LoadImageFromCache'
 ]
@@ -1,19 +1,228 @@
+import hashlib
+import json
 import os
+import os.path as osp
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import mmcv
+import numpy as np
 from mmcv.transforms import BaseTransform
 from mmdet.registry import TRANSFORMS
 
 import albumentations as A
 
+
+class StyleBank:
+    """Precomputed styles of the images of a target domain.
+
+    Stores per target image what the albumentations domain adaption
+    transforms would take from it, so the targets are decoded once when the
+    bank is built instead of once per transformed sample::
+
+        root/
+            meta.json       build settings, target files and the hash of
+                            the target list they were taken from
+            cdf.npy         (N, 3, 256) float32 cumulative histograms
+            amplitude.npy   (N, 2B+1, 2B+1, 3) float32 centred low-frequency
+                            FFT amplitude at ``size`` (w, h), divided by h * w
+            mean.npy        (N, 3) float32 pixel mean in [0, 1]
+            components.npy  (N, 3, 3) float32 pixel PCA components
+
+    with ``B = floor(min(size) * beta_limit)``. Like albumentations, targets
+    are read in RGB order. Columns are memory-mapped, so a bank is shared by
+    all dataloader workers through the page cache.
+
+    Args:
+        root (str): Directory of the bank.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        with open(osp.join(root, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.cdf = np.load(osp.join(root, 'cdf.npy'), mmap_mode='r')
+        self.amplitude = np.load(
+            osp.join(root, 'amplitude.npy'), mmap_mode='r')
+        self.mean = np.load(osp.join(root, 'mean.npy'), mmap_mode='r')
+        self.components = np.load(
+            osp.join(root, 'components.npy'), mmap_mode='r')
+
+    def __len__(self) -> int:
+        return len(self.cdf)
+
+    @classmethod
+    def build(cls,
+              root: str,
+              target_list: list,
+              size: Tuple[int, int] = (512, 512),
+              beta_limit: float = 0.1,
+              num_workers: int = 8,
+              max_images: Optional[int] = None) -> None:
+        """Decode every target once and write the bank to ``root``.
+
+        With ``max_images``, a fixed random subset of at most that many
+        targets goes into the bank. ``targets_hash`` in the meta file
+        identifies ``target_list`` and ``max_images``.
+
+        The bank is written to a temporary directory and renamed, so
+        processes building the same bank at once never read a partial one.
+        """
+        targets_hash = target_list_hash(target_list, max_images)
+        target_list = sorted(target_list)
+        if max_images is not None and len(target_list) > max_images:
+            rng = np.random.RandomState(0)
+            target_list = [
+                target_list[i] for i in sorted(
+                    rng.choice(len(target_list), max_images, replace=False))
+            ]
+        border = int(np.floor(min(size) * beta_limit))
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            styles = list(
+                executor.map(lambda file: _image_style(file, size, border),
+                             target_list))
+        tmp_root = f'{root}.tmp{os.getpid()}'
+        os.makedirs(tmp_root, exist_ok=True)
+        for i, name in enumerate(['cdf', 'amplitude', 'mean', 'components']):
+            np.save(
+                osp.join(tmp_root, f'{name}.npy'),
+                np.stack([style[i] for style in styles]).astype(np.float32))
+        with open(osp.join(tmp_root, 'meta.json'), 'w') as f:
+            json.dump(
+                dict(
+                    size=list(size),
+                    beta_limit=beta_limit,
+                    border=border,
+                    max_images=max_images,
+                    targets_hash=targets_hash,
+                    targets=list(target_list)),
+                f,
+                indent=2)
+        try:
+            os.rename(tmp_root, root)
+        except OSError:
+            # built by another process meanwhile
+            shutil.rmtree(tmp_root, ignore_errors=True)
+
+
+def target_list_hash(target_list: list,
+                     max_images: Optional[int] = None) -> str:
+    """Hash of the target files of a :class:`StyleBank`."""
+    text = json.dumps(dict(targets=sorted(target_list), max_images=max_images))
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def _image_style(file: str, size: Tuple[int, int], border: int) -> tuple:
+    img = mmcv.imread(file, channel_order='rgb')
+    # histogram of each channel
+    offsets = np.arange(3) * 256
+    counts = np.bincount(
+        (img.astype(np.int64) + offsets).ravel(),
+        minlength=768).reshape(3, 256)
+    cdf = np.cumsum(counts, axis=1) / (img.shape[0] * img.shape[1])
+
+    # low frequencies of the FFT amplitude at the working resolution, scaled
+    # to a unit image area so they apply to any source size
+    resized = mmcv.imresize(img, size).astype(np.float32)
+    h, w = resized.shape[:2]
+    amplitude = np.fft.fftshift(
+        np.abs(np.fft.fft2(resized, axes=(0, 1))), axes=(0, 1))
+    center_y, center_x = h // 2, w // 2
+    amplitude = amplitude[center_y - border:center_y + border + 1,
+                          center_x - border:center_x + border + 1] / (h * w)
+
+    mean, components = _pca(img.reshape(-1, 3))
+    return cdf, amplitude, mean, components
+
+
+def _pca(pixels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Mean and PCA components (rows, by decreasing variance) of the RGB
+    pixels scaled to [0, 1], with the sign convention of scikit-learn."""
+    pixels = pixels.astype(np.float64) / 255.
+    mean = pixels.mean(axis=0)
+    cov = pixels.T @ pixels / len(pixels) - np.outer(mean, mean)
+    _, vectors = np.linalg.eigh(cov)
+    components = vectors[:, ::-1].T
+    max_abs = np.argmax(np.abs(components), axis=1)
+    components = components * np.sign(
+        components[np.arange(3), max_abs])[:, None]
+    return mean, components
+
+
+def histogram_matching(img: np.ndarray, cdf: np.ndarray,
+                       blend_ratio: float) -> np.ndarray:
+    """``A.HistogramMatching`` against a stored cumulative histogram."""
+    offsets = np.arange(3) * 256
+    counts = np.bincount(
+        (img.astype(np.int64) + offsets).ravel(),
+        minlength=768).reshape(3, 256)
+    src_cdf = np.cumsum(counts, axis=1) / (img.shape[0] * img.shape[1])
+    values = np.arange(256, dtype=np.float64)
+    lut = np.empty((3, 256))
+    for c in range(3):
+        # as skimage, only the values present in the target
+        present = np.diff(cdf[c], prepend=0) > 0
+        lut[c] = np.interp(src_cdf[c], cdf[c][present], values[present])
+    lut = np.rint(blend_ratio * lut + (1 - blend_ratio) * values)
+    lut = np.clip(lut, 0, 255).astype(np.uint8)
+    return lut[np.arange(3), img]
+
+
+def fourier_domain_adaptation(img: np.ndarray, amplitude: np.ndarray,
+                              beta: float) -> np.ndarray:
+    """``A.FDA`` with the low-frequency amplitude of a stored target."""
+    h, w = img.shape[:2]
+    signal = np.fft.fftshift(
+        np.fft.fft2(img.astype(np.float32), axes=(0, 1)), axes=(0, 1))
+    stored = amplitude.shape[0] // 2
+    border = min(int(np.floor(min(h, w) * beta)), stored)
+    center_y, center_x = h // 2, w // 2
+    window = signal[center_y - border:center_y + border + 1,
+                    center_x - border:center_x + border + 1]
+    target = amplitude[stored - border:stored + border + 1,
+                       stored - border:stored + border + 1] * (h * w)
+    window[...] = target * np.exp(1j * np.angle(window))
+    img = np.real(
+        np.fft.ifft2(np.fft.ifftshift(signal, axes=(0, 1)), axes=(0, 1)))
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def pixel_distribution_adaptation(img: np.ndarray, mean: np.ndarray,
+                                  components: np.ndarray,
+                                  blend_ratio: float) -> np.ndarray:
+    """``A.PixelDistributionAdaptation`` (PCA) to stored target statistics."""
+    src_mean, src_components = _pca(img.reshape(-1, 3))
+    components = np.asarray(components, dtype=np.float64)
+    # as albumentations, keep the colors from being inverted
+    if np.sign(np.trace(components)) != np.sign(np.trace(src_components)):
+        components = -components
+    pixels = img.reshape(-1, 3).astype(np.float64) / 255.
+    result = (pixels - src_mean) @ (src_components.T @ components) + mean
+    result = (np.clip(result, 0, 1) * 255).astype(np.uint8)
+    result = result.reshape(img.shape).astype(np.float32)
+    return (img.astype(np.float32) * (1 - blend_ratio) +
+            result * blend_ratio).astype(np.uint8)
+
+
 @TRANSFORMS.register_module()
 class AlbuDomainAdaption(BaseTransform):
     """Apply Albu domain adaption methods
 
+    With ``style_bank``, the styles of the target images are precomputed
+    once into a :class:`StyleBank` at that directory (built if missing) and
+    applied without decoding any target image. With ``max_images``, at most
+    that many targets, a fixed random subset, go into the bank. An existing
+    bank built from other targets raises a ValueError.
     """
 
     def __init__(self,
                  domain_adaption_type: str = 'ALL',
                  target_dir: str = None,
-                 p: float = 0.5) -> None:
+                 p: float = 0.5,
+                 style_bank: Optional[str] = None,
+                 bank_size: Tuple[int, int] = (512, 512),
+                 max_images: Optional[int] = None) -> None:
         self.domain_adaption_type = domain_adaption_type
         self.target_dir = target_dir
         self.p = p
@@ -21,7 +230,31 @@ class AlbuDomainAdaption(BaseTransform):
         assert self.domain_adaption_type in ["HistogramMatching", "FDA", "PixelDistributionAdaptation", 'ALL']
         assert len(self.target_list) > 0
 
+        self.style_bank = style_bank
+        self.bank = None
+        if style_bank is not None:
+            if not osp.exists(osp.join(style_bank, 'meta.json')):
+                StyleBank.build(
+                    style_bank,
+                    self.target_list,
+                    bank_size,
+                    max_images=max_images)
+            self.bank = StyleBank(style_bank)
+            if self.bank.meta.get('targets_hash') != target_list_hash(
+                    self.target_list, max_images):
+                raise ValueError(
+                    f'style bank {style_bank} was not built from the '
+                    f'{len(self.target_list)} images of {target_dir} with '
+                    f'max_images={max_images}, remove it to rebuild it')
+            if self.bank.meta['size'] != list(bank_size):
+                raise ValueError(
+                    f'style bank {style_bank} was built at size '
+                    f'{self.bank.meta["size"]}, not {bank_size}')
+
     def transform(self, results: dict) -> dict:
+        if self.bank is not None:
+            results['img'] = self._transform_with_bank(results['img'])
+            return results
 
         if self.domain_adaption_type == "HistogramMatching":
             aug = A.Compose([A.HistogramMatching(self.target_list, p=self.p)])
@@ -41,9 +274,29 @@ class AlbuDomainAdaption(BaseTransform):
 
         return results
 
+    def _transform_with_bank(self, img: np.ndarray) -> np.ndarray:
+        # same probabilities and parameter ranges as the albumentations path
+        if np.random.rand() >= self.p:
+            return img
+        adaption_type = self.domain_adaption_type
+        if adaption_type == 'ALL':
+            adaption_type = np.random.choice(
+                ["HistogramMatching", "FDA", "PixelDistributionAdaptation"])
+        i = np.random.randint(len(self.bank))
+        if adaption_type == "HistogramMatching":
+            return histogram_matching(img, self.bank.cdf[i],
+                                      np.random.uniform(0.5, 1.0))
+        elif adaption_type == "FDA":
+            return fourier_domain_adaptation(img, self.bank.amplitude[i],
+                                             np.random.uniform(0, 0.1))
+        return pixel_distribution_adaptation(img, self.bank.mean[i],
+                                             self.bank.components[i],
+                                             np.random.uniform(0.25, 1.0))
+
     def __repr__(self):
         repr_str = self.__class__.__name__
         repr_str += f'domain adaption type={self.domain_adaption_type}, '
         repr_str += f'target dir={self.target_dir}, '
-        repr_str += f'p={self.p})'
+        repr_str += f'p={self.p}, '
+        repr_str += f'style bank={self.style_bank})'
         return repr_str
@@ -77,7 +77,9 @@ class PackDetInputs(BaseTransform):
             # `torch.permute()` followed by `torch.contiguous()`
             # Refer to https://github.com/open-mmlab/mmdetection/pull/9533
             # for more details
-            if not img.flags.c_contiguous:
+            # Read-only images (shared by `MultiBranch(copy_on_write=True)`)
+            # take the numpy path too, the copy makes them writeable.
+            if not img.flags.c_contiguous or not img.flags.writeable:
                 img = np.ascontiguousarray(img.transpose(2, 0, 1))
                 img = to_tensor(img)
             else:
@@ -0,0 +1,182 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import json
+import os
+import os.path as osp
+from typing import Optional, Tuple
+
+import cv2
+import mmcv
+import numpy as np
+
+
+class ImageShardCache:
+    """Images stored already resized, in large shard files.
+
+    Every image is stored as one record of a shard, as raw uint8 pixels or
+    as a PNG or a JPEG of the resized image::
+
+        root/
+            meta.json       resize settings, format and color type
+            index.json      img_path -> image index
+            entries.npy     (num_images, 8) int64 shard, offset, nbytes,
+                            h, w, c, ori_h, ori_w
+            shards/         00000.bin, 00001.bin, ...
+
+    Shards are memory-mapped on first use in each process, so the page cache
+    is shared by all dataloader workers. Raw records are returned as
+    read-only views of the mapping.
+
+    Args:
+        root (str): Directory of the cache.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        with open(osp.join(root, 'meta.json')) as f:
+            self.meta = json.load(f)
+        with open(osp.join(root, 'index.json')) as f:
+            self.index = json.load(f)
+        self.entries = np.load(osp.join(root, 'entries.npy'), mmap_mode='r')
+        self.resize = self.meta['resize']
+        self._shards = dict()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, img_path: str) -> bool:
+        return img_path in self.index
+
+    def _shard(self, shard: int) -> np.memmap:
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(
+                osp.join(self.root, 'shards', f'{shard:05d}.bin'),
+                dtype=np.uint8,
+                mode='r')
+        return self._shards[shard]
+
+    def get(self, img_path: str) -> Optional[Tuple[np.ndarray, tuple]]:
+        """The resized image and the original (h, w) of ``img_path``, None
+        if it is not cached."""
+        i = self.index.get(img_path)
+        if i is None:
+            return None
+        shard, offset, nbytes, h, w, c, ori_h, ori_w = (
+            int(value) for value in self.entries[i])
+        record = np.asarray(self._shard(shard)[offset:offset + nbytes])
+        if self.meta['format'] == 'raw':
+            img = record.reshape((h, w, c) if c > 1 else (h, w))
+        else:
+            img = mmcv.imfrombytes(
+                memoryview(record),
+                flag=self.meta['color_type'],
+                channel_order=self.meta['channel_order'])
+        return img, (ori_h, ori_w)
+
+
+def encode_image(img: np.ndarray,
+                 format: str = 'png',
+                 quality: int = 95,
+                 channel_order: str = 'bgr') -> bytes:
+    """Record of an image in an :class:`ImageShardCache`."""
+    if format == 'raw':
+        return np.ascontiguousarray(img).tobytes()
+    if channel_order == 'rgb' and img.ndim == 3:
+        img = img[..., ::-1]
+    if format == 'png':
+        ok, buf = cv2.imencode('.png', img)
+    else:
+        ok, buf = cv2.imencode('.jpg', img,
+                               [cv2.IMWRITE_JPEG_QUALITY, quality])
+    assert ok, 'failed to encode an image'
+    return buf.tobytes()
+
+
+class ImageShardCacheWriter:
+    """Builds an :class:`ImageShardCache`.
+
+    Args:
+        root (str): Directory of the cache.
+        resize (dict): Settings of the ``Resize`` the images went through,
+            ``scale``, ``keep_ratio``, ``interpolation`` and ``backend``.
+        format (str): ``'raw'``, ``'png'`` or ``'jpeg'``. JPEG is lossy,
+            images loaded from such a cache differ slightly from the
+            decoded files. Defaults to 'png'.
+        quality (int): JPEG quality. Defaults to 95.
+        color_type (str): Color type the images were decoded with.
+            Defaults to 'color'.
+        channel_order (str): Channel order the images were decoded with.
+            Defaults to 'bgr'.
+        shard_size (int): Bytes after which a new shard is started.
+            Defaults to 1GB.
+    """
+
+    def __init__(self,
+                 root: str,
+                 resize: dict,
+                 format: str = 'png',
+                 quality: int = 95,
+                 color_type: str = 'color',
+                 channel_order: str = 'bgr',
+                 shard_size: int = 1 << 30) -> None:
+        assert format in ('raw', 'png', 'jpeg'), \
+            f'format should be raw, png or jpeg, got {format}'
+        self.root = root
+        self.meta = dict(
+            resize=resize,
+            format=format,
+            quality=quality,
+            color_type=color_type,
+            channel_order=channel_order)
+        self.shard_size = shard_size
+        self.index = dict()
+        self.entries = []
+        self.shard = -1
+        self.shard_file = None
+        self.offset = 0
+        os.makedirs(osp.join(root, 'shards'), exist_ok=True)
+
+    def encode(self, img: np.ndarray) -> bytes:
+        return encode_image(img, self.meta['format'], self.meta['quality'],
+                            self.meta['channel_order'])
+
+    def add(self, img_path: str, record: bytes, shape: tuple,
+            ori_shape: tuple) -> None:
+        """Add the encoded resized image of ``img_path``.
+
+        Args:
+            img_path (str): Path of the image, the key of the cache.
+            record (bytes): The image encoded by :meth:`encode`.
+            shape (tuple): Shape of the resized image.
+            ori_shape (tuple): (h, w) of the original image.
+        """
+        assert img_path not in self.index, f'{img_path} is added twice'
+        if self.shard_file is None or self.offset >= self.shard_size:
+            if self.shard_file is not None:
+                self.shard_file.close()
+            self.shard += 1
+            self.shard_file = open(
+                osp.join(self.root, 'shards', f'{self.shard:05d}.bin'), 'wb')
+            self.offset = 0
+        self.shard_file.write(record)
+        h, w = shape[:2]
+        c = shape[2] if len(shape) > 2 else 1
+        self.index[img_path] = len(self.entries)
+        self.entries.append([
+            self.shard, self.offset,
+            len(record), h, w, c, ori_shape[0], ori_shape[1]
+        ])
+        self.offset += len(record)
+
+    def close(self) -> None:
+        """Write the index, the meta file last so that a partial cache is
+        never opened."""
+        if self.shard_file is not None:
+            self.shard_file.close()
+        np.save(
+            osp.join(self.root, 'entries.npy'),
+            np.array(self.entries, dtype=np.int64).reshape(-1, 8))
+        with open(osp.join(self.root, 'index.json'), 'w') as f:
+            json.dump(self.index, f)
+        self.meta['num_images'] = len(self.index)
+        with open(osp.join(self.root, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f, indent=2)
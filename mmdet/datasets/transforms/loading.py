@@ -1,4 +1,6 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+import os.path as osp
+import warnings
 from typing import Optional, Tuple, Union
 
 import mmcv
@@ -15,6 +17,7 @@ from mmdet.registry import TRANSFORMS
 from mmdet.structures.bbox import get_box_type
 from mmdet.structures.bbox.box_type import autocast_box_type
 from mmdet.structures.mask import BitmapMasks, PolygonMasks
+from .image_cache import ImageShardCache
 
 
 @TRANSFORMS.register_module()
@@ -64,6 +67,86 @@ class LoadImageFromNDArray(LoadImageFromFile):
         return results
 
 
+@TRANSFORMS.register_module()
+class LoadImageFromCache(LoadImageFromFile):
+    """Load an image from an :class:`ImageShardCache`.
+
+    Cached images are already resized by the ``Resize`` the cache was built
+    for, which has to follow in the pipeline with the same settings. That
+    ``Resize`` then keeps the image and takes the recorded scale factor for
+    ``scale_factor`` and the annotations. Images missing from the cache,
+    or all images if ``cache_root`` holds no cache, are loaded from file as
+    by :obj:`LoadImageFromFile`.
+
+    Required Keys:
+
+    - img_path
+
+    Modified Keys:
+
+    - img
+    - img_shape
+    - ori_shape
+
+    Added Keys:
+
+    - cached_resize
+
+    Args:
+        cache_root (str): Directory of the cache, see
+            ``tools/misc/build_image_cache.py``.
+        **kwargs: Arguments of :obj:`LoadImageFromFile`.
+    """
+
+    def __init__(self, cache_root: str, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.cache_root = cache_root
+        self.cache = None
+        if osp.exists(osp.join(cache_root, 'meta.json')):
+            self.cache = ImageShardCache(cache_root)
+            assert self.cache.meta['color_type'] == self.color_type, \
+                f'{cache_root} was built with color_type ' \
+                f'{self.cache.meta["color_type"]}'
+        else:
+            warnings.warn(f'no image cache at {cache_root}, images are '
+                          'loaded from file')
+
+    def transform(self, results: dict) -> Optional[dict]:
+        """Load the cached image of ``results['img_path']``.
+
+        Args:
+            results (dict): Result dict from
+                :class:`mmengine.dataset.BaseDataset`.
+
+        Returns:
+            dict: The dict contains loaded image and meta information.
+        """
+        cached = None
+        if self.cache is not None:
+            cached = self.cache.get(results['img_path'])
+        if cached is None:
+            return super().transform(results)
+        img, ori_shape = cached
+        if self.to_float32:
+            img = img.astype(np.float32)
+        h, w = img.shape[:2]
+        results['img'] = img
+        results['img_shape'] = (h, w)
+        results['ori_shape'] = ori_shape
+        results['cached_resize'] = dict(
+            self.cache.resize,
+            scale_factor=(w / ori_shape[1], h / ori_shape[0]))
+        return results
+
+    def __repr__(self):
+        repr_str = self.__class__.__name__
+        repr_str += f'(cache_root={self.cache_root}, '
+        repr_str += f'to_float32={self.to_float32}, '
+        repr_str += f"color_type='{self.color_type}', "
+        repr_str += f"imdecode_backend='{self.imdecode_backend}')"
+        return repr_str
+
+
 @TRANSFORMS.register_module()
 class LoadMultiChannelImageFromFiles(BaseTransform):
     """Load multi-channel images from a list of separate channel files.
@@ -39,6 +39,16 @@ except ImportError:
 Number = Union[int, float]
 
 
+def writeable(array: np.ndarray) -> np.ndarray:
+    """``array``, or a copy of it if it is read-only.
+
+    ``MultiBranch(copy_on_write=True)`` hands the image-sized arrays to
+    every branch as shared read-only views, transforms writing into such an
+    array in place take a private copy first.
+    """
+    return array if array.flags.writeable else array.copy()
+
+
 def _fixed_scale_size(
     size: Tuple[int, int],
     scale: Union[float, int, tuple],
@@ -211,6 +221,21 @@ class Resize(MMCV_Resize):
             results['homography_matrix'] = homography_matrix @ results[
                 'homography_matrix']
 
+    def _check_cached_resize(self, cached_resize: dict) -> None:
+        """Check that a cached image went through this resize."""
+        settings = dict(
+            type=type(self).__name__,
+            scale=list(self.scale) if self.scale else None,
+            keep_ratio=self.keep_ratio,
+            interpolation=self.interpolation,
+            backend=self.backend)
+        for key, value in settings.items():
+            if cached_resize.get(key) != value:
+                raise ValueError(
+                    f'the image cache was built for {key}='
+                    f'{cached_resize.get(key)}, the pipeline resizes with '
+                    f'{key}={value}')
+
     @autocast_box_type()
     def transform(self, results: dict) -> dict:
         """Transform function to resize images, bounding boxes and semantic
@@ -228,7 +253,14 @@ class Resize(MMCV_Resize):
         else:
             img_shape = results['img'].shape[:2]
             results['scale'] = _scale_size(img_shape[::-1], self.scale_factor)
-        self._resize_img(results)
+        cached_resize = results.pop('cached_resize', None)
+        if cached_resize is not None:
+            # the image comes resized from LoadImageFromCache
+            self._check_cached_resize(cached_resize)
+            results['scale_factor'] = tuple(cached_resize['scale_factor'])
+            results['keep_ratio'] = self.keep_ratio
+        else:
+            self._resize_img(results)
         self._resize_bboxes(results)
         self._resize_masks(results)
         self._resize_seg(results)
@@ -2227,6 +2259,7 @@ class CutOut(BaseTransform):
         """Call function to drop some regions of image."""
         h, w, c = results['img'].shape
         n_holes = np.random.randint(self.n_holes[0], self.n_holes[1] + 1)
+        results['img'] = writeable(results['img'])
         for _ in range(n_holes):
             x1 = np.random.randint(0, w)
             y1 = np.random.randint(0, h)
@@ -3278,6 +3311,7 @@ class RandomErasing(BaseTransform):
 
     def _transform_img(self, results: dict, patches: List[list]) -> None:
         """Random erasing the image."""
+        results['img'] = writeable(results['img'])
         for patch in patches:
             px1, py1, px2, py2 = patch
             results['img'][py1:py2, px1:px2, :] = self.img_border_value
@@ -3304,6 +3338,7 @@ class RandomErasing(BaseTransform):
 
     def _transform_masks(self, results: dict, patches: List[list]) -> None:
         """Random erasing the masks."""
+        results['gt_masks'].masks = writeable(results['gt_masks'].masks)
         for patch in patches:
             px1, py1, px2, py2 = patch
             results['gt_masks'].masks[:, py1:py2,
@@ -3311,6 +3346,7 @@ class RandomErasing(BaseTransform):
 
     def _transform_seg(self, results: dict, patches: List[list]) -> None:
         """Random erasing the segmentation map."""
+        results['gt_seg_map'] = writeable(results['gt_seg_map'])
         for patch in patches:
             px1, py1, px2, py2 = patch
             results['gt_seg_map'][py1:py2, px1:px2] = self.seg_ignore_label
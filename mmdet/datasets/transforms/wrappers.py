@@ -7,6 +7,7 @@ from mmcv.transforms import BaseTransform, Compose
 from mmcv.transforms.utils import cache_random_params, cache_randomness
 
 from mmdet.registry import TRANSFORMS
+from mmdet.structures.mask import BitmapMasks
 
 
 @TRANSFORMS.register_module()
@@ -22,6 +23,11 @@ class MultiBranch(BaseTransform):
 
     Args:
         branch_field (list): List of branch names.
+        copy_on_write (bool): Whether the branches share the image-sized
+            arrays (``img``, ``gt_seg_map`` and the masks of ``gt_masks``)
+            as read-only views instead of deep copies of them. Transforms
+            writing into one of them in place copy it first, so a branch
+            only copies what it modifies. Defaults to False.
         branch_pipelines (dict): Dict of different pipeline configs
             to be composed.
 
@@ -85,9 +91,12 @@ class MultiBranch(BaseTransform):
         >>> )
     """
 
-    def __init__(self, branch_field: List[str],
+    def __init__(self,
+                 branch_field: List[str],
+                 copy_on_write: bool = False,
                  **branch_pipelines: dict) -> None:
         self.branch_field = branch_field
+        self.copy_on_write = copy_on_write
         self.branch_pipelines = {
             branch: Compose(pipeline)
             for branch, pipeline in branch_pipelines.items()
@@ -112,7 +121,7 @@ class MultiBranch(BaseTransform):
         for branch in self.branch_field:
             multi_results[branch] = {'inputs': None, 'data_samples': None}
         for branch, pipeline in self.branch_pipelines.items():
-            branch_results = pipeline(copy.deepcopy(results))
+            branch_results = pipeline(self._branch_copy(results))
             # If one branch pipeline returns None,
             # it will sample another data from dataset.
             if branch_results is None:
@@ -128,6 +137,22 @@ class MultiBranch(BaseTransform):
                     format_results[key][branch] = results[key]
         return format_results
 
+    def _branch_copy(self, results: dict) -> dict:
+        """Copy of ``results`` for one branch."""
+        if not self.copy_on_write:
+            return copy.deepcopy(results)
+        shared = [results.get('img'), results.get('gt_seg_map')]
+        if isinstance(results.get('gt_masks'), BitmapMasks):
+            shared.append(results['gt_masks'].masks)
+        # deepcopy takes the objects in memo as already copied
+        memo = {}
+        for array in shared:
+            if isinstance(array, np.ndarray):
+                view = array.view()
+                view.flags.writeable = False
+                memo[id(array)] = view
+        return copy.deepcopy(results, memo)
+
     def __repr__(self) -> str:
         repr_str = self.__class__.__name__
         repr_str += f'(branch_pipelines={list(self.branch_pipelines.keys())})'
@@ -1,4 +1,6 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+import hashlib
+import os
 import os.path as osp
 import xml.etree.ElementTree as ET
 from typing import List, Optional, Union
@@ -21,6 +23,8 @@ class XMLDataset(BaseDetDataset):
             corresponding backend. Defaults to None.
     """
 
+    DATA_LIST_CACHE_ATTRS = ('cat2label', )
+
     def __init__(self,
                  img_subdir: str = 'JPEGImages',
                  ann_subdir: str = 'Annotations',
@@ -29,6 +33,23 @@ class XMLDataset(BaseDetDataset):
         self.ann_subdir = ann_subdir
         super().__init__(**kwargs)
 
+    def _data_list_cache_settings(self) -> dict:
+        """The XML files of the images of ``ann_file`` with their mtime and
+        size, so in-place edits of an annotation invalidate the cache."""
+        ann_dir = osp.join(self.sub_data_root, self.ann_subdir)
+        sha = hashlib.sha1()
+        if osp.isfile(self.ann_file):
+            for img_id in list_from_file(
+                    self.ann_file, backend_args=self.backend_args):
+                xml_path = osp.join(ann_dir, f'{img_id}.xml')
+                stat = os.stat(xml_path) if osp.exists(xml_path) else None
+                sha.update(f'{img_id}:{stat and stat.st_mtime_ns}:'
+                           f'{stat and stat.st_size}\n'.encode())
+        return dict(
+            img_subdir=self.img_subdir,
+            ann_subdir=self.ann_subdir,
+            ann_files=sha.hexdigest())
+
     @property
     def sub_data_root(self) -> str:
         """Return the sub data root."""
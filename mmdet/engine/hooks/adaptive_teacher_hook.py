@@ -1,17 +1,16 @@
  # Copyright (c) OpenMMLab. All rights reserved.
 from typing import Optional
 
-import torch.nn as nn
-from mmengine.hooks import Hook
 from mmengine.model import is_model_wrapper
 from mmengine.runner import Runner
 
 from mmdet.registry import HOOKS
 from mmengine.runner import load_checkpoint
+from .mean_teacher_hook import ForeachEMA, MeanTeacherHook
 
 
 @HOOKS.register_module()
-class AdaptiveTeacherHook(Hook):
+class AdaptiveTeacherHook(MeanTeacherHook):
     """Mean Teacher Hook.
 
     Mean Teacher is an efficient semi-supervised learning method in
@@ -34,17 +33,28 @@ class AdaptiveTeacherHook(Hook):
         skip_buffers (bool): Whether to skip the model buffers, such as
             batchnorm running stats (running_mean, running_var), it does not
             perform the ema operation. Default to True.
+        momentum_compensation (bool): Whether to use
+            ``1 - (1 - momentum) ** interval`` as the momentum of each
+            update, so the teacher decays per iteration as with interval 1.
+            Defaults to False.
+        side_stream (bool): Whether to update the teacher on a separate
+            CUDA stream. The next iteration, validation and checkpoints wait
+            for it. Defaults to False.
     """
 
     def __init__(self,
                  momentum: float = 0.0004,
                  interval: int = 1,
                  skip_buffer=True,
-                 burn_up_iters=12000) -> None:
-        assert 0 < momentum < 1
-        self.momentum = momentum
-        self.interval = interval
-        self.skip_buffers = skip_buffer
+                 burn_up_iters=12000,
+                 momentum_compensation: bool = False,
+                 side_stream: bool = False) -> None:
+        super().__init__(
+            momentum=momentum,
+            interval=interval,
+            skip_buffer=skip_buffer,
+            momentum_compensation=momentum_compensation,
+            side_stream=side_stream)
         self.burn_up_iters = burn_up_iters
 
     def before_train(self, runner: Runner) -> None:
@@ -64,6 +74,9 @@ class AdaptiveTeacherHook(Hook):
             load_checkpoint(model.student, model.semi_train_cfg.student_pretrained, map_location='cpu', strict=False)
             model.student.cuda()
 
+        # bound after loading, .cuda() may replace the student tensors
+        self.ema = ForeachEMA(model.student, model.teacher, self.skip_buffers,
+                              self.side_stream)
         # only do it at initial stage
         if runner.iter == 0:
             self.momentum_update(model, 1)
@@ -96,22 +109,7 @@ class AdaptiveTeacherHook(Hook):
             model = model.module
         if hasattr(model, 'model'):
             model = model.model
-        self.momentum_update(model, self.momentum)
-
-    def momentum_update(self, model: nn.Module, momentum: float) -> None:
-        """Compute the moving average of the parameters using exponential
-        moving average."""
-        if self.skip_buffers:
-            for (src_name, src_parm), (dst_name, dst_parm) in zip(
-                    model.student.named_parameters(),
-                    model.teacher.named_parameters()):
-                dst_parm.data.mul_(1 - momentum).add_(
-                    src_parm.data, alpha=momentum)
-        else:
-            for (src_parm,
-                 dst_parm) in zip(model.student.state_dict().values(),
-                                  model.teacher.state_dict().values()):
-                # exclude num_tracking
-                if dst_parm.dtype.is_floating_point:
-                    dst_parm.data.mul_(1 - momentum).add_(
-                        src_parm.data, alpha=momentum)
+        self.momentum_update(model, self.effective_momentum)
+        if self._checkpoint_due(runner):
+            # checkpoints read the teacher on the current stream
+            self._wait()
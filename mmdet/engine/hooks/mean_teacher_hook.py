@@ -1,14 +1,84 @@
 # Copyright (c) OpenMMLab. All rights reserved.
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 
+import torch
 import torch.nn as nn
-from mmengine.hooks import Hook
+from mmengine.hooks import CheckpointHook, Hook
 from mmengine.model import is_model_wrapper
 from mmengine.runner import Runner
 
 from mmdet.registry import HOOKS
 
 
+class ForeachEMA:
+    """Exponential moving average of a student into a teacher.
+
+    The floating point tensors to average are bound once and grouped by
+    device and dtype, so an update runs one ``torch._foreach_mul_`` and one
+    ``torch._foreach_add_`` per group instead of two kernels per tensor.
+    Build it again if the tensors of either model are replaced, e.g. after
+    moving a model to another device.
+
+    Args:
+        student (nn.Module): The averaged model.
+        teacher (nn.Module): The model holding the average.
+        skip_buffers (bool): Whether to only average the parameters.
+            Defaults to True.
+        side_stream (bool): Whether to run the update on a separate CUDA
+            stream. ``wait`` then makes the current stream wait for the last
+            update. Defaults to False.
+    """
+
+    def __init__(self,
+                 student: nn.Module,
+                 teacher: nn.Module,
+                 skip_buffers: bool = True,
+                 side_stream: bool = False) -> None:
+        if skip_buffers:
+            pairs = zip(student.parameters(), teacher.parameters())
+        else:
+            pairs = zip(student.state_dict().values(),
+                        teacher.state_dict().values())
+        self.groups: Dict[tuple, Tuple[List[torch.Tensor],
+                                       List[torch.Tensor]]] = dict()
+        for src, dst in pairs:
+            # exclude num_tracking
+            if not dst.dtype.is_floating_point:
+                continue
+            dsts, srcs = self.groups.setdefault((dst.device, dst.dtype),
+                                                ([], []))
+            dsts.append(dst.data)
+            srcs.append(src.data)
+        self.stream = None
+        if side_stream and torch.cuda.is_available():
+            self.stream = torch.cuda.Stream()
+        self.event = None
+
+    @torch.no_grad()
+    def update(self, momentum: float) -> None:
+        """``teacher = (1 - momentum) * teacher + momentum * student``."""
+        if self.stream is not None:
+            # the student was updated on the current stream
+            self.stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.stream):
+            for dsts, srcs in self.groups.values():
+                if hasattr(torch, '_foreach_mul_'):
+                    torch._foreach_mul_(dsts, 1 - momentum)
+                    torch._foreach_add_(dsts, srcs, alpha=momentum)
+                else:
+                    for dst, src in zip(dsts, srcs):
+                        dst.mul_(1 - momentum).add_(src, alpha=momentum)
+        if self.stream is not None:
+            self.event = torch.cuda.Event()
+            self.event.record(self.stream)
+
+    def wait(self) -> None:
+        """Make the current stream wait for the last side stream update."""
+        if self.event is not None:
+            torch.cuda.current_stream().wait_event(self.event)
+            self.event = None
+
+
 @HOOKS.register_module()
 class MeanTeacherHook(Hook):
     """Mean Teacher Hook.
@@ -33,16 +103,28 @@ class MeanTeacherHook(Hook):
         skip_buffers (bool): Whether to skip the model buffers, such as
             batchnorm running stats (running_mean, running_var), it does not
             perform the ema operation. Default to True.
+        momentum_compensation (bool): Whether to use
+            ``1 - (1 - momentum) ** interval`` as the momentum of each
+            update, so the teacher decays per iteration as with interval 1.
+            Defaults to False.
+        side_stream (bool): Whether to update the teacher on a separate
+            CUDA stream. The next iteration, validation and checkpoints wait
+            for it. Defaults to False.
     """
 
     def __init__(self,
                  momentum: float = 0.001,
                  interval: int = 1,
-                 skip_buffer=True) -> None:
+                 skip_buffer=True,
+                 momentum_compensation: bool = False,
+                 side_stream: bool = False) -> None:
         assert 0 < momentum < 1
         self.momentum = momentum
         self.interval = interval
         self.skip_buffers = skip_buffer
+        self.momentum_compensation = momentum_compensation
+        self.side_stream = side_stream
+        self.ema = None
 
     def before_train(self, runner: Runner) -> None:
         """To check that teacher model and student model exist."""
@@ -51,6 +133,8 @@ class MeanTeacherHook(Hook):
             model = model.module
         assert hasattr(model, 'teacher')
         assert hasattr(model, 'student')
+        self.ema = ForeachEMA(model.student, model.teacher, self.skip_buffers,
+                              self.side_stream)
         # only do it at initial stage
         if runner.iter == 0:
             self.momentum_update(model, 1)
@@ -66,22 +150,51 @@ class MeanTeacherHook(Hook):
         model = runner.model
         if is_model_wrapper(model):
             model = model.module
-        self.momentum_update(model, self.momentum)
+        self.momentum_update(model, self.effective_momentum)
+        if self._checkpoint_due(runner):
+            # checkpoints read the teacher on the current stream
+            self._wait()
+
+    @property
+    def effective_momentum(self) -> float:
+        """Momentum of one update."""
+        if self.momentum_compensation:
+            return 1 - (1 - self.momentum)**self.interval
+        return self.momentum
+
+    def _checkpoint_due(self, runner: Runner) -> bool:
+        if self.ema is None or self.ema.event is None:
+            return False
+        for hook in runner.hooks:
+            if isinstance(hook, CheckpointHook) and not hook.by_epoch and (
+                    self.every_n_train_iters(runner, hook.interval)
+                    or self.is_last_train_iter(runner)):
+                return True
+        return False
+
+    def before_train_iter(self,
+                          runner: Runner,
+                          batch_idx: int,
+                          data_batch: Optional[dict] = None) -> None:
+        self._wait()
+
+    def after_train_epoch(self, runner: Runner) -> None:
+        self._wait()
+
+    def before_val(self, runner: Runner) -> None:
+        self._wait()
+
+    def after_train(self, runner: Runner) -> None:
+        self._wait()
+
+    def _wait(self) -> None:
+        if self.ema is not None:
+            self.ema.wait()
 
     def momentum_update(self, model: nn.Module, momentum: float) -> None:
         """Compute the moving average of the parameters using exponential
         moving average."""
-        if self.skip_buffers:
-            for (src_name, src_parm), (dst_name, dst_parm) in zip(
-                    model.student.named_parameters(),
-                    model.teacher.named_parameters()):
-                dst_parm.data.mul_(1 - momentum).add_(
-                    src_parm.data, alpha=momentum)
-        else:
-            for (src_parm,
-                 dst_parm) in zip(model.student.state_dict().values(),
-                                  model.teacher.state_dict().values()):
-                # exclude num_tracking
-                if dst_parm.dtype.is_floating_point:
-                    dst_parm.data.mul_(1 - momentum).add_(
-                        src_parm.data, alpha=momentum)
+        if self.ema is None:
+            self.ema = ForeachEMA(model.student, model.teacher,
+                                  self.skip_buffers, self.side_stream)
+        self.ema.update(momentum)
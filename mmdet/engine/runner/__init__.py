@@ -1,4 +1,7 @@
 # Copyright (c) OpenMMLab. All rights reserved.
-from .loops import TeacherStudentValLoop
+from .loops import (MultiTargetTestLoop, TeacherPipelineTrainLoop,
+                    TeacherStudentValLoop)
 
-__all__ = ['TeacherStudentValLoop']
+__all__ = [
+    'TeacherStudentValLoop', 'MultiTargetTestLoop', 'TeacherPipelineTrainLoop'
+]
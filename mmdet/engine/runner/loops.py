@@ -1,6 +1,19 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+import logging
+import os.path as osp
+from typing import Dict, List, Optional, Sequence, Union
+
+import torch
+from mmengine.dist import is_main_process
+from mmengine.evaluator import Evaluator
+from mmengine.logging import print_log
 from mmengine.model import is_model_wrapper
-from mmengine.runner import ValLoop
+from mmengine.model.utils import detect_anomalous_params
+from mmengine.runner import IterBasedTrainLoop, TestLoop, ValLoop
+from mmengine.runner.amp import autocast
+from mmengine.runner.base_loop import BaseLoop
+from terminaltables import AsciiTable
+from torch.utils.data import DataLoader
 
 from mmdet.registry import LOOPS
 
@@ -43,3 +56,264 @@ class TeacherStudentValLoop(ValLoop):
 
         self.runner.call_hook('after_val_epoch', metrics=multi_metrics)
         self.runner.call_hook('after_val')
+
+
+@LOOPS.register_module()
+class MultiTargetTestLoop(TestLoop):
+    """Loop for testing one model on several target-domain test sets.
+
+    The model is built and loaded once, then every target dataloader and
+    evaluator pair runs through it. The metrics of all targets are written
+    as one combined table to the log and to ``multi_target_results.txt`` in
+    the log directory.
+
+    Args:
+        runner (Runner): A reference of runner.
+        dataloader (Dataloader or dict): Dataloader of the runner, only used
+            when ``targets`` is empty.
+        evaluator (Evaluator or dict or list): Evaluator of the runner, only
+            used when ``targets`` is empty.
+        targets (list[dict]): Each target is a dict with ``name``,
+            ``dataloader`` and ``evaluator``, and optionally
+            ``pipeline_hash``, set as metainfo of its data samples so the
+            diffusion feature store keeps the targets apart.
+        interleave (bool): Whether to take batches from the targets in turn,
+            so all dataloaders prefetch at the same time. Defaults to False.
+        fp16 (bool): Whether to enable fp16 testing. Defaults to False.
+    """
+
+    def __init__(self,
+                 runner,
+                 dataloader: Union[DataLoader, Dict],
+                 evaluator: Union[Evaluator, Dict, List],
+                 targets: Sequence[dict] = (),
+                 interleave: bool = False,
+                 fp16: bool = False) -> None:
+        if len(targets) == 0:
+            targets = [dict(name='test', dataloader=dataloader,
+                            evaluator=evaluator)]
+        self.names = [target['name'] for target in targets]
+        self.pipeline_hashes = {
+            target['name']: target.get('pipeline_hash')
+            for target in targets
+        }
+        assert len(set(self.names)) == len(self.names), \
+            f'target names must be unique, got {self.names}'
+
+        BaseLoop.__init__(self, runner, targets[0]['dataloader'])
+        self.dataloaders = dict()
+        self.evaluators = dict()
+        diff_rank_seed = runner._randomness_cfg.get('diff_rank_seed', False)
+        for i, target in enumerate(targets):
+            name = target['name']
+            if i == 0:
+                self.dataloaders[name] = self.dataloader
+            elif isinstance(target['dataloader'], dict):
+                self.dataloaders[name] = runner.build_dataloader(
+                    target['dataloader'],
+                    seed=runner.seed,
+                    diff_rank_seed=diff_rank_seed)
+            else:
+                self.dataloaders[name] = target['dataloader']
+            evaluator = target['evaluator']
+            if isinstance(evaluator, (dict, list)):
+                evaluator = runner.build_evaluator(evaluator)
+            dataset = self.dataloaders[name].dataset
+            if hasattr(dataset, 'metainfo'):
+                evaluator.dataset_meta = dataset.metainfo
+            self.evaluators[name] = evaluator
+        self.evaluator = self.evaluators[self.names[0]]
+        self.interleave = interleave
+        self.fp16 = fp16
+        self.test_loss = dict()
+
+    def _iter_batches(self):
+        """Yields ``(name, idx, data_batch)`` over all targets."""
+        if not self.interleave:
+            for name in self.names:
+                for idx, data_batch in enumerate(self.dataloaders[name]):
+                    yield name, idx, data_batch
+            return
+        iters = {name: iter(self.dataloaders[name]) for name in self.names}
+        idxs = {name: 0 for name in self.names}
+        while iters:
+            for name in list(iters):
+                data_batch = next(iters[name], None)
+                if data_batch is None:
+                    iters.pop(name)
+                    continue
+                yield name, idxs[name], data_batch
+                idxs[name] += 1
+
+    def run(self) -> dict:
+        """Launch test on all targets."""
+        self.runner.call_hook('before_test')
+        self.runner.call_hook('before_test_epoch')
+        self.runner.model.eval()
+
+        for name, idx, data_batch in self._iter_batches():
+            self.run_target_iter(name, idx, data_batch)
+
+        multi_metrics = dict()
+        for name in self.names:
+            dataset = self.dataloaders[name].dataset
+            metrics = self.evaluators[name].evaluate(len(dataset))
+            multi_metrics.update(
+                {'/'.join((name, k)): v
+                 for k, v in metrics.items()})
+        self._dump_table(multi_metrics)
+
+        self.runner.call_hook('after_test_epoch', metrics=multi_metrics)
+        self.runner.call_hook('after_test')
+        return multi_metrics
+
+    @torch.no_grad()
+    def run_target_iter(self, name: str, idx: int, data_batch) -> None:
+        """Iterate one mini-batch of target ``name``."""
+        if self.pipeline_hashes[name] is not None:
+            for data_sample in data_batch['data_samples']:
+                data_sample.set_metainfo(
+                    dict(pipeline_hash=self.pipeline_hashes[name]))
+        self.runner.call_hook(
+            'before_test_iter', batch_idx=idx, data_batch=data_batch)
+        with autocast(enabled=self.fp16):
+            outputs = self.runner.model.test_step(data_batch)
+        self.evaluators[name].process(
+            data_samples=outputs, data_batch=data_batch)
+        self.runner.call_hook(
+            'after_test_iter',
+            batch_idx=idx,
+            data_batch=data_batch,
+            outputs=outputs)
+
+    def _dump_table(self, multi_metrics: dict) -> None:
+        """Log the metrics of all targets as one table."""
+        keys = []
+        for key in multi_metrics:
+            metric = key.split('/', 1)[1]
+            if metric not in keys:
+                keys.append(metric)
+        table_data = [['target'] + keys]
+        for name in self.names:
+            row = [name]
+            for metric in keys:
+                value = multi_metrics.get(f'{name}/{metric}', '')
+                row.append(f'{value:.3f}' if isinstance(value, float)
+                           else str(value))
+            table_data.append(row)
+        table = AsciiTable(table_data).table
+        print_log('\n' + table, logger='current')
+        if is_main_process():
+            out_file = osp.join(self.runner.log_dir,
+                                'multi_target_results.txt')
+            with open(out_file, 'w') as f:
+                f.write(table + '\n')
+
+
+@LOOPS.register_module()
+class TeacherPipelineTrainLoop(IterBasedTrainLoop):
+    """Iter-based training loop running the frozen diffusion teacher one
+    batch ahead of the student.
+
+    Before the student step of batch k, batch k+1 is taken from the
+    dataloader, preprocessed and submitted to the teacher producer of the
+    model (see :class:`mmdet.models.utils.TeacherProducer`), so the teacher
+    forward is off the critical path. Each batch is preprocessed once, the
+    teacher and the student step get the same tensors, also with random
+    ``batch_augments``; the train iter hooks see the preprocessed batch.
+    Without ``teacher_producer``, or with a model that has no frozen teacher
+    to run ahead, it behaves like ``IterBasedTrainLoop``.
+
+    Args:
+        runner (Runner): A reference of runner.
+        dataloader (Dataloader or dict): A dataloader object or a dict to
+            build a dataloader.
+        max_iters (int): Total training iterations.
+        teacher_producer (dict, optional): Arguments of the teacher producer,
+            e.g. ``dict(mode='thread', max_pending=2)``. Defaults to None.
+        **kwargs: Other arguments of ``IterBasedTrainLoop``.
+    """
+
+    def __init__(self,
+                 runner,
+                 dataloader: Union[DataLoader, Dict],
+                 max_iters: int,
+                 teacher_producer: Optional[dict] = None,
+                 **kwargs) -> None:
+        super().__init__(runner, dataloader, max_iters, **kwargs)
+        self.teacher_producer_cfg = teacher_producer
+
+    def run(self) -> None:
+        """Launch training."""
+        model = self.runner.model
+        if is_model_wrapper(model):
+            model = model.module
+        producer = None
+        if self.teacher_producer_cfg is not None and hasattr(
+                model, 'build_teacher_producer'):
+            producer = model.build_teacher_producer(
+                **self.teacher_producer_cfg)
+        if producer is None:
+            return super().run()
+
+        self.runner.call_hook('before_train')
+        self.runner.call_hook('before_train_epoch')
+        if self._iter > 0:
+            print_log(
+                f'Advance dataloader {self._iter} steps to skip data '
+                'that has already been trained',
+                logger='current',
+                level=logging.WARNING)
+            for _ in range(self._iter):
+                next(self.dataloader_iterator)
+
+        next_batch = None
+        if self._iter < self._max_iters:
+            next_batch = model.data_preprocessor(
+                next(self.dataloader_iterator), True)
+            model.submit_teacher(next_batch)
+        while self._iter < self._max_iters and not self.stop_training:
+            self.runner.model.train()
+
+            data_batch = next_batch
+            # the teacher works on batch k+1 during the student step of k
+            if self._iter + 1 < self._max_iters:
+                next_batch = model.data_preprocessor(
+                    next(self.dataloader_iterator), True)
+                model.submit_teacher(next_batch)
+            self.run_preprocessed_iter(data_batch)
+
+            self._decide_current_val_interval()
+            if (self.runner.val_loop is not None
+                    and self._iter >= self.val_begin
+                    and (self._iter % self.val_interval == 0
+                         or self._iter == self._max_iters)):
+                self.runner.val_loop.run()
+
+        producer.shutdown()
+        model.teacher_producer = None
+        self.runner.call_hook('after_train_epoch')
+        self.runner.call_hook('after_train')
+        return self.runner.model
+
+    def run_preprocessed_iter(self, data: dict) -> None:
+        """``run_iter`` on a batch already preprocessed by the loop, the
+        ``train_step`` of the model without its preprocessing."""
+        self.runner.call_hook(
+            'before_train_iter', batch_idx=self._iter, data_batch=data)
+        runner_model = self.runner.model
+        model = runner_model.module if is_model_wrapper(
+            runner_model) else runner_model
+        optim_wrapper = self.runner.optim_wrapper
+        with optim_wrapper.optim_context(runner_model):
+            losses = runner_model(**data, mode='loss')
+        parsed_loss, log_vars = model.parse_losses(losses)
+        optim_wrapper.update_params(parsed_loss)
+        if getattr(runner_model, 'detect_anomalous_params', False):
+            detect_anomalous_params(parsed_loss, model=runner_model)
+        self.runner.call_hook(
+            'after_train_iter',
+            batch_idx=self._iter,
+            data_batch=data,
+            outputs=log_vars)
+        self._iter += 1
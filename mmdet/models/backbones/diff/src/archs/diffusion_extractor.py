@@ -4,6 +4,9 @@
 # By Yuxiang Ji
 
 
+import hashlib
+import warnings
+
 from PIL import Image
 import torch
 from torch import nn
@@ -12,11 +15,37 @@ import torch.nn.functional as F
 from diffusers import DDIMScheduler
 from archs.stable_diffusion.diffusion import (
     init_models,
+    init_models_lean,
+    resolve_device_dtype,
+    autocast,
     get_tokens_embedding,
+    PromptEmbeddingCache,
     generalized_steps,
     collect_stride_feats_with_timesteplist,
+    resize_mask,
 )
-from archs.stable_diffusion.resnet import init_resnet_func, init_ca_resnet_func
+from archs.stable_diffusion.attention import set_attention_backend
+from archs.stable_diffusion.resnet import init_resnet_func, HookedLayerRegistry, StopForward
+from archs.feature_store import DiffusionFeatureStore
+
+
+# submodules holding frozen SD weights
+FROZEN_MODULES = ("unet", "vae", "clip", "depth_estimator", "feature_extractor")
+# frozen weights every extractor of a model_id holds whatever the loader
+# pruned (later up blocks, VAE decoder) or dropped (CLIP)
+FINGERPRINT_PREFIXES = ("unet.conv_in.", "unet.time_embedding.", "unet.down_blocks.",
+                        "unet.mid_block.", "unet.up_blocks.0.", "vae.encoder.",
+                        "vae.quant_conv.")
+
+
+def _drop_frozen_weights(module, state_dict, prefix, local_metadata):
+    """State dict hook leaving out the frozen SD weights, see save_frozen_weights."""
+    if module.save_frozen_weights:
+        return
+    for key in module.frozen_state_dict(prefix):
+        state_dict.pop(key, None)
+    local_metadata["frozen_weights"] = dict(
+        model_id=module.diffusion_version, fingerprint=module.frozen_fingerprint())
 
 
 class DiffusionExtractor(nn.Module):
@@ -25,14 +54,56 @@ class DiffusionExtractor(nn.Module):
     and extracting intermediate feature maps.
     """
 
-    def __init__(self, config, device):
+    def __init__(self, config, device=None):
         super().__init__()
-        self.device = device
-
-        self.pipe, self.unet, self.vae, self.clip, self.clip_tokenizer = init_models(
-            model_id=config["model_id"])
-
-        self.scheduler = self.pipe.scheduler
+        # diff_config["device"] and ["dtype"] select the backend, bf16 autocast
+        # on cpu hosts by default
+        self.device, self.dtype = resolve_device_dtype(
+            config.get("device", device), config.get("dtype"))
+        if self.device.type == "cpu" and config.get("num_threads"):
+            torch.set_num_threads(config["num_threads"])
+        print(f"diffusion extractor device={self.device}, dtype={self.dtype}, "
+              f"threads={torch.get_num_threads()}")
+
+        # The lean loader only builds the scheduler, the VAE encoder, the UNet
+        # up to the last hooked up block and CLIP (depth models need the pipe)
+        self.lean_loading = config.get("lean_loading", False) and "depth" not in config["model_id"]
+        if self.lean_loading:
+            last_up_block = None
+            if config.get("feature_only", True) and config.get("idxs_resnet") is not None \
+                    and config.get("idxs_ca") is not None:
+                if self._stops_on_first_unet_call(config):
+                    last_up_block = max(idx[0] for idx in list(config["idxs_resnet"]) + list(config["idxs_ca"]))
+                else:
+                    # the DDIM inversion needs the full eps prediction of
+                    # every step before the last saved one
+                    print("diffusion extractor keeps the full UNet: the "
+                          "inversion runs UNet steps before the last saved "
+                          f"timestep (save_timestep={config.get('save_timestep', [])}, "
+                          f"{len(config['scheduler_timesteps']) - 1} steps)")
+            self.pipe = None
+            self.scheduler, self.unet, self.vae, self.clip, self.clip_tokenizer = init_models_lean(
+                device=self.device, model_id=config["model_id"], dtype=self.dtype,
+                last_up_block=last_up_block)
+            print(f"diffusion extractor lean loading, last_up_block={last_up_block}")
+        else:
+            self.pipe, self.unet, self.vae, self.clip, self.clip_tokenizer = init_models(
+                device=self.device, model_id=config["model_id"], dtype=self.dtype)
+            self.scheduler = self.pipe.scheduler
+
+        # diff_config["attention"] = dict(backend="sliced", chunk_size=4096,
+        # tome_ratio=0.5) bounds the attention memory at full test resolution
+        attention_cfg = dict(config.get("attention") or {})
+        if attention_cfg:
+            set_attention_backend(self.unet, **attention_cfg)
+            set_attention_backend(self.vae, **attention_cfg)
+            print(f"diffusion extractor attention={attention_cfg}")
+
+        # NHWC convolutions are the fast path of oneDNN on cpu
+        self.channels_last = config.get("channels_last", self.device.type == "cpu")
+        if self.channels_last:
+            self.unet.to(memory_format=torch.channels_last)
+            self.vae.to(memory_format=torch.channels_last)
 
         self.num_timesteps = config["num_timesteps"]
         self.scheduler.set_timesteps(self.num_timesteps)
@@ -71,6 +142,18 @@ class DiffusionExtractor(nn.Module):
         print(f"diffusion extractor idxs_resnet={self.idxs_resnet}")
         print(f"diffusion extractor idxs_ca={self.idxs_ca}")
 
+        # Hooked layers are collected and patched once, every forward only
+        # touches these modules
+        self.hook_registry = HookedLayerRegistry(
+            self.unet, idxs_resnet=self.idxs_resnet, idxs_ca=self.idxs_ca)
+        self.hook_registry.install()
+
+        # Opt-in: the hooks write the stride features straight into one
+        # float buffer per stride instead of collecting and concatenating them
+        if config.get("feature_buffers", False):
+            self.hook_registry.buffer_dtype = torch.float
+        print(f"diffusion extractor feature_buffers={config.get('feature_buffers', False)}")
+
         self.output_resolution = (
             config["input_resolution"][0]//8, config["input_resolution"][1]//8)
 
@@ -89,6 +172,16 @@ class DiffusionExtractor(nn.Module):
         print(
             f"diffusion extractor s_tmin={self.s_tmin}, s_tmax={self.s_tmax}")
 
+        # Stop the UNet after the deepest hooked layer, the eps prediction and
+        # DDIM update after it are never used when extracting features
+        self.feature_only = config.get("feature_only", True)
+        print(f"diffusion extractor feature_only={self.feature_only}")
+
+        # Extract every saved step in one UNet call, each from the clean latent
+        # noised independently to its timestep instead of the DDIM inversion
+        self.independent_timesteps = config.get("independent_timesteps", False)
+        print(f"diffusion extractor independent_timesteps={self.independent_timesteps}")
+
         self.eta = config.get("eta", 0.0)
         print(f"diffusion extractor ddim eta={self.eta}")
 
@@ -139,6 +232,55 @@ class DiffusionExtractor(nn.Module):
         else:
             self.tclass_list = None
 
+        # Class prompts of the masked branch are embedded once per label set.
+        # With every label set of the dataset cached, CLIP can leave the GPU.
+        self.prompt_cache = None
+        prompts_complete = not self.do_mask_steps
+        if self.do_mask_steps:
+            self.prompt_cache = PromptEmbeddingCache(
+                self.clip_tokenizer, self.clip, self.device,
+                max_size=config.get("prompt_cache_size", 256))
+            if config.get("prompt_cache_warmup", False) and config.get("classes") is not None:
+                with torch.no_grad():
+                    with self.autocast():
+                        prompts_complete = self.prompt_cache.warmup(config["classes"])
+                print(f"diffusion extractor warmed {len(self.prompt_cache)} class prompts")
+                if prompts_complete and config.get("offload_clip", False) and self.device.type != "cpu":
+                    self.clip.to("cpu", dtype=torch.float32)
+                    print("diffusion extractor offloaded CLIP to cpu")
+
+        # Once cond/uncond and every class prompt are embedded CLIP is unused
+        if config.get("drop_clip", False) and prompts_complete:
+            self.clip = None
+            if self.prompt_cache is not None:
+                self.prompt_cache.clip = None
+            print("diffusion extractor dropped CLIP")
+
+        # Opt-in on-disk store of the stride features, used at evaluation time
+        # to skip the VAE encode and the UNet for images seen before
+        self.feature_store = None
+        store_cfg = config.get("feature_store", None)
+        if store_cfg:
+            self.feature_store = DiffusionFeatureStore(
+                root=store_cfg["root"],
+                model_id=config["model_id"],
+                idxs_resnet=self.idxs_resnet,
+                idxs_ca=self.idxs_ca,
+                save_timestep=self.save_timestep,
+                scheduler_timesteps=config["scheduler_timesteps"],
+                pipeline_hash=store_cfg.get("pipeline_hash", ""),
+                settings=self.feature_store_settings(config),
+                readonly=store_cfg.get("readonly", False))
+            print(f"diffusion extractor feature store: {self.feature_store.root}")
+
+        # save_frozen_weights=False keeps the frozen SD modules out of the
+        # state dict, checkpoints only record model_id and a fingerprint of
+        # them; loading takes these modules from the ones built from model_id
+        self.save_frozen_weights = config.get("save_frozen_weights", True)
+        self._frozen_fingerprint = None
+        self._register_state_dict_hook(_drop_frozen_weights)
+        self._register_load_state_dict_pre_hook(self._restore_frozen_weights)
+
         self.mask_min = config.get("mask_min", 0)
         self.mask_max = config.get("mask_max", 1000)
         if self.do_mask_steps:
@@ -154,11 +296,98 @@ class DiffusionExtractor(nn.Module):
         # print(f"prompt: {self.prompt}")
         # print(f"negative_prompt: {self.snegative_prompt}")
 
+    @staticmethod
+    def _stops_on_first_unet_call(config):
+        """
+        Whether feature-only extraction never needs a UNet output: the last
+        hooked layer stops the forward within the first UNet call, so the
+        blocks after it can be pruned.
+        """
+        if config.get("independent_timesteps", False):
+            return True
+        # the stop fires at the last saved step, which is the first UNet call
+        # only if step 0 is the one saved (e.g. a single inversion step);
+        # without saved steps nothing stops the forward
+        save_timestep = config.get("save_timestep", [])
+        return bool(save_timestep) and max(save_timestep) == 0
+
+    def feature_store_settings(self, config):
+        """
+        Extractor settings that change the stored features besides the
+        hooked layers and the timesteps, so that changing any of them starts
+        a new feature store namespace.
+        """
+        attention_cfg = dict(config.get("attention") or {})
+        tome = None
+        if attention_cfg.get("tome_ratio", 0) > 0:
+            # token merging is lossy, the backend and chunking are not
+            tome = {k: v for k, v in attention_cfg.items() if k.startswith("tome_")}
+        return dict(
+            diffusion_mode=self.diffusion_mode,
+            independent_timesteps=self.independent_timesteps,
+            prompt=self.prompt,
+            negative_prompt=self.negative_prompt,
+            guidance_scale=self.guidance_scale,
+            dtype=str(self.dtype),
+            tome=tome)
+
+    def autocast(self):
+        return autocast(self.device, self.dtype)
+
+    def frozen_state_dict(self, prefix=""):
+        """The tensors of the frozen SD modules, keyed as in the state dict."""
+        state_dict = {}
+        for name in FROZEN_MODULES:
+            module = getattr(self, name, None)
+            if isinstance(module, nn.Module):
+                for key, tensor in module.state_dict().items():
+                    state_dict[f"{prefix}{name}.{key}"] = tensor
+        return state_dict
+
+    @torch.no_grad()
+    def frozen_fingerprint(self):
+        """
+        Fingerprint of the frozen weights: names, shapes and integer sums of
+        the raw bits of the tensors under FINGERPRINT_PREFIXES, taken in
+        float16 so that it neither depends on the device, the precision the
+        weights are kept in nor on what the loader pruned.
+        Computed once, the frozen weights do not change.
+        """
+        if self._frozen_fingerprint is None:
+            sha = hashlib.sha256()
+            sums = []
+            for name, tensor in self.frozen_state_dict().items():
+                if not name.startswith(FINGERPRINT_PREFIXES) or not tensor.is_floating_point():
+                    continue
+                sha.update(f"{name}:{tuple(tensor.shape)}".encode())
+                bits = tensor.detach().to(torch.float16).reshape(-1).view(torch.int16).long()
+                sums.append(torch.stack([bits.sum(), (bits * bits).sum()]))
+            if sums:
+                sha.update(torch.stack(sums).cpu().numpy().tobytes())
+            self._frozen_fingerprint = sha.hexdigest()
+        return self._frozen_fingerprint
+
+    def _restore_frozen_weights(self, state_dict, prefix, local_metadata, strict,
+                                missing_keys, unexpected_keys, error_msgs):
+        """Load pre-hook filling in the frozen weights a checkpoint left out."""
+        frozen = local_metadata.get("frozen_weights")
+        if frozen is None:
+            # checkpoints with the weights, or without their metadata
+            if any(key.startswith(prefix + "unet.") for key in state_dict):
+                return
+        elif frozen["model_id"] != self.diffusion_version or \
+                frozen["fingerprint"] != self.frozen_fingerprint():
+            warnings.warn(
+                f"the frozen weights of the checkpoint ({frozen['model_id']}) differ from "
+                f"the ones built from {self.diffusion_version}, keeping the latter")
+        for key, tensor in self.frozen_state_dict(prefix).items():
+            state_dict.setdefault(key, tensor)
+
     def set_cond(self, prompt, negative_prompt):
         print('prompt', prompt)
         print('negative_prmopt', negative_prompt)
         with torch.no_grad():
-            with torch.autocast("cuda"):
+            with self.autocast():
                 _, cond_prompt = get_tokens_embedding(
                     self.clip_tokenizer, self.clip, self.device, prompt)
                 _, uncond_prompt = get_tokens_embedding(
@@ -181,10 +410,16 @@ class DiffusionExtractor(nn.Module):
         self.batch_size = batch_size
 
     def change_cond(self, prompt, cond_type="cond", batch_size=2):
+        if self.clip is None:
+            raise RuntimeError(
+                "CLIP was dropped (drop_clip=True), the prompts cannot change "
+                "afterwards; set the prompt in the config or keep CLIP")
+        # CLIP may be offloaded to cpu (offload_clip=True)
+        clip_device = next(self.clip.parameters()).device
         with torch.no_grad():
-            with torch.autocast("cuda"):
+            with self.autocast():
                 _, new_cond = get_tokens_embedding(
-                    self.clip_tokenizer, self.clip, self.device, prompt)
+                    self.clip_tokenizer, self.clip, clip_device, prompt)
                 new_cond = new_cond.expand((batch_size, *new_cond.shape[1:]))
                 new_cond = new_cond.to(self.device)
                 if cond_type == "cond":
@@ -219,12 +454,13 @@ class DiffusionExtractor(nn.Module):
                 conditional=self.cond[self.batch_size],
                 unconditional=self.uncond[self.batch_size],
                 min_i=min_i,
-                max_i=max_i
+                max_i=max_i,
+                registry=self.hook_registry,
             )
         return xs
 
     def run_inversion(self, latent, ref_masks=None, ref_labels=None, images=None, min_i=None, max_i=None,
-                      mode="norm"):
+                      mode="norm", fuse_branches=False, noise_seeds=None):
         if mode == "norm":
             xs = generalized_steps(
                 latent,
@@ -262,20 +498,40 @@ class DiffusionExtractor(nn.Module):
                 eta=self.eta,
                 clip=self.clip,
                 clip_tokenizer=self.clip_tokenizer,
+                prompt_cache=self.prompt_cache,
+                registry=self.hook_registry,
+                fuse_branches=fuse_branches,
+                independent_timesteps=self.independent_timesteps,
+                save_timestep=self.save_timestep,
+                noise_seeds=noise_seeds,
             )
         return xs
 
-    def get_feats_stride(self, latents, extractor_fn, preview_mode=False, do_optim_steps=False):
+    def get_feats_stride(self, latents, extractor_fn, preview_mode=False, do_optim_steps=False,
+                         batch_size=None):
         # returns feats of shape [batch_size, num_timesteps, channels, w, h]
         if not preview_mode:
-            init_ca_resnet_func(self.unet, save_hidden=True, reset=True, idxs_resnet=self.idxs_resnet,
-                                idxs_ca=self.idxs_ca, save_timestep=self.save_timestep)
-        outputs = extractor_fn(latents)
+            self.hook_registry.configure(save_hidden=True, save_timestep=self.save_timestep,
+                                         feature_only=self.feature_only)
+            self.hook_registry.reset()
+            use_buffers = self.hook_registry.buffer_dtype is not None
+            if use_buffers:
+                latent = latents[0] if isinstance(latents, list) else latents
+                self.hook_registry.prepare_buffers(batch_size or latent.shape[0], latent.shape[-2:])
+        try:
+            outputs = extractor_fn(latents)
+        except StopForward:
+            outputs = None
         if not preview_mode:
-            feats = collect_stride_feats_with_timesteplist(self.unet, self.idxs_resnet, self.idxs_ca, timestep_list=self.save_timestep,
-                                                           do_mask_steps=self.do_mask_steps, x=latents)
+            if use_buffers:
+                feats = self.hook_registry.take_buffers()
+            else:
+                feats = collect_stride_feats_with_timesteplist(self.unet, self.idxs_resnet, self.idxs_ca, timestep_list=self.save_timestep,
+                                                               do_mask_steps=self.do_mask_steps, x=latents,
+                                                               registry=self.hook_registry, batch_size=batch_size)
             # feats = torch.stack(feats, dim=1)
-            init_ca_resnet_func(self.unet, reset=True)
+            self.hook_registry.configure(save_hidden=False)
+            self.hook_registry.reset()
         else:
             feats = None
         return feats
@@ -288,7 +544,26 @@ class DiffusionExtractor(nn.Module):
         images = (images * 255).round().astype("uint8")
         return [Image.fromarray(image) for image in images]
 
-    def forward(self, images=None, latents=None, guidance_scale=-1, preview_mode=False, stride_mode=False, ref_masks=None, ref_labels=None):
+    def forward(self, images=None, latents=None, guidance_scale=-1, preview_mode=False, stride_mode=False, ref_masks=None, ref_labels=None,
+                fuse_branches=False, store_keys=None):
+        """
+        With ref_masks/ref_labels and fuse_branches=True the no-ref and ref
+        branches are extracted together: the stride features hold the no-ref
+        images in the first half of the batch and the masked images with
+        class prompts in the second half.
+
+        With a feature store and store_keys (one per image), stored features
+        are returned directly; missing ones are computed from the latent mean
+        (with independent_timesteps, noised with seeds taken from the keys)
+        and written to the store.
+        """
+        use_store = (self.feature_store is not None and store_keys is not None
+                     and images is not None and stride_mode and not ref_labels)
+        if use_store:
+            feats = self.feature_store.load_batch(store_keys, images.device)
+            if feats is not None:
+                return feats
+
         if images is None:
             if latents is None:
                 latents = torch.randn((self.batch_size, self.unet.in_channels, 512 //
@@ -300,33 +575,48 @@ class DiffusionExtractor(nn.Module):
             elif self.diffusion_mode == "inversion":
                 raise NotImplementedError
         else:
+            noise_seeds = None
+            images = images.to(device=self.device, dtype=self.vae.dtype)
+            if self.channels_last:
+                images = images.contiguous(memory_format=torch.channels_last)
             if ref_labels and ref_labels:
-                latents = []
-                latents_image = self.vae.encode(images).latent_dist.sample(
-                    generator=None) * 0.18215
-                
                 ## apply mask
-                mask = ref_masks.to(dtype=images.dtype, device=images.device)
-                mask = mask[:, None, :, :]
-                mask = F.interpolate(mask, size=(images.shape[2], images.shape[3]), mode='nearest')
-                mask_images = images*mask 
-                
-                latents_mask_images = self.vae.encode(mask_images).latent_dist.sample(
+                # bool masks from bbox_to_mask, already at the image size
+                mask = resize_mask(ref_masks[:, None, :, :], images.shape[2:])
+                mask_images = images * mask.to(dtype=images.dtype, device=images.device)
+
+                # image and masked image share one VAE encode
+                latents = self.vae.encode(torch.cat([images, mask_images], dim=0)).latent_dist.sample(
                     generator=None) * 0.18215
-                
-                latents.append(latents_image)
-                latents.append(latents_mask_images)
+                latents = list(latents.chunk(2, dim=0))
+            elif use_store:
+                # stored features must be reproducible, so use the mean
+                latents = self.vae.encode(images).latent_dist.mean * 0.18215
+                if self.independent_timesteps:
+                    # and noise the latents of each image from its key
+                    noise_seeds = [int(key.split('/')[-1][:15], 16) for key in store_keys]
             else:
                 latents = self.vae.encode(images).latent_dist.sample(
                     generator=None) * 0.18215
             
+            fuse_branches = fuse_branches and bool(ref_labels)
             if self.diffusion_mode == "inversion":
                 def extractor_fn(latents): return self.run_inversion(
-                    latents, ref_masks=ref_masks, ref_labels=ref_labels, images=images)
+                    latents, ref_masks=ref_masks, ref_labels=ref_labels, images=images,
+                    fuse_branches=fuse_branches, noise_seeds=noise_seeds)
             elif self.diffusion_mode == "generation":
                 raise NotImplementedError
 
         with torch.no_grad():
-            with torch.autocast("cuda"):
+            with self.autocast():
                 if stride_mode:
-                    return self.get_feats_stride(latents, extractor_fn)
+                    batch_size = None
+                    if images is not None and fuse_branches:
+                        batch_size = 2 * images.shape[0]
+                    feats = self.get_feats_stride(latents, extractor_fn, batch_size=batch_size)
+                    if self.channels_last:
+                        # the aggregation network views the features as NCHW
+                        feats = tuple(None if feat is None else feat.contiguous() for feat in feats)
+                    if use_store:
+                        self.feature_store.save_batch(store_keys, feats)
+                    return feats
@@ -0,0 +1,133 @@
+# On-disk store of frozen diffusion features
+# The SD UNet, VAE and CLIP are frozen, so the per-stride outputs of
+# collect_stride_feats_with_timesteplist only depend on the input image,
+# the test pipeline and the extractor settings. They are computed once
+# (from the latent mean, so they are reproducible) and memory-mapped on
+# later evaluations.
+
+import hashlib
+import json
+import os
+import os.path as osp
+
+import numpy as np
+import torch
+
+
+def config_hash(cfg, length=16):
+    """Stable hash of a (nested) config, e.g. a test pipeline."""
+    text = json.dumps(cfg, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:length]
+
+
+def pipeline_hash(pipeline):
+    """Hash of a test pipeline, used to key a feature store."""
+    return config_hash([dict(transform) for transform in pipeline])
+
+
+class DiffusionFeatureStore:
+    """
+    Memory-mapped store of the stride features of the diffusion extractor.
+
+    Features live under ``root/<namespace>/<key[:2]>/<key>/stride<k>.npy``.
+    The namespace hashes model_id, the hooked idxs, the timesteps, the other
+    extractor ``settings`` that change the features (noising, conditioning,
+    guidance, dtype, token merging) and the pipeline hash, the key hashes
+    the image path and its input geometry.
+    Images tested with another pipeline than ``pipeline_hash`` (several
+    targets with one model) pass their own pipeline hash to :meth:`key` and
+    go to the namespace of that pipeline.
+    """
+
+    def __init__(self, root, model_id, idxs_resnet, idxs_ca, save_timestep,
+                 scheduler_timesteps, pipeline_hash='', settings=None,
+                 readonly=False):
+        self.base_root = root
+        self.meta = dict(
+            model_id=model_id,
+            idxs_resnet=[list(idx) for idx in idxs_resnet],
+            idxs_ca=[list(idx) for idx in idxs_ca],
+            save_timestep=list(save_timestep),
+            scheduler_timesteps=[float(t) for t in scheduler_timesteps],
+            settings=dict(settings or {}),
+            pipeline_hash=pipeline_hash)
+        self.readonly = readonly
+        self.namespaces = dict()
+        self.namespace = self._namespace(pipeline_hash)
+        self.root = osp.join(root, self.namespace)
+
+    def _namespace(self, pipeline_hash):
+        """Namespace of a pipeline, created with its meta file on first use."""
+        if pipeline_hash not in self.namespaces:
+            meta = dict(self.meta, pipeline_hash=pipeline_hash)
+            namespace = config_hash(meta)
+            if not self.readonly:
+                ns_root = osp.join(self.base_root, namespace)
+                os.makedirs(ns_root, exist_ok=True)
+                meta_file = osp.join(ns_root, 'meta.json')
+                if not osp.exists(meta_file):
+                    with open(meta_file, 'w') as f:
+                        json.dump(meta, f, indent=2)
+            self.namespaces[pipeline_hash] = namespace
+        return self.namespaces[pipeline_hash]
+
+    def key(self, img_path, input_shape, pipeline_hash=None):
+        """Key of an image, in the namespace of ``pipeline_hash`` (that of
+        the store if None)."""
+        namespace = self.namespace if pipeline_hash is None else \
+            self._namespace(pipeline_hash)
+        text = f'{img_path}|{tuple(input_shape)}'
+        return f"{namespace}/{hashlib.sha1(text.encode('utf-8')).hexdigest()}"
+
+    def _entry(self, key):
+        namespace, key = key.split('/')
+        return osp.join(self.base_root, namespace, key[:2], key)
+
+    def __contains__(self, key):
+        return osp.exists(osp.join(self._entry(key), 'done'))
+
+    def load(self, key):
+        """Returns the memory-mapped stride features of one image."""
+        entry = self._entry(key)
+        with open(osp.join(entry, 'done')) as f:
+            num_strides = int(f.read())
+        feats = []
+        for k in range(num_strides):
+            file = osp.join(entry, f'stride{k}.npy')
+            feats.append(np.load(file, mmap_mode='r') if osp.exists(file) else None)
+        return feats
+
+    def load_batch(self, keys, device):
+        """
+        Stacks the stored features of a batch, or returns None if any of the
+        images is missing.
+        """
+        if not all(key in self for key in keys):
+            return None
+        entries = [self.load(key) for key in keys]
+        feats = []
+        for k in range(len(entries[0])):
+            if entries[0][k] is None:
+                feats.append(None)
+                continue
+            feat = np.stack([entry[k] for entry in entries], axis=0)
+            feats.append(torch.from_numpy(feat).to(device, non_blocking=True))
+        return tuple(feats)
+
+    def save_batch(self, keys, feats):
+        if self.readonly:
+            return
+        feats = [None if feat is None else feat.detach().to(
+            'cpu', dtype=torch.float16).numpy() for feat in feats]
+        for i, key in enumerate(keys):
+            entry = self._entry(key)
+            os.makedirs(entry, exist_ok=True)
+            for k, feat in enumerate(feats):
+                if feat is None:
+                    continue
+                # write then rename, so readers never see a partial file
+                tmp_file = osp.join(entry, f'stride{k}.tmp.npy')
+                np.save(tmp_file, feat[i])
+                os.replace(tmp_file, osp.join(entry, f'stride{k}.npy'))
+            with open(osp.join(entry, 'done'), 'w') as f:
+                f.write(str(len(feats)))
@@ -0,0 +1,164 @@
+# Attention backends for the frozen SD models
+# At test resolution (1333x800, pad 64) the finest UNet level attends over
+# ~17k latent tokens, so the attention memory dominates the extractor.
+# The processors below run torch SDPA over query chunks and optionally
+# merge the self-attention keys/values (Token Merging for Stable Diffusion,
+# Bolya & Hoffman 2023). Both also run on cpu.
+
+import torch
+import torch.nn.functional as F
+
+
+def scaled_dot_product_attention(query, key, value, attn_bias=None):
+    """Fused SDPA when torch provides it, otherwise the explicit softmax."""
+    if hasattr(F, "scaled_dot_product_attention"):
+        return F.scaled_dot_product_attention(
+            query, key, value, attn_mask=attn_bias, dropout_p=0.0, is_causal=False)
+    scores = query @ key.transpose(-1, -2) * query.shape[-1] ** -0.5
+    if attn_bias is not None:
+        scores = scores + attn_bias
+    return scores.softmax(dim=-1) @ value
+
+
+def merge_tokens(x, r, stride=4):
+    """
+    Bipartite soft matching of ToMe. Every ``stride``-th token is a
+    destination, the ``r`` source tokens most similar to a destination are
+    averaged into it. Returns the merged tokens and how many tokens each
+    one stands for.
+    """
+    batch_size, num_tokens, channels = x.shape
+    is_dst = torch.arange(num_tokens, device=x.device) % stride == 0
+    src, dst = x[:, ~is_dst], x[:, is_dst]
+    r = min(r, src.shape[1])
+
+    metric = F.normalize(src, dim=-1) @ F.normalize(dst, dim=-1).transpose(-1, -2)
+    node_max, node_idx = metric.max(dim=-1)
+    edge_idx = node_max.argsort(dim=-1, descending=True)
+    merged_idx, unmerged_idx = edge_idx[:, :r], edge_idx[:, r:]
+    dst_idx = node_idx.gather(-1, merged_idx)
+
+    merged = src.gather(1, merged_idx[..., None].expand(-1, -1, channels))
+    dst = dst.scatter_reduce(1, dst_idx[..., None].expand(-1, -1, channels), merged,
+                             reduce="mean", include_self=True)
+    unmerged = src.gather(1, unmerged_idx[..., None].expand(-1, -1, channels))
+
+    dst_size = torch.ones(dst.shape[:2], device=x.device, dtype=x.dtype)
+    dst_size = dst_size.scatter_add(1, dst_idx, torch.ones_like(dst_idx, dtype=x.dtype))
+    size = torch.cat([torch.ones(unmerged.shape[:2], device=x.device, dtype=x.dtype), dst_size], dim=1)
+    return torch.cat([unmerged, dst], dim=1), size
+
+
+class ChunkedAttnProcessor:
+    """
+    Attention processor running SDPA over chunks of ``chunk_size`` queries
+    (all at once if None), so the score matrix of one chunk is live at a
+    time. With ``merge_ratio`` > 0, self-attention over at least
+    ``merge_min_tokens`` tokens attends to keys/values merged down by that
+    ratio; the queries and the output keep every token. Keys/values are
+    linear in the input tokens, so the tokens are merged before projection
+    and the merged sizes enter the softmax as a log bias (proportional
+    attention).
+    """
+
+    def __init__(self, chunk_size=None, merge_ratio=0.0, merge_stride=4, merge_min_tokens=4096):
+        self.chunk_size = chunk_size
+        self.merge_ratio = merge_ratio
+        self.merge_stride = merge_stride
+        self.merge_min_tokens = merge_min_tokens
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None,
+                 temb=None, *args, **kwargs):
+        residual = hidden_states
+        if getattr(attn, "spatial_norm", None) is not None:
+            hidden_states = attn.spatial_norm(hidden_states, temb)
+
+        input_ndim = hidden_states.ndim
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            # reshape, the VAE may run channels_last
+            hidden_states = hidden_states.reshape(batch_size, channel, height * width).transpose(1, 2)
+        batch_size, seq_len, _ = hidden_states.shape
+
+        if getattr(attn, "group_norm", None) is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
+
+        is_self = encoder_hidden_states is None
+        if is_self:
+            context = hidden_states
+        else:
+            context = encoder_hidden_states
+            if attn.norm_cross:
+                context = attn.norm_encoder_hidden_states(context)
+
+        attn_bias = None
+        if is_self and self.merge_ratio > 0 and seq_len >= self.merge_min_tokens:
+            context, size = merge_tokens(context, int(seq_len * self.merge_ratio), self.merge_stride)
+            attn_bias = size.log()[:, None, None, :]
+        if attention_mask is not None:
+            attention_mask = attn.prepare_attention_mask(attention_mask, context.shape[1], batch_size)
+            attention_mask = attention_mask.view(batch_size, attn.heads, -1, attention_mask.shape[-1])
+            attn_bias = attention_mask if attn_bias is None else attn_bias + attention_mask
+
+        query = attn.to_q(hidden_states)
+        key = attn.to_k(context)
+        value = attn.to_v(context)
+        head_dim = key.shape[-1] // attn.heads
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        if attn_bias is not None:
+            attn_bias = attn_bias.to(query.dtype)
+
+        chunk_size = self.chunk_size or seq_len
+        if chunk_size >= seq_len:
+            hidden_states = scaled_dot_product_attention(query, key, value, attn_bias)
+        else:
+            hidden_states = torch.empty_like(query)
+            for start in range(0, seq_len, chunk_size):
+                end = start + chunk_size
+                bias = attn_bias
+                if bias is not None and bias.shape[-2] > 1:
+                    bias = bias[:, :, start:end]
+                hidden_states[:, :, start:end] = scaled_dot_product_attention(
+                    query[:, :, start:end], key, value, bias)
+
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+        hidden_states = attn.to_out[0](hidden_states)
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+        return hidden_states / attn.rescale_output_factor
+
+
+def set_attention_backend(model, backend=None, chunk_size=4096, tome_ratio=0.0, tome_stride=4,
+                          tome_min_tokens=4096):
+    """
+    Installs an attention backend on every attention layer of a UNet or VAE.
+
+    backend: None keeps the diffusers default, "sdpa" runs fused attention
+    in one call, "sliced" in query chunks of ``chunk_size``, "xformers"
+    uses the xformers memory-efficient kernels. ``tome_ratio`` > 0 merges
+    that share of the self-attention (``attn1``) keys/values, which is lossy
+    and not available with xformers.
+    """
+    if backend is None and tome_ratio <= 0:
+        return
+    if backend == "xformers":
+        assert tome_ratio <= 0, "token merging is not available with xformers"
+        model.enable_xformers_memory_efficient_attention()
+        return
+    if backend not in (None, "sdpa", "sliced"):
+        raise ValueError(f"attention backend should be None, 'sdpa', 'sliced' or "
+                         f"'xformers', got {backend!r}")
+
+    chunk_size = chunk_size if backend == "sliced" else None
+    processor = ChunkedAttnProcessor(chunk_size=chunk_size)
+    self_processor = ChunkedAttnProcessor(chunk_size=chunk_size, merge_ratio=tome_ratio,
+                                          merge_stride=tome_stride, merge_min_tokens=tome_min_tokens)
+    for name, module in model.named_modules():
+        if hasattr(module, "set_processor"):
+            module.set_processor(self_processor if name.endswith("attn1") else processor)
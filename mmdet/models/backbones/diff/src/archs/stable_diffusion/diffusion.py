@@ -3,8 +3,10 @@
 # Based on HyperFeature
 # By Yuxiang Ji
 
+import itertools
 import numpy as np
 import os
+from collections import OrderedDict
 from PIL import Image
 import PIL
 import torch
@@ -48,6 +50,100 @@ def get_tokens_embedding(clip_tokenizer, clip, device, prompt):
     return tokens, embedding
 
 
+CLASS_PROMPT_PREFIX = "A photo of "
+
+
+def canonical_label_key(prompt, prefix=CLASS_PROMPT_PREFIX):
+    """
+    Canonical key of a class prompt such as "A photo of person, car":
+    the sorted tuple of its labels, () for the empty prompt.
+    """
+    if prompt.startswith(prefix):
+        prompt = prompt[len(prefix):]
+    labels = set(label.strip() for label in prompt.split(","))
+    labels.discard("")
+    return tuple(sorted(labels))
+
+
+def label_key_to_prompt(key, prefix=CLASS_PROMPT_PREFIX):
+    if len(key) == 0:
+        return ""
+    return prefix + ", ".join(key)
+
+
+class PromptEmbeddingCache:
+    """
+    LRU cache of CLIP embeddings for the class prompts of the masked branch.
+    Prompts are keyed by their canonical (sorted) label set, so only the
+    prompts missing from the cache go through the tokenizer and CLIP.
+    """
+
+    def __init__(self, clip_tokenizer, clip, device, max_size=256):
+        self.clip_tokenizer = clip_tokenizer
+        self.clip = clip
+        self.device = device
+        self.dtype = clip.dtype if clip is not None else torch.float16
+        self.max_size = max_size
+        self.embeddings = OrderedDict()
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def __contains__(self, key):
+        return key in self.embeddings
+
+    def _encode(self, keys):
+        if self.clip is None:
+            raise RuntimeError(
+                f"CLIP was dropped but the prompts of {keys} are not cached")
+        prompts = [label_key_to_prompt(key) for key in keys]
+        clip_device = next(self.clip.parameters()).device
+        _, embedding = get_tokens_embedding(
+            self.clip_tokenizer, self.clip, clip_device, prompts)
+        return embedding.to(device=self.device, dtype=self.dtype)
+
+    def _put(self, key, embedding):
+        self.embeddings[key] = embedding
+        self.embeddings.move_to_end(key)
+        while len(self.embeddings) > self.max_size:
+            self.embeddings.popitem(last=False)
+
+    @torch.no_grad()
+    def __call__(self, prompts):
+        """Returns the [len(prompts), tokens, dim] embedding of the prompts."""
+        keys = [canonical_label_key(prompt) for prompt in prompts]
+        missing = list(OrderedDict.fromkeys(
+            key for key in keys if key not in self.embeddings))
+        if missing:
+            for key, embedding in zip(missing, self._encode(missing)):
+                self._put(key, embedding)
+        embeddings = []
+        for key in keys:
+            self.embeddings.move_to_end(key)
+            embeddings.append(self.embeddings[key])
+        return torch.stack(embeddings, dim=0)
+
+    @torch.no_grad()
+    def warmup(self, classes, batch_size=64):
+        """
+        Pre-computes the prompts of the label subsets of ``classes``, smallest
+        subsets first, until the cache is full. Returns True if every subset
+        is cached.
+        """
+        classes = sorted(set(classes))
+        keys = []
+        for num in range(len(classes) + 1):
+            for key in itertools.combinations(classes, num):
+                if len(keys) >= self.max_size:
+                    break
+                keys.append(key)
+        for i in range(0, len(keys), batch_size):
+            batch_keys = keys[i:i + batch_size]
+            for key, embedding in zip(batch_keys, self._encode(batch_keys)):
+                self._put(key, embedding)
+        return len(keys) == 2 ** len(classes)
+
+
 def latent_to_image(vae, latent):
     latent = latent / 0.18215
     image = vae.decode(latent.to(vae.dtype)).sample
@@ -76,6 +172,20 @@ def image_to_latent(vae, image, generator=None, mult=64, w=512, h=512):
     return vae.encode(image).latent_dist.sample(generator=generator) * 0.18215
 
 
+def resize_mask(mask, size):
+    """
+    Nearest resize of (N, 1, H, W) masks. Integer downscales, e.g. image
+    masks to the latent size, are a strided view, the same pixels as the
+    nearest interpolation.
+    """
+    h, w = mask.shape[-2:]
+    if (h, w) == tuple(size):
+        return mask
+    if h % size[0] == 0 and w % size[1] == 0:
+        return mask[..., ::h // size[0], ::w // size[1]]
+    return F.interpolate(mask.float(), size=size, mode='nearest')
+
+
 def get_xt_next(xt, et, at, at_next, a_skip, eta, tmask, do_adpm_steps=False, gamma_t=None):
     """
     Uses the DDIM formulation for sampling xt_next
@@ -105,12 +215,31 @@ def get_xt_next(xt, et, at, at_next, a_skip, eta, tmask, do_adpm_steps=False, ga
     return x0_t, xt_next
 
 
+def seeded_noise(x, seeds=None, step=0):
+    """
+    Gaussian noise like x. With one seed per sample, the noise of a sample
+    only depends on its seed and the step, e.g. for the feature store.
+    """
+    if seeds is None:
+        return torch.randn_like(x)
+    noise = []
+    for seed in seeds:
+        generator = torch.Generator(x.device).manual_seed(
+            (int(seed) + step * 1000003) % (2 ** 63))
+        noise.append(torch.randn(x.shape[1:], generator=generator,
+                                 device=x.device, dtype=x.dtype))
+    return torch.stack(noise, dim=0)
+
+
 def generalized_steps(x, model, scheduler, **kwargs):
     """
     Performs either the generation or inversion diffusion process.
     """
     ref_masks = kwargs.get("ref_masks", None)
     ref_labels = kwargs.get("ref_labels", None)
+    # With fuse_branches the no-ref latent and the masked latent go through
+    # one UNet call, conditioned on the empty and the class prompts
+    fuse_branches = kwargs.get("fuse_branches", False)
     if ref_masks is not None:
         x, mask_x = x
         
@@ -200,15 +329,18 @@ def generalized_steps(x, model, scheduler, **kwargs):
             
             #########################################################################################3
                 prompts += ref_labels
-                mask = ref_masks.to(dtype=x.dtype, device=x.device)
-                mask = mask[:, None, :, :]
-                mask = F.interpolate(mask, size=(x_h, x_w), mode='nearest')
+                mask = resize_mask(ref_masks[:, None, :, :], (x_h, x_w))
+                mask = mask.to(dtype=x.dtype, device=x.device)
                 mask_ = mask[None, ...]
                 masks = torch.cat([masks, mask_], dim=0)
                 prompt_cnt += 1
 
-                _, label_embedding = get_tokens_embedding(
-                    clip_tokenizer, clip, x.device, prompts)
+                prompt_cache = kwargs.get("prompt_cache", None)
+                if prompt_cache is not None:
+                    label_embedding = prompt_cache(prompts)
+                else:
+                    _, label_embedding = get_tokens_embedding(
+                        clip_tokenizer, clip, x.device, prompts)
                 uncond_embedding = kwargs["unconditional"]
                 text_embedding = torch.cat(
                     [uncond_embedding, label_embedding], dim=0)
@@ -218,6 +350,49 @@ def generalized_steps(x, model, scheduler, **kwargs):
             
             #########################################################################################3
 
+        if kwargs.get("independent_timesteps", False):
+            # one UNet call for every saved step, nothing is carried between
+            # steps so there is no DDIM update and no output latent
+            seq_iter = list(seq_iter)
+            steps = [i for i in range(len(seq_iter))
+                     if i in (kwargs.get("save_timestep") or range(len(seq_iter)))
+                     and (kwargs.get("max_i") is None or i < kwargs["max_i"])
+                     and (kwargs.get("min_i") is None or i >= kwargs["min_i"])]
+            registry = kwargs["registry"]
+            cond = kwargs["conditional"]
+            guidance_scale = kwargs.get("guidance_scale", -1)
+            alphas = (1 - b).cumprod(dim=0)
+            samples, hidden_states, timesteps = [], [], []
+            for i in steps:
+                t = int(seq_iter[i])
+                xt = x
+                mask_xt = mask_x if ref_masks is not None else None
+                if i > 0:
+                    # the inversion reaches step i at noise level t, sample
+                    # that level directly from the clean latent
+                    at = alphas[t].to(x.dtype)
+                    noise = seeded_noise(x, kwargs.get("noise_seeds"), i)
+                    xt = at.sqrt() * x + (1 - at).sqrt() * noise
+                    if mask_xt is not None:
+                        mask_xt = at.sqrt() * mask_xt + (1 - at).sqrt() * noise
+                if fuse_branches and ref_masks != None and ref_labels != None:
+                    sample = torch.cat([xt, mask_xt], dim=0)
+                    states = torch.cat([cond, label_embedding], dim=0)
+                elif ref_masks != None and ref_labels != None:
+                    sample, states = mask_xt, label_embedding
+                elif guidance_scale == -1:
+                    sample, states = xt, cond
+                else:
+                    sample = xt.repeat(2, 1, 1, 1)
+                    states = torch.cat([kwargs["unconditional"], cond], dim=0)
+                samples.append(sample)
+                hidden_states.append(states)
+                timesteps.append(torch.full((sample.shape[0],), t, device=x.device))
+            registry.set_timestep(tuple(steps))
+            model(torch.cat(samples, dim=0), torch.cat(timesteps, dim=0),
+                  encoder_hidden_states=torch.cat(hidden_states, dim=0))
+            return None
+
         xs = x
         for i, (t, next_t) in enumerate(zip(seq_iter, seq_next_iter)):
             max_i = kwargs.get("max_i", None)
@@ -235,7 +410,11 @@ def generalized_steps(x, model, scheduler, **kwargs):
             # Expand to the correct dim
             at, at_next = at[:, None, None, None], at_next[:, None, None, None]
 
-            set_timestep(model, i)
+            registry = kwargs.get("registry", None)
+            if registry is not None:
+                registry.set_timestep(i)
+            else:
+                set_timestep(model, i)
 
             xt = xs
             if do_with_depth:
@@ -246,7 +425,14 @@ def generalized_steps(x, model, scheduler, **kwargs):
             cond = kwargs["conditional"]
             guidance_scale = kwargs.get("guidance_scale", -1)
 
-            if ref_masks != None and ref_labels != None:
+            if fuse_branches and ref_masks != None and ref_labels != None:
+                et = model(torch.cat([xt_input, mask_x], dim=0), t,
+                           encoder_hidden_states=torch.cat([cond, label_embedding], dim=0)).sample
+                # only the no-ref latent is carried to the next step, the ref
+                # branch always feeds mask_x to the UNet
+                et = et[:batch_size, ...]
+
+            elif ref_masks != None and ref_labels != None:
                 # xt_input = torch.cat([xt_input, mask_x], dim=0)
                 # et = model(
                 #     xt_input, t, encoder_hidden_states=text_embedding).sample
@@ -282,7 +468,7 @@ def generalized_steps(x, model, scheduler, **kwargs):
             else:
                 a_skip = at_next / at
 
-            if do_mask_steps and ref_masks != None and ref_labels != None:
+            if do_mask_steps and ref_masks != None and ref_labels != None and not fuse_branches:
                 if t >= mask_min and t <= mask_max:
                     
                     xts = xt.repeat(prompt_cnt, 1, 1, 1)
@@ -316,25 +502,176 @@ def freeze_weights(weights):
         param.requires_grad = False
 
 
+DTYPES = {
+    "float16": torch.float16,
+    "fp16": torch.float16,
+    "bfloat16": torch.bfloat16,
+    "bf16": torch.bfloat16,
+    "float32": torch.float32,
+    "fp32": torch.float32,
+}
+
+
+def resolve_device_dtype(device=None, dtype=None):
+    """
+    Device and weight dtype of the diffusion models. The device defaults to
+    cuda when available, the dtype to fp16 on cuda and bf16 on cpu, where
+    most fp16 kernels are missing or emulated.
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    device = torch.device(device)
+    if dtype is None:
+        dtype = torch.float16 if device.type == "cuda" else torch.bfloat16
+    elif isinstance(dtype, str):
+        dtype = DTYPES[dtype]
+    return device, dtype
+
+
+def autocast(device, dtype):
+    """Autocast context of the diffusion models, a no-op for fp32."""
+    return torch.autocast(torch.device(device).type, dtype=dtype,
+                          enabled=dtype != torch.float32)
+
+
+def _find_weights(model_id, subfolder, dtype):
+    """Safetensors file of a local pipeline component, or None."""
+    folder = os.path.join(model_id, subfolder)
+    names = ["diffusion_pytorch_model.safetensors", "model.safetensors"]
+    if dtype == torch.float16:
+        names = ["diffusion_pytorch_model.fp16.safetensors", "model.fp16.safetensors"] + names
+    for name in names:
+        if os.path.isfile(os.path.join(folder, name)):
+            return os.path.join(folder, name)
+    return None
+
+
+def _load_weights(model, weights_file, device, dtype):
+    """
+    Loads a safetensors file straight to ``device``/``dtype`` into a model
+    built with empty weights. Weights of modules removed from the model are
+    skipped; returns False if any weight of the model is missing.
+    """
+    from safetensors.torch import load_file
+
+    model_keys = set(model.state_dict().keys())
+    state_dict = load_file(weights_file, device=str(device))
+    state_dict = {
+        k: v.to(dtype) if v.is_floating_point() else v
+        for k, v in state_dict.items() if k in model_keys}
+    if set(state_dict.keys()) != model_keys:
+        return False
+    model.load_state_dict(state_dict, strict=True, assign=True)
+    # buffers outside the state dict are still on the cpu
+    model.to(device)
+    return True
+
+
+def _load_component(model_cls, model_id, subfolder, device, dtype, build_fn=None, prune_fn=None):
+    """
+    Builds one pipeline component without random init and loads its
+    weights. ``prune_fn`` drops submodules that are never run before the
+    weights are loaded. Falls back to ``from_pretrained`` for hub ids and
+    checkpoints whose keys need conversion.
+    """
+    from accelerate import init_empty_weights
+
+    weights_file = _find_weights(model_id, subfolder, dtype) if os.path.isdir(model_id) else None
+    if weights_file is not None:
+        with init_empty_weights():
+            model = build_fn()
+        if prune_fn is not None:
+            prune_fn(model)
+        if _load_weights(model, weights_file, device, dtype):
+            return model
+    model = model_cls.from_pretrained(model_id, subfolder=subfolder, torch_dtype=dtype)
+    if prune_fn is not None:
+        prune_fn(model)
+    return model.to(device)
+
+
+def init_models_lean(
+    device="cuda",
+    model_id="runwayml/stable-diffusion-v1-5",
+    dtype=torch.float16,
+    freeze=True,
+    last_up_block=None,
+    with_clip=True,
+):
+    """
+    Loads only what feature extraction needs: the scheduler, the VAE encoder,
+    the UNet up to ``last_up_block`` (all blocks if None) and the CLIP text
+    encoder if ``with_clip``. The VAE decoder, safety checker and feature
+    extractor of the pipeline are never built.
+    """
+    from diffusers import DiffusionPipeline
+    from transformers import CLIPTextConfig
+    import diffusers
+
+    pipe_config = DiffusionPipeline.load_config(model_id)
+    scheduler_cls = getattr(diffusers, pipe_config["scheduler"][1])
+    scheduler = scheduler_cls.from_pretrained(model_id, subfolder="scheduler")
+
+    def prune_unet(unet):
+        if last_up_block is None:
+            return
+        # features are taken from the up blocks, everything after the last
+        # hooked block is cut off by the feature-only forward
+        unet.up_blocks = unet.up_blocks[:last_up_block + 1]
+        unet.up_blocks[-1].upsamplers = None
+        unet.conv_norm_out = None
+        unet.conv_out = None
+
+    def prune_vae(vae):
+        vae.decoder = None
+        vae.post_quant_conv = None
+
+    unet = _load_component(
+        UNet2DConditionModel, model_id, "unet", device, dtype,
+        build_fn=lambda: UNet2DConditionModel.from_config(
+            UNet2DConditionModel.load_config(model_id, subfolder="unet")),
+        prune_fn=prune_unet)
+    vae = _load_component(
+        AutoencoderKL, model_id, "vae", device, dtype,
+        build_fn=lambda: AutoencoderKL.from_config(
+            AutoencoderKL.load_config(model_id, subfolder="vae")),
+        prune_fn=prune_vae)
+    clip = None
+    if with_clip:
+        clip = _load_component(
+            CLIPTextModel, model_id, "text_encoder", device, dtype,
+            build_fn=lambda: CLIPTextModel(
+                CLIPTextConfig.from_pretrained(model_id, subfolder="text_encoder")))
+    clip_tokenizer = CLIPTokenizer.from_pretrained(model_id, subfolder="tokenizer")
+    if freeze:
+        freeze_weights(unet)
+        freeze_weights(vae)
+        if clip is not None:
+            freeze_weights(clip)
+    return scheduler, unet, vae, clip, clip_tokenizer
+
+
 def init_models(
     device="cuda",
     model_id="runwayml/stable-diffusion-v1-5",
     freeze=True,
     do_with_depth=False,
+    dtype=torch.float16,
 ):
     if 'depth' in model_id:
         do_with_depth = True
+    revision = "fp16" if dtype == torch.float16 else None
     if do_with_depth:
         pipe = StableDiffusionDepth2ImgPipeline.from_pretrained(
             model_id,
-            revision="fp16",
-            torch_dtype=torch.float16,
+            revision=revision,
+            torch_dtype=dtype,
         )
     else:
         pipe = StableDiffusionPipeline.from_pretrained(
             model_id,
-            revision="fp16",
-            torch_dtype=torch.float16,
+            revision=revision,
+            torch_dtype=dtype,
         )
     unet = pipe.unet
     vae = pipe.vae
@@ -358,15 +695,21 @@ def get_stride_num(idxs):
 
 
 def collect_stride_feats_with_timesteplist(unet, idxs_resnet, idxs_ca, timestep_list, do_mask_steps=False,
-                                           x=None, ref_semantic_seg=None, label_map=None, guidance_scale=0.0):
-    if isinstance(x, list):
-        batch_size = x[0].shape[0]
-    else:
-        batch_size = x.shape[0]
+                                           x=None, ref_semantic_seg=None, label_map=None, guidance_scale=0.0,
+                                           registry=None, batch_size=None):
+    if batch_size is None:
+        if isinstance(x, list):
+            batch_size = x[0].shape[0]
+        else:
+            batch_size = x.shape[0]
     latent_h = [0, 0, 0, 0]
     latent_w = [0, 0, 0, 0]
 
-    latent_feats_resnet = collect_feats_resnet(unet, idxs=idxs_resnet)
+    if registry is not None:
+        idxs_resnet, idxs_ca = registry.idxs_resnet, registry.idxs_ca
+        latent_feats_resnet = registry.feats_resnet()
+    else:
+        latent_feats_resnet = collect_feats_resnet(unet, idxs=idxs_resnet)
     latent_feats_resnet_idxs = []
     for idx, feat in zip(idxs_resnet, latent_feats_resnet):
         latents_feats_idxs_t = []
@@ -381,7 +724,10 @@ def collect_stride_feats_with_timesteplist(unet, idxs_resnet, idxs_ca, timestep_
                              for feat_t in latent_feats_resnet_idxs]
     # print('resnet shape', feats_cat_resnet_idxs[0].shape, feats_cat_resnet_idxs[3].shape, feats_cat_resnet_idxs[6].shape, feats_cat_resnet_idxs[9].shape)
 
-    latent_feats_ca = collect_feats_ca(unet, idxs=idxs_ca)
+    if registry is not None:
+        latent_feats_ca = registry.feats_ca()
+    else:
+        latent_feats_ca = collect_feats_ca(unet, idxs=idxs_ca)
     latent_feats_ca_idxs = []
     for idx, feat in zip(idxs_ca, latent_feats_ca):
         latents_feats_idxs_t = []
@@ -8,46 +8,218 @@ import torch
 from einops import rearrange, repeat
 
 
-def init_ca_resnet_func(
-    unet,
-    save_hidden=False,
-    use_hidden=False,
-    reset=True,
-    save_timestep=[],
-    idxs_resnet=[(1, 0)],
-    idxs_ca=[(1, 0)]
-):
-  def new_forward_resnet(self, input_tensor, temb):
-    # https://github.com/huggingface/diffusers/blob/ad9d7ce4763f8fb2a9e620bff017830c26086c36/src/diffusers/models/resnet.py#L372
-    hidden_states = input_tensor
+class StopForward(Exception):
+  """
+  Raised by the deepest hooked layer once every requested feature is saved,
+  so the rest of the UNet (later up blocks, conv_out, DDIM update) is skipped.
+  """
+  pass
+
+
+class HookedLayerRegistry:
+  """
+  Hooked up-block layers of a UNet, collected once.
+
+  Holds the ResnetBlock2D and BasicTransformerBlock instances selected by
+  idxs_resnet / idxs_ca with their stride ids and channel dims. The hooked
+  forwards read their save/stop settings from the registry, so they are
+  installed once and timestep setting, reset and feature collection only
+  touch these layers instead of walking the whole UNet.
+  """
+
+  def __init__(self, unet, idxs_resnet=None, idxs_ca=None):
+    self.idxs_resnet, self.layers_resnet, self.dims_resnet = [], [], []
+    self.idxs_ca, self.layers_ca, self.dims_ca = [], [], []
+    for i, up_block in enumerate(unet.up_blocks):
+      for j, module in enumerate(up_block.resnets):
+        if idxs_resnet is None or (i, j) in idxs_resnet or [i, j] in idxs_resnet:
+          self.idxs_resnet.append((i, j))
+          self.layers_resnet.append(module)
+          self.dims_resnet.append(module.time_emb_proj.out_features)
+      if hasattr(up_block, 'attentions'):
+        for j, module in enumerate(up_block.attentions):
+          if idxs_ca is None or (i, j) in idxs_ca or [i, j] in idxs_ca:
+            self.idxs_ca.append((i, j))
+            self.layers_ca.append(module.transformer_blocks[0])
+            self.dims_ca.append(module.transformer_blocks[0].norm1.normalized_shape[0])
+    self.layers = self.layers_resnet + self.layers_ca
+    self.last_layer = collect_last_layer(unet, idxs_resnet, idxs_ca)
+    self.num_strides = len(unet.up_blocks)
+
+    self.save_hidden = False
+    self.use_hidden = False
+    self.save_timestep = []
+    self.stop_layer = None
+    self.stop_timestep = None
+
+    # With a buffer dtype the hooks write straight into one NCHW buffer per
+    # stride instead of the per-module feats dicts, see prepare_buffers
+    self.buffer_dtype = None
+    self.buffers = None
+
+  def configure(self, save_hidden=False, use_hidden=False, save_timestep=[], feature_only=False):
+    self.save_hidden = save_hidden
+    self.use_hidden = use_hidden
+    self.save_timestep = save_timestep
+    # In feature-only mode the last hooked layer (in execution order) stops the
+    # forward pass at the last timestep we save features for.
+    if feature_only and save_hidden and save_timestep:
+      self.stop_layer = self.last_layer
+      self.stop_timestep = max(save_timestep)
+    else:
+      self.stop_layer = None
+      self.stop_timestep = None
+
+  def set_timestep(self, timestep=None):
+    """
+    A tuple of timesteps marks independent timesteps stacked along the
+    batch (in that order), the hooks then save one slice per timestep.
+    """
+    for module in self.layers:
+      module.timestep = timestep
+
+  def save(self, module, hidden_states):
+    if isinstance(module.timestep, tuple):
+      chunks = hidden_states.chunk(len(module.timestep))
+      for timestep, chunk in zip(module.timestep, chunks):
+        if self.save_timestep is None or timestep in self.save_timestep:
+          self._store(module, timestep, chunk)
+    elif self.save_timestep is None or module.timestep in self.save_timestep:
+      self._store(module, module.timestep, hidden_states)
+
+  def _store(self, module, timestep, hidden_states):
+    if self.buffers is None:
+      module.feats[timestep] = hidden_states
+      return
+    stride, start, end = self.buffer_slices[module][timestep]
+    batch_size = self.buffer_batch_size
+    if stride not in self.buffers:
+      h, w = self.buffer_sizes[stride]
+      self.buffers[stride] = torch.empty(
+        (batch_size, self.buffer_channels[stride], h, w),
+        dtype=self.buffer_dtype, device=hidden_states.device)
+    dst = self.buffers[stride][:, start:end]
+    if hidden_states.dim() == 4:
+      dst.copy_(hidden_states[:batch_size])
+    else:
+      # (prompts * batch, h * w, c) tokens, summed over the prompts
+      h, w = dst.shape[2:]
+      tokens = hidden_states.view(-1, batch_size, h, w, hidden_states.shape[2])
+      tokens = tokens[0] if tokens.shape[0] == 1 else tokens.sum(dim=0)
+      dst.copy_(tokens.permute(0, 3, 1, 2))
+    self.buffer_writes += 1
+
+  def prepare_buffers(self, batch_size, latent_size):
+    """
+    Lays out the stride buffers of the next forward. Stride s holds, in
+    order, every hooked resnet and then every cross-attention layer of up
+    block s, each as its save_timestep slices, which is the channel order
+    of collect_stride_feats_with_timesteplist. The buffers themselves are
+    allocated at the first write and handed over by take_buffers.
+    """
+    self.buffer_batch_size = batch_size
+    self.buffer_slices = {}
+    self.buffer_channels = [0 for _ in range(self.num_strides)]
+    for idxs, layers, dims in ((self.idxs_resnet, self.layers_resnet, self.dims_resnet),
+                               (self.idxs_ca, self.layers_ca, self.dims_ca)):
+      for s in range(self.num_strides):
+        for (i, _), module, dim in zip(idxs, layers, dims):
+          if i != s:
+            continue
+          self.buffer_slices[module] = {}
+          for timestep in self.save_timestep:
+            start = self.buffer_channels[s]
+            self.buffer_slices[module][timestep] = (s, start, start + dim)
+            self.buffer_channels[s] += dim
+    # up block s runs at the latent size halved (num_strides - 1 - s) times
+    h, w = latent_size
+    self.buffer_sizes = [None for _ in range(self.num_strides)]
+    for s in reversed(range(self.num_strides)):
+      self.buffer_sizes[s] = (h, w)
+      h, w = -(-h // 2), -(-w // 2)
+    self.buffer_writes = 0
+    self.buffers = {}
+
+  def take_buffers(self):
+    """
+    Stride buffers of the last forward, None for strides without hooked
+    layers. A new forward allocates new buffers, so the returned ones are
+    never overwritten while autograd still holds them.
+    """
+    expected = sum(len(slices) for slices in self.buffer_slices.values())
+    if self.buffer_writes != expected:
+      raise RuntimeError(
+        f"hooked layers wrote {self.buffer_writes} of {expected} feature slices")
+    buffers = tuple(self.buffers.get(s) for s in range(self.num_strides))
+    self.buffers = None
+    return buffers
+
+  def is_stop(self, module):
+    if module is not self.stop_layer:
+      return False
+    if isinstance(module.timestep, tuple):
+      return self.stop_timestep in module.timestep
+    return module.timestep == self.stop_timestep
+
+  def reset(self):
+    for module in self.layers:
+      module.feats = {}
+      module.timestep = None
 
-    hidden_states = self.norm1(hidden_states)
-    hidden_states = self.nonlinearity(hidden_states)
+  def feats_resnet(self):
+    return [module.feats for module in self.layers_resnet]
 
-    if self.upsample is not None:
-      input_tensor = self.upsample(input_tensor)
-      hidden_states = self.upsample(hidden_states)
-    elif self.downsample is not None:
-      input_tensor = self.downsample(input_tensor)
-      hidden_states = self.downsample(hidden_states)
+  def feats_ca(self):
+    return [module.feats for module in self.layers_ca]
 
-    hidden_states = self.conv1(hidden_states)
+  def dims_by_stride(self):
+    dims = [0 for _ in range(self.num_strides)]
+    for (i, _), dim in zip(self.idxs_resnet + self.idxs_ca, self.dims_resnet + self.dims_ca):
+      dims[i] += dim
+    return dims
 
-    if temb is not None:
-      temb = self.time_emb_proj(self.nonlinearity(temb))[:, :, None, None]
-      hidden_states = hidden_states + temb
+  def dims_by_idx(self):
+    dims = [0 for _ in range(len(self.idxs_resnet))]
+    idx_map = {idx: k for k, idx in enumerate(self.idxs_resnet)}
+    for idx, dim in zip(self.idxs_resnet + self.idxs_ca, self.dims_resnet + self.dims_ca):
+      # as collect_dims_by_idx, CA layers without a hooked resnet at the same
+      # idx are counted in the first slot
+      dims[idx_map.get(idx, 0)] += dim
+    return dims
 
-    hidden_states = self.norm2(hidden_states)
-    hidden_states = self.nonlinearity(hidden_states)
+  def install(self, reset=True):
+    registry = self
 
-    hidden_states = self.dropout(hidden_states)
-    hidden_states = self.conv2(hidden_states)
+    def new_forward_resnet(self, input_tensor, temb):
+      # https://github.com/huggingface/diffusers/blob/ad9d7ce4763f8fb2a9e620bff017830c26086c36/src/diffusers/models/resnet.py#L372
+      hidden_states = input_tensor
 
-    if self.conv_shortcut is not None:
-      input_tensor = self.conv_shortcut(input_tensor)
+      hidden_states = self.norm1(hidden_states)
+      hidden_states = self.nonlinearity(hidden_states)
 
-    if save_hidden:
-      if save_timestep is None or self.timestep in save_timestep:
+      if self.upsample is not None:
+        input_tensor = self.upsample(input_tensor)
+        hidden_states = self.upsample(hidden_states)
+      elif self.downsample is not None:
+        input_tensor = self.downsample(input_tensor)
+        hidden_states = self.downsample(hidden_states)
+
+      hidden_states = self.conv1(hidden_states)
+
+      if temb is not None:
+        temb = self.time_emb_proj(self.nonlinearity(temb))[:, :, None, None]
+        hidden_states = hidden_states + temb
+
+      hidden_states = self.norm2(hidden_states)
+      hidden_states = self.nonlinearity(hidden_states)
+
+      hidden_states = self.dropout(hidden_states)
+      hidden_states = self.conv2(hidden_states)
+
+      if self.conv_shortcut is not None:
+        input_tensor = self.conv_shortcut(input_tensor)
+
+      if registry.save_hidden:
         # if do_optim_steps:
         #   self.mt = self.beta1 * self.mt + (1 - self.beta1) * hidden_states
         #   self.vt = self.beta2 * self.vt + (1 - self.beta2) * hidden_states ** 2
@@ -57,97 +229,108 @@ def init_ca_resnet_func(
         #   # print(self.__class__.__name__, torch.any(torch.isnan(self.mt / ((self.vt ** 0.5) + 1e-8))))
         #   self.steps += 1
         # else: 
-        self.feats[self.timestep] = hidden_states
-    elif use_hidden:
-      hidden_states = self.feats[self.timestep]
-    output_tensor = (input_tensor + hidden_states) / self.output_scale_factor
-    return output_tensor
+        registry.save(self, hidden_states)
+        if registry.is_stop(self):
+          raise StopForward()
+      elif registry.use_hidden:
+        hidden_states = self.feats[self.timestep]
+      output_tensor = (input_tensor + hidden_states) / self.output_scale_factor
+      return output_tensor
   
-  def new_forward_ca(
-    self,
-    hidden_states,
-    attention_mask=None,
-    encoder_hidden_states=None,
-    encoder_attention_mask=None,
-    timestep=None,
-    cross_attention_kwargs=None,
-    class_labels=None,
-  ):
-    # Notice that normalization is always applied before the real computation in the following blocks.
-    # 1. Self-Attention
-    if self.use_ada_layer_norm:
-      norm_hidden_states = self.norm1(hidden_states, timestep)
-    elif self.use_ada_layer_norm_zero:
-      norm_hidden_states, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.norm1(
-        hidden_states, timestep, class_labels, hidden_dtype=hidden_states.dtype
-      )
-    else:
-      norm_hidden_states = self.norm1(hidden_states)
-
-    cross_attention_kwargs = cross_attention_kwargs if cross_attention_kwargs is not None else {}
-    attn_output = self.attn1(
-      norm_hidden_states,
-      encoder_hidden_states=encoder_hidden_states if self.only_cross_attention else None,
-      attention_mask=attention_mask,
-      **cross_attention_kwargs,
-    )
-    if self.use_ada_layer_norm_zero:
-      attn_output = gate_msa.unsqueeze(1) * attn_output
-    hidden_states = attn_output + hidden_states
-
-    # 2. Cross-Attention
-    if self.attn2 is not None:
-      norm_hidden_states = (
-          self.norm2(hidden_states, timestep) if self.use_ada_layer_norm else self.norm2(hidden_states)
-      )
-      # TODO (Birch-San): Here we should prepare the encoder_attention mask correctly
-      # prepare attention mask here
-
-      attn_output = self.attn2(
+    def new_forward_ca(
+      self,
+      hidden_states,
+      attention_mask=None,
+      encoder_hidden_states=None,
+      encoder_attention_mask=None,
+      timestep=None,
+      cross_attention_kwargs=None,
+      class_labels=None,
+    ):
+      # Notice that normalization is always applied before the real computation in the following blocks.
+      # 1. Self-Attention
+      if self.use_ada_layer_norm:
+        norm_hidden_states = self.norm1(hidden_states, timestep)
+      elif self.use_ada_layer_norm_zero:
+        norm_hidden_states, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.norm1(
+          hidden_states, timestep, class_labels, hidden_dtype=hidden_states.dtype
+        )
+      else:
+        norm_hidden_states = self.norm1(hidden_states)
+
+      cross_attention_kwargs = cross_attention_kwargs if cross_attention_kwargs is not None else {}
+      attn_output = self.attn1(
         norm_hidden_states,
-        encoder_hidden_states=encoder_hidden_states,
-        attention_mask=encoder_attention_mask,
+        encoder_hidden_states=encoder_hidden_states if self.only_cross_attention else None,
+        attention_mask=attention_mask,
         **cross_attention_kwargs,
       )
-
+      if self.use_ada_layer_norm_zero:
+        attn_output = gate_msa.unsqueeze(1) * attn_output
       hidden_states = attn_output + hidden_states
+
+      # 2. Cross-Attention
+      if self.attn2 is not None:
+        norm_hidden_states = (
+            self.norm2(hidden_states, timestep) if self.use_ada_layer_norm else self.norm2(hidden_states)
+        )
+        # TODO (Birch-San): Here we should prepare the encoder_attention mask correctly
+        # prepare attention mask here
+
+        attn_output = self.attn2(
+          norm_hidden_states,
+          encoder_hidden_states=encoder_hidden_states,
+          attention_mask=encoder_attention_mask,
+          **cross_attention_kwargs,
+        )
+
+        hidden_states = attn_output + hidden_states
       
 
-    # 3. Feed-forward
-    norm_hidden_states = self.norm3(hidden_states)
+      # 3. Feed-forward
+      norm_hidden_states = self.norm3(hidden_states)
 
-    if self.use_ada_layer_norm_zero:
-      norm_hidden_states = norm_hidden_states * (1 + scale_mlp[:, None]) + shift_mlp[:, None]
+      if self.use_ada_layer_norm_zero:
+        norm_hidden_states = norm_hidden_states * (1 + scale_mlp[:, None]) + shift_mlp[:, None]
 
-    ff_output = self.ff(norm_hidden_states)
+      ff_output = self.ff(norm_hidden_states)
 
-    if self.use_ada_layer_norm_zero:
-      ff_output = gate_mlp.unsqueeze(1) * ff_output
+      if self.use_ada_layer_norm_zero:
+        ff_output = gate_mlp.unsqueeze(1) * ff_output
 
-    hidden_states = ff_output + hidden_states
+      hidden_states = ff_output + hidden_states
 
-    #### ca4
-    if save_hidden:
-        if save_timestep is None or self.timestep in save_timestep:
-          self.feats[self.timestep] = hidden_states
+      #### ca4
+      if registry.save_hidden:
+          registry.save(self, hidden_states)
+          if registry.is_stop(self):
+            raise StopForward()
 
-    return hidden_states
-  
-  layers = collect_layers_resnet(unet, idxs_resnet)
-  for module in layers:
-    module.forward = new_forward_resnet.__get__(module, type(module))
-    if reset:
-      module.feats = {}
-      module.timestep = None
-  
-  layers = collect_layers_ca(unet, idxs_ca)
-  # print('    ca', len(layers))
-  for module in layers:
-    module.forward = new_forward_ca.__get__(module, type(module))
+      return hidden_states
+
+    for module in self.layers_resnet:
+      module.forward = new_forward_resnet.__get__(module, type(module))
+    for module in self.layers_ca:
+      module.forward = new_forward_ca.__get__(module, type(module))
     if reset:
-      module.feats = {}
-      module.timestep = None
-  
+      self.reset()
+
+
+def init_ca_resnet_func(
+    unet,
+    save_hidden=False,
+    use_hidden=False,
+    reset=True,
+    save_timestep=[],
+    idxs_resnet=[(1, 0)],
+    idxs_ca=[(1, 0)],
+    feature_only=False
+):
+  registry = HookedLayerRegistry(unet, idxs_resnet, idxs_ca)
+  registry.configure(save_hidden=save_hidden, use_hidden=use_hidden,
+                     save_timestep=save_timestep, feature_only=feature_only)
+  registry.install(reset=reset)
+  return registry
 
 
 """
@@ -247,6 +430,18 @@ def collect_layers_ca(unet, idxs=None):
           layers.append(module.transformer_blocks[0])
   return layers
 
+def collect_last_layer(unet, idxs_resnet=None, idxs_ca=None):
+  # up blocks run resnets[j] then attentions[j], so keep the last hooked one
+  last_layer = None
+  for i, up_block in enumerate(unet.up_blocks):
+    for j, module in enumerate(up_block.resnets):
+      if idxs_resnet is None or (i, j) in idxs_resnet or [i, j] in idxs_resnet:
+        last_layer = module
+      if hasattr(up_block, 'attentions') and j < len(up_block.attentions):
+        if idxs_ca is None or (i, j) in idxs_ca or [i, j] in idxs_ca:
+          last_layer = up_block.attentions[j].transformer_blocks[0]
+  return last_layer
+
 def collect_layers(unet, idxs=None):
   layers = []
   for i, up_block in enumerate(unet.up_blocks):
@@ -31,14 +31,14 @@ sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__f
 
 from archs.diffusion_extractor import DiffusionExtractor
 from archs.aggregation_network import AggregationNetwork, StrideAggregationNetwork, StrideVanillaNetwork, StrideDirectAggregationNetwork
-from archs.stable_diffusion.resnet import collect_dims_by_idx, collect_dims_by_stride
 
 
-def load_models_stride(config, device='cuda'):
+def load_models_stride(config, device=None):
     diffusion_extractor = DiffusionExtractor(config, device)
+    device = diffusion_extractor.device
     # print(diffusion_extractor.idxs)
-    dims_by_idx = collect_dims_by_idx(diffusion_extractor.unet, idxs_resnet=diffusion_extractor.idxs_resnet, idxs_ca=diffusion_extractor.idxs_ca)
-    dims_by_stride = collect_dims_by_stride(diffusion_extractor.unet, idxs_resnet=diffusion_extractor.idxs_resnet, idxs_ca=diffusion_extractor.idxs_ca)
+    dims_by_idx = diffusion_extractor.hook_registry.dims_by_idx()
+    dims_by_stride = diffusion_extractor.hook_registry.dims_by_stride()
     if config['aggregation_type'] == 'vanilla':
         aggregation_network = StrideVanillaNetwork(
             feature_dims=dims_by_idx,
@@ -76,7 +76,8 @@ class DIFFEncoder(nn.Module):
         super().__init__()
         self.mode = mode
 
-        self.config, self.diffusion_extractor, self.aggregation_network = load_models_stride(config)
+        self.config, self.diffusion_extractor, self.aggregation_network = load_models_stride(
+            config, device=config.get('device'))
 
         if config['fine_type'] == 'upsample':
             self.finecoder = DiftStrideUpsampleFinecoder()
@@ -104,8 +105,21 @@ class DIFFEncoder(nn.Module):
         elif mode == "half":
             self.aggregation_network.to(dtype=torch.float16)
             self.finecoder.to(dtype=torch.float16)
+        # stride buffers are written in the aggregation dtype
+        registry = self.diffusion_extractor.hook_registry
+        if registry.buffer_dtype is not None:
+            registry.buffer_dtype = torch.float if mode == "float" else torch.float16
 
-    def forward(self, img_tensor, ref_masks=None, ref_labels=None):
+    @property
+    def dtype(self):
+        """Input dtype of the frozen diffusion models."""
+        return self.diffusion_extractor.dtype
+
+    @property
+    def with_feature_store(self):
+        return self.diffusion_extractor.feature_store is not None
+
+    def forward(self, img_tensor, ref_masks=None, ref_labels=None, store_keys=None):
         b = img_tensor.shape[0]
         h = img_tensor.shape[2]
         w = img_tensor.shape[3]
@@ -114,8 +128,35 @@ class DIFFEncoder(nn.Module):
             self.change_batchsize(b)
 
         with torch.no_grad():
-            feats = self.diffusion_extractor.forward(img_tensor, stride_mode=True, ref_masks=ref_masks, ref_labels=ref_labels)
-    
+            feats = self.diffusion_extractor.forward(img_tensor, stride_mode=True, ref_masks=ref_masks, ref_labels=ref_labels,
+                                                     store_keys=store_keys)
+
+        return self.aggregate(feats, b, h, w)
+
+    def forward_dual(self, img_tensor, ref_masks, ref_labels):
+        """
+        Features of the no-ref and the ref (masked image + class prompt)
+        branches from one VAE encode and one UNet call on the 2N batch.
+        """
+        b = img_tensor.shape[0]
+        h = img_tensor.shape[2]
+        w = img_tensor.shape[3]
+
+        if b != self.batch_size:
+            self.change_batchsize(b)
+
+        with torch.no_grad():
+            feats = self.diffusion_extractor.forward(img_tensor, stride_mode=True, ref_masks=ref_masks, ref_labels=ref_labels,
+                                                     fuse_branches=True)
+
+        # aggregation network and finecoder only use GroupNorm, so running
+        # both branches as one batch is the same as running them one by one
+        feature_fine = self.aggregate(feats, 2 * b, h, w)
+        feature_fine_wo_ref = tuple(feat[:b] for feat in feature_fine)
+        feature_fine_w_ref = tuple(feat[b:] for feat in feature_fine)
+        return feature_fine_wo_ref, feature_fine_w_ref
+
+    def aggregate(self, feats, b, h, w):
         if self.mode == "float":
             stride_hf = self.aggregation_network([feats[0].view((b, -1, h//64, w//64)).to(dtype=torch.float), 
                                                             feats[1].view((b, -1, h//32, w//32)).to(dtype=torch.float), 
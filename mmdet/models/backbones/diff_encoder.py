@@ -41,11 +41,36 @@ class DIFF(BaseModule):
         self.diff_config = diff_config
         self.diff_model = DIFFEncoder(config=self.diff_config)
 
-    def forward(self, x, ref_masks=None, ref_labels=None):
+    @property
+    def with_feature_store(self):
+        return self.diff_model.with_feature_store
+
+    def forward(self, x, ref_masks=None, ref_labels=None, store_keys=None):
         x = self.imagenet_to_stable_diffusion(x)
-        x = self.diff_model(x.to(dtype=torch.float16), ref_masks, ref_labels)
+        x = self.diff_model(x.to(dtype=self.diff_model.dtype), ref_masks, ref_labels,
+                            store_keys=store_keys)
         return x
 
+    def feature_store_keys(self, batch_data_samples):
+        """Feature store key of each image: its path and input geometry, in
+        the namespace of its ``pipeline_hash`` metainfo if it has one (set
+        by ``MultiTargetTestLoop``)."""
+        store = self.diff_model.diffusion_extractor.feature_store
+        keys = []
+        for data_sample in batch_data_samples:
+            shape = (*data_sample.batch_input_shape, *data_sample.img_shape,
+                     data_sample.get('flip', False),
+                     data_sample.get('flip_direction', None))
+            keys.append(
+                store.key(data_sample.img_path, shape,
+                          data_sample.get('pipeline_hash', None)))
+        return keys
+
+    def forward_dual(self, x, ref_masks, ref_labels):
+        """Fused no-ref / ref extraction, see ``DIFFEncoder.forward_dual``."""
+        x = self.imagenet_to_stable_diffusion(x)
+        return self.diff_model.forward_dual(x.to(dtype=self.diff_model.dtype), ref_masks, ref_labels)
+
     def init_weights(self):
         pass
 
@@ -6,7 +6,9 @@ import torch
 import torch.nn as nn
 from torch import Tensor
 
-from mmdet.models.utils import (filter_gt_instances, rename_loss_dict, reweight_loss_dict)
+from mmdet.models.utils import (PseudoLabelBank, TeacherProducer,
+                                filter_gt_instances, rename_loss_dict,
+                                reweight_loss_dict)
 from mmdet.registry import MODELS
 from mmdet.structures import SampleList
 from mmdet.structures.bbox import bbox_project
@@ -53,18 +55,26 @@ class SemiBaseDiffDetector(BaseDetector):
         self.student = MODELS.build(detector.deepcopy())
         self.teacher = MODELS.build(detector.deepcopy())
         self.diff_detector = None
+        self.diff_model_cfg = diff_model
         if diff_model.config:
             teacher_config = Config.fromfile(diff_model.config)
             self.diff_detector = MODELS.build(teacher_config['model'])
             if diff_model.pretrained_model:
                 load_checkpoint(self.diff_detector, diff_model.pretrained_model, map_location='cpu', strict=True)
-                self.diff_detector.cuda()
+                if torch.cuda.is_available():
+                    self.diff_detector.cuda()
                 self.freeze(self.diff_detector)
         if self.diff_detector is None:
             self.diff_detector = self.student
 
         self.semi_train_cfg = semi_train_cfg
         self.semi_test_cfg = semi_test_cfg
+        # offline detections (and features) of the diffusion detector, built
+        # by tools/misc/build_pseudo_label_bank.py
+        self.pseudo_label_bank = None
+        bank_root = self.semi_train_cfg.get('pseudo_label_bank', None)
+        if bank_root:
+            self.pseudo_label_bank = PseudoLabelBank(bank_root)
         if self.semi_train_cfg.get('freeze_teacher', True) is True:
             self.freeze(self.teacher)
 
@@ -134,7 +144,9 @@ class SemiBaseDiffDetector(BaseDetector):
         return losses
     
     def loss_diff_adaptation(self, multi_batch_inputs: Dict[str, Tensor],
-                             multi_batch_data_samples: Dict[str, SampleList]) -> dict:
+                             multi_batch_data_samples: Dict[str, SampleList],
+                             teacher_outputs: Optional[tuple] = None,
+                             student_feats: Optional[dict] = None) -> dict:
         """Calculate losses from multi-branch inputs and data samples.
 
         Args:
@@ -143,24 +155,73 @@ class SemiBaseDiffDetector(BaseDetector):
                 Each value should usually be mean centered and std scaled.
             multi_batch_data_samples (Dict[str, List[:obj:`DetDataSample`]]):
                 The dict of multi-branch data samples.
+            teacher_outputs (tuple, optional): Predicted instances and
+                features of the diffusion detector on the ``unsup_teacher``
+                branch, produced ahead by a :class:`TeacherProducer`.
+                Defaults to None.
+            student_feats (dict, optional): Student features of the ``sup``
+                and ``unsup_student`` branches, see
+                ``extract_student_feats``. Without them, they are extracted
+                here, in one forward if ``semi_train_cfg.fused_student_forward``
+                is set. Defaults to None.
 
         Returns:
             dict: A dictionary of loss components
         """
+        if student_feats is None and self.semi_train_cfg.get(
+                'fused_student_forward', False):
+            student_feats = self.extract_student_feats(
+                multi_batch_inputs, ('sup', 'unsup_student'))
+        student_feats = student_feats or dict()
         losses = dict()
         losses.update(**self.loss_by_gt_instances(
-            multi_batch_inputs['sup'], multi_batch_data_samples['sup']))
+            multi_batch_inputs['sup'], multi_batch_data_samples['sup'],
+            feats=student_feats.get('sup')))
         origin_pseudo_data_samples, batch_info, diff_feature = self.get_pseudo_instances_diff(
-            multi_batch_inputs['unsup_teacher'], multi_batch_data_samples['unsup_teacher'])
+            multi_batch_inputs['unsup_teacher'], multi_batch_data_samples['unsup_teacher'],
+            teacher_outputs=teacher_outputs)
         multi_batch_data_samples['unsup_student'] = self.project_pseudo_instances(
             origin_pseudo_data_samples, multi_batch_data_samples['unsup_student'])
 
         losses.update(**self.loss_by_pseudo_instances(multi_batch_inputs['unsup_student'],
-                                                      multi_batch_data_samples['unsup_student'], batch_info))
+                                                      multi_batch_data_samples['unsup_student'], batch_info,
+                                                      feats=student_feats.get('unsup_student')))
         return losses, diff_feature
 
-    def loss_by_gt_instances(self, batch_inputs: Tensor,
-                             batch_data_samples: SampleList) -> dict:
+    def extract_student_feats(self, multi_batch_inputs: Dict[str, Tensor],
+                              branches: Tuple[str]) -> Dict[str, tuple]:
+        """Student features of several branches from one forward.
+
+        The inputs of branches with the same shape are concatenated into one
+        batch for the backbone and neck, and the features are split back per
+        branch. The norm layers of the student should not use batch
+        statistics (e.g. ``norm_eval=True``), they would see the joint batch.
+
+        Args:
+            multi_batch_inputs (Dict[str, Tensor]): The dict of multi-branch
+                input images.
+            branches (tuple[str]): The branches to extract.
+
+        Returns:
+            Dict[str, tuple]: Multi-level student features of each branch.
+        """
+        groups = dict()
+        for branch in branches:
+            shape = tuple(multi_batch_inputs[branch].shape[1:])
+            groups.setdefault(shape, []).append(branch)
+        student_feats = dict()
+        for group in groups.values():
+            inputs = [multi_batch_inputs[branch] for branch in group]
+            x = self.student.extract_feat(torch.cat(inputs))
+            splits = [feat.split([len(i) for i in inputs]) for feat in x]
+            for i, branch in enumerate(group):
+                student_feats[branch] = tuple(split[i] for split in splits)
+        return student_feats
+
+    def loss_by_gt_instances(self,
+                             batch_inputs: Tensor,
+                             batch_data_samples: SampleList,
+                             feats: Optional[tuple] = None) -> dict:
         """Calculate losses from a batch of inputs and ground-truth data
         samples.
 
@@ -170,19 +231,26 @@ class SemiBaseDiffDetector(BaseDetector):
             batch_data_samples (List[:obj:`DetDataSample`]): The batch
                 data samples. It usually includes information such
                 as `gt_instance` or `gt_panoptic_seg` or `gt_sem_seg`.
+            feats (tuple, optional): Student features of ``batch_inputs``.
+                Defaults to None.
 
         Returns:
             dict: A dictionary of loss components
         """
 
-        losses = self.student.loss(batch_inputs, batch_data_samples)
+        if feats is None:
+            losses = self.student.loss(batch_inputs, batch_data_samples)
+        else:
+            losses = self.student.loss(
+                batch_inputs, batch_data_samples, feats=feats)
         sup_weight = self.semi_train_cfg.get('sup_weight', 1.)
         return rename_loss_dict('sup_', reweight_loss_dict(losses, sup_weight))
 
     def loss_by_pseudo_instances(self,
                                  batch_inputs: Tensor,
                                  batch_data_samples: SampleList,
-                                 batch_info: Optional[dict] = None) -> dict:
+                                 batch_info: Optional[dict] = None,
+                                 feats: Optional[tuple] = None) -> dict:
         """Calculate losses from a batch of inputs and pseudo data samples.
 
         Args:
@@ -195,13 +263,19 @@ class SemiBaseDiffDetector(BaseDetector):
                 or `pseudo_sem_seg` in fact.
             batch_info (dict): Batch information of teacher model
                 forward propagation process. Defaults to None.
+            feats (tuple, optional): Student features of ``batch_inputs``.
+                Defaults to None.
 
         Returns:
             dict: A dictionary of loss components
         """
         batch_data_samples = filter_gt_instances(
             batch_data_samples, score_thr=self.semi_train_cfg.cls_pseudo_thr)
-        losses = self.student.loss(batch_inputs, batch_data_samples)
+        if feats is None:
+            losses = self.student.loss(batch_inputs, batch_data_samples)
+        else:
+            losses = self.student.loss(
+                batch_inputs, batch_data_samples, feats=feats)
         pseudo_instances_num = sum([
             len(data_samples.gt_instances)
             for data_samples in batch_data_samples
@@ -230,21 +304,70 @@ class SemiBaseDiffDetector(BaseDetector):
     
     @torch.no_grad()
     def get_pseudo_instances_diff(
-            self, batch_inputs: Tensor, batch_data_samples: SampleList
+            self, batch_inputs: Tensor, batch_data_samples: SampleList,
+            teacher_outputs: Optional[tuple] = None
     ) -> Tuple[SampleList, Optional[dict]]:
-        """Get pseudo instances from teacher model."""
-        self.diff_detector.eval()
-        results_list, diff_feature = self.diff_detector.predict(
-            batch_inputs, batch_data_samples, rescale=False, return_feature=True)
+        """Get pseudo instances from teacher model, or from the outputs
+        produced ahead by a :class:`TeacherProducer`."""
+        if self.pseudo_label_bank is not None:
+            return self.get_pseudo_instances_bank(batch_inputs, batch_data_samples)
+        if teacher_outputs is not None:
+            pred_instances_list, diff_feature = teacher_outputs
+        else:
+            self.diff_detector.eval()
+            results_list, diff_feature = self.diff_detector.predict(
+                batch_inputs, batch_data_samples, rescale=False, return_feature=True)
+            pred_instances_list = [results.pred_instances for results in results_list]
         batch_info = {}
-        for data_samples, results in zip(batch_data_samples, results_list):
-            data_samples.gt_instances = results.pred_instances
+        for data_samples, pred_instances in zip(batch_data_samples, pred_instances_list):
+            data_samples.gt_instances = pred_instances
             data_samples.gt_instances.bboxes = bbox_project(
                 data_samples.gt_instances.bboxes,
                 torch.from_numpy(data_samples.homography_matrix).inverse().to(
                     self.data_preprocessor.device), data_samples.ori_shape)
         return batch_data_samples, batch_info, diff_feature
 
+    @torch.no_grad()
+    def get_pseudo_instances_bank(
+            self, batch_inputs: Tensor, batch_data_samples: SampleList
+    ) -> Tuple[SampleList, Optional[dict]]:
+        """Get pseudo instances from the pseudo-label bank.
+
+        The bank holds the detections of the diffusion detector on the full
+        images in original image coordinates, the coordinates the teacher
+        predictions are projected to in ``get_pseudo_instances_diff``. The
+        features come from the bank if it stores them, otherwise from the
+        diffusion detector backbone and neck.
+        """
+        bank = self.pseudo_label_bank
+        device = self.data_preprocessor.device
+        for data_samples in batch_data_samples:
+            data_samples.gt_instances = bank.get_instances(
+                data_samples.img_path, device)
+        if bank.with_features:
+            diff_feature = bank.get_features(batch_data_samples, device)
+        else:
+            self.diff_detector.eval()
+            diff_feature = self.diff_detector.extract_feat(batch_inputs)
+        return batch_data_samples, {}, diff_feature
+
+    def build_teacher_producer(self, **kwargs) -> Optional[TeacherProducer]:
+        """Build a :class:`TeacherProducer` running the frozen diffusion
+        detector ahead of the student.
+
+        Returns None without a separate diffusion detector, the student
+        changes every step and can not run ahead, and with a pseudo-label
+        bank.
+        """
+        if self.diff_detector is self.student or \
+                self.pseudo_label_bank is not None:
+            return None
+        return TeacherProducer(
+            self.diff_detector,
+            teacher_config=self.diff_model_cfg.config,
+            teacher_checkpoint=self.diff_model_cfg.get('pretrained_model'),
+            **kwargs)
+
     def project_pseudo_instances(self, batch_pseudo_instances: SampleList,
                                  batch_data_samples: SampleList) -> SampleList:
         """Project pseudo instances."""
@@ -1,14 +1,17 @@
 # Copyright (c) OpenMMLab. All rights reserved.
-import copy
 import warnings
 from typing import List, Tuple, Union
 
 import torch
+import torch.nn.functional as F
 from torch import Tensor
 
-from mmdet.models.utils import (rename_loss_dict,
-                                reweight_loss_dict)
-from mmdet.structures.bbox import bbox2roi
+from mmdet.models.utils import (class_agnostic_data_samples,
+                                rename_loss_dict, reweight_loss_dict)
+from mmdet.structures import DetDataSample
+from mmdet.structures.bbox import bbox2roi, scale_boxes
+from mmdet.utils.large_image import (merge_results_by_nms,
+                                     sliding_window_offsets)
 from ..utils import unpack_gt_instances
 
 
@@ -18,25 +21,57 @@ from mmdet.utils import ConfigType, OptConfigType, OptMultiConfig
 from .base import BaseDetector
 from ..losses import KDLoss
 
-def bbox_to_mask(batch_data_samples, N, H, W, class_names):
-    batch_masks = torch.full((N, H, W), 0, dtype=torch.long)
+def bbox_to_mask(batch_data_samples, N, H, W, class_names, device=None):
+    """Box masks and class prompts of the auxiliary (ref) branch.
+
+    All gt boxes of the batch are rasterised at once on ``device``: a pixel
+    of image ``i`` is in the mask if it lies in one of its boxes, with the
+    box corners truncated to integers. The latent size masks of the
+    diffusion extractor are strided views of these (see ``resize_mask``),
+    the nearest downsampling, so they are not rasterised separately. The
+    masked image is not built here either: the extractor multiplies these
+    masks into the images after casting them to the VAE dtype and layout,
+    and encodes them together with the unmasked images.
+
+    Returns:
+        tuple: Bool masks with shape (N, H, W) and one
+        prompt per image, built from the sorted class names of its boxes so
+        that a label set always maps to the same prompt.
+    """
+    gt_instances = [data_sample.gt_instances for data_sample in batch_data_samples[:N]]
+    if device is None:
+        device = gt_instances[0].bboxes.device
+    num_boxes = [len(instances) for instances in gt_instances]
+    max_boxes = max(num_boxes, default=0)
+
+    # boxes padded per image, padding boxes are empty
+    bboxes = torch.zeros((N, max_boxes, 4), device=device)
+    labels = []
+    for i, instances in enumerate(gt_instances):
+        bboxes[i, :num_boxes[i]] = instances.bboxes.to(device=device, dtype=bboxes.dtype)
+        labels.append(instances.labels.to(device) + i * len(class_names))
+    bboxes = bboxes.trunc()
+
+    # separable rasterisation: rows(N, h, B) @ cols(N, B, w) counts boxes
+    ys = torch.arange(H, device=device, dtype=bboxes.dtype)
+    xs = torch.arange(W, device=device, dtype=bboxes.dtype)
+    rows = (ys[None, :, None] >= bboxes[:, None, :, 1]) & (ys[None, :, None] < bboxes[:, None, :, 3])
+    cols = (xs[None, None, :] >= bboxes[:, :, 0, None]) & (xs[None, None, :] < bboxes[:, :, 2, None])
+    batch_masks = torch.bmm(rows.to(bboxes.dtype), cols.to(bboxes.dtype)) > 0
+
+    # one device sync for the label sets of the whole batch
+    image_labels = [[] for _ in range(N)]
+    if labels:
+        for label in torch.unique(torch.cat(labels)).tolist():
+            image_labels[label // len(class_names)].append(class_names[label % len(class_names)])
     batch_labels = []
-    for i in range(N):
-        gt_instance = batch_data_samples[i].gt_instances
-        bboxes = gt_instance["bboxes"]
-        labels = gt_instance["labels"]
-        sample_labels = set([class_names[label.item()] for label in labels])
+    for sample_labels in image_labels:
+        sample_labels = sorted(set(sample_labels))
         if sample_labels:
             label_string = "A photo of " + ", ".join(sample_labels)
         else:
             label_string = ""
         batch_labels.append(label_string)
-        bbox_areas = [(bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) for bbox in bboxes]
-        sorted_indices = sorted(range(len(bboxes)), key=lambda idx: bbox_areas[idx], reverse=True)
-        for idx in sorted_indices:
-            bbox = bboxes[idx]
-            x1, y1, x2, y2 = bbox.int()
-            batch_masks[i, y1:y2, x1:x2] = 1
 
     return batch_masks, batch_labels
 
@@ -97,11 +132,18 @@ class DiffusionDetector(BaseDetector):
         self.loss_cls_kd = MODELS.build(self.auxiliary_branch_cfg['loss_cls_kd'])
         self.loss_reg_kd = MODELS.build(self.auxiliary_branch_cfg['loss_reg_kd'])
         self.apply_auxiliary_branch = self.auxiliary_branch_cfg['apply_auxiliary_branch']
+        # extract the ref and no-ref branches with one VAE encode and one UNet
+        # call instead of two full backbone passes
+        self.fuse_branches = self.auxiliary_branch_cfg.get('fuse_branches', True)
         
         self.loss_feature = KDLoss(loss_weight=1.0, loss_type='mse')
         
         self.class_maps = backbone['diff_config']['classes']
 
+        # optional tiled inference, see ``predict_tiled``
+        self.tile_cfg = test_cfg.get('tile', None) \
+            if test_cfg is not None else None
+
     def _load_from_state_dict(self, state_dict: dict, prefix: str,
                               local_metadata: dict, strict: bool,
                               missing_keys: Union[List[str], str],
@@ -136,11 +178,14 @@ class DiffusionDetector(BaseDetector):
         """bool: whether the detector has a RoI head"""
         return hasattr(self, 'roi_head') and self.roi_head is not None
 
-    def extract_feat(self, batch_inputs: Tensor, ref_masks=None, ref_labels=None) -> Tuple[Tensor]:
+    def extract_feat(self, batch_inputs: Tensor, ref_masks=None, ref_labels=None,
+                     store_keys=None) -> Tuple[Tensor]:
         """Extract features.
 
         Args:
             batch_inputs (Tensor): Image tensor with shape (N, C, H ,W).
+            store_keys (list[str], optional): Per-image keys of the backbone
+                feature store. Defaults to None.
 
         Returns:
             tuple[Tensor]: Multi-level features that may have
@@ -148,12 +193,35 @@ class DiffusionDetector(BaseDetector):
         """
         if ref_masks != None and ref_labels != None:
             x = self.backbone(batch_inputs, ref_masks, ref_labels)
+        elif store_keys is not None:
+            x = self.backbone(batch_inputs, store_keys=store_keys)
         else:
             x = self.backbone(batch_inputs)
         if self.with_neck:
             x = self.neck(x)
         return x
 
+    def extract_feat_dual(self, batch_inputs: Tensor, ref_masks,
+                          ref_labels) -> Tuple[Tuple[Tensor], Tuple[Tensor]]:
+        """Extract features of the no-ref and the ref branch in one backbone
+        pass.
+
+        Args:
+            batch_inputs (Tensor): Image tensor with shape (N, C, H ,W).
+            ref_masks (Tensor): Object masks with shape (N, H, W).
+            ref_labels (list[str]): Class prompt of each image.
+
+        Returns:
+            tuple[tuple[Tensor], tuple[Tensor]]: Multi-level features of the
+            no-ref and the ref branch.
+        """
+        x_wo_ref, x_w_ref = self.backbone.forward_dual(
+            batch_inputs, ref_masks, ref_labels)
+        if self.with_neck:
+            x_wo_ref = self.neck(x_wo_ref)
+            x_w_ref = self.neck(x_w_ref)
+        return x_wo_ref, x_w_ref
+
     def _forward(self, batch_inputs: Tensor,
                  batch_data_samples: SampleList) -> tuple:
         """Network forward process. Usually includes backbone, neck and head
@@ -205,9 +273,14 @@ class DiffusionDetector(BaseDetector):
         ###########################################################################
         if self.apply_auxiliary_branch:
             N, _, H, W = batch_inputs.shape
-            ref_masks, ref_labels = bbox_to_mask(batch_data_samples, N, H, W, self.class_maps)
-            x_w_ref = self.extract_feat(batch_inputs, ref_masks, ref_labels)
-            x_wo_ref = self.extract_feat(batch_inputs)
+            ref_masks, ref_labels = bbox_to_mask(
+                batch_data_samples, N, H, W, self.class_maps, device=batch_inputs.device)
+            if self.fuse_branches:
+                x_wo_ref, x_w_ref = self.extract_feat_dual(
+                    batch_inputs, ref_masks, ref_labels)
+            else:
+                x_w_ref = self.extract_feat(batch_inputs, ref_masks, ref_labels)
+                x_wo_ref = self.extract_feat(batch_inputs)
         ###########################################################################
         else:
             x_wo_ref = self.extract_feat(batch_inputs)
@@ -221,11 +294,8 @@ class DiffusionDetector(BaseDetector):
         if self.with_rpn:
             proposal_cfg = self.train_cfg.get('rpn_proposal',
                                               self.test_cfg.rpn)
-            rpn_data_samples = copy.deepcopy(batch_data_samples)
             # set cat_id of gt_labels to 0 in RPN
-            for data_sample in rpn_data_samples:
-                data_sample.gt_instances.labels = \
-                    torch.zeros_like(data_sample.gt_instances.labels)
+            rpn_data_samples = class_agnostic_data_samples(batch_data_samples)
 
             rpn_losses, rpn_results_list_noref = self.rpn_head.loss_and_predict(
                 x_wo_ref, rpn_data_samples, proposal_cfg=proposal_cfg)
@@ -254,11 +324,8 @@ class DiffusionDetector(BaseDetector):
         if self.with_rpn:
             proposal_cfg = self.train_cfg.get('rpn_proposal',
                                               self.test_cfg.rpn)
-            rpn_data_samples = copy.deepcopy(batch_data_samples)
             # set cat_id of gt_labels to 0 in RPN
-            for data_sample in rpn_data_samples:
-                data_sample.gt_instances.labels = \
-                    torch.zeros_like(data_sample.gt_instances.labels)
+            rpn_data_samples = class_agnostic_data_samples(batch_data_samples)
 
             rpn_losses, rpn_results_list_ref = self.rpn_head.loss_and_predict(
                 x_w_ref, rpn_data_samples, proposal_cfg=proposal_cfg)
@@ -276,8 +343,10 @@ class DiffusionDetector(BaseDetector):
                 data_sample.proposals for data_sample in batch_data_samples
             ]
 
-        roi_losses = self.roi_head.loss(x_w_ref, rpn_results_list_ref,
-                                        batch_data_samples)
+        # the kd branch distills on the same sampled rois, keep them
+        roi_losses, sampling_results_ref, ref_bbox_results = \
+            self.roi_head.loss(x_w_ref, rpn_results_list_ref,
+                               batch_data_samples, return_results=True)
         losses.update(rename_loss_dict('ref_', roi_losses))
         ##########################################################################
 
@@ -286,7 +355,9 @@ class DiffusionDetector(BaseDetector):
         if self.apply_auxiliary_branch:
             # Apply cross-kd in ROI head
             roi_losses_kd = self.roi_head_loss_with_kd(
-                x_wo_ref, x_w_ref, rpn_results_list_ref, batch_data_samples)
+                x_wo_ref, x_w_ref, rpn_results_list_ref, batch_data_samples,
+                sampling_results_ref=sampling_results_ref,
+                ref_bbox_results=ref_bbox_results)
             losses.update(roi_losses_kd)
         ##############################################################################################################
         
@@ -307,45 +378,62 @@ class DiffusionDetector(BaseDetector):
             return losses, x_wo_ref
 
     def roi_head_loss_with_kd(self,
-                              x_wo_ref, x_w_ref, rpn_results_list_ref, batch_data_samples):
+                              x_wo_ref, x_w_ref, rpn_results_list_ref, batch_data_samples,
+                              sampling_results_ref=None, ref_bbox_results=None):
+        """KD from the ref branch to the reused branch on the ref rois.
+
+        ``sampling_results_ref`` and ``ref_bbox_results`` are the ones of
+        ``roi_head.loss`` on ``x_w_ref``; when given, the rois are not
+        assigned and sampled again and the ref bbox head is not run again.
+        """
         assert len(rpn_results_list_ref) == len(batch_data_samples)
-         
-        outputs = unpack_gt_instances(batch_data_samples)
-        batch_gt_instances, batch_gt_instances_ignore, _ = outputs
         roi_head = self.roi_head
 
         # assign gts and sample proposals
-        num_imgs = len(batch_data_samples)
-        sampling_results_ref = []
-        for i in range(num_imgs):
-            # rename rpn_results.bboxes to rpn_results.priors
-            rpn_results = rpn_results_list_ref[i]
-            # rpn_results.priors = rpn_results.pop('bboxes')
-
-            assign_result = roi_head.bbox_assigner.assign(
-                rpn_results, batch_gt_instances[i],
-                batch_gt_instances_ignore[i])
-            sampling_result = roi_head.bbox_sampler.sample(
-                assign_result,
-                rpn_results,
-                batch_gt_instances[i],
-                feats=[lvl_feat[i][None] for lvl_feat in x_w_ref])
-            sampling_results_ref.append(sampling_result)
+        if sampling_results_ref is None:
+            outputs = unpack_gt_instances(batch_data_samples)
+            batch_gt_instances, batch_gt_instances_ignore, _ = outputs
+            num_imgs = len(batch_data_samples)
+            sampling_results_ref = []
+            ref_bbox_results = None
+            for i in range(num_imgs):
+                # rename rpn_results.bboxes to rpn_results.priors
+                rpn_results = rpn_results_list_ref[i]
+                # rpn_results.priors = rpn_results.pop('bboxes')
+
+                assign_result = roi_head.bbox_assigner.assign(
+                    rpn_results, batch_gt_instances[i],
+                    batch_gt_instances_ignore[i])
+                sampling_result = roi_head.bbox_sampler.sample(
+                    assign_result,
+                    rpn_results,
+                    batch_gt_instances[i],
+                    feats=[lvl_feat[i][None] for lvl_feat in x_w_ref])
+                sampling_results_ref.append(sampling_result)
                       
         losses = dict()
         # bbox head loss
         if roi_head.with_bbox:
             bbox_results = self.bbox_loss_with_kd(
-                x_wo_ref, x_w_ref, sampling_results_ref)
+                x_wo_ref, x_w_ref, sampling_results_ref, ref_bbox_results)
             losses.update(bbox_results['loss_bbox_kd'])
 
         return losses
 
-    def bbox_loss_with_kd(self, x_wo_ref, x_w_ref, sampling_results_ref):
+    def bbox_loss_with_kd(self, x_wo_ref, x_w_ref, sampling_results_ref,
+                          ref_bbox_results=None):
         rois_ref = bbox2roi([res.priors for res in sampling_results_ref])
 
         roi_head = self.roi_head
-        ref_bbox_results = roi_head._bbox_forward(x_w_ref, rois_ref)
+        if ref_bbox_results is None:
+            ref_bbox_results = roi_head._bbox_forward(x_w_ref, rois_ref)
+        else:
+            # reuse the outputs of roi_head.loss, minus its loss dict
+            ref_bbox_results = {
+                key: value
+                for key, value in ref_bbox_results.items()
+                if key != 'loss_bbox'
+            }
         reused_bbox_results = roi_head._bbox_forward(x_wo_ref, rois_ref)
 
         losses_kd = dict()
@@ -423,7 +511,13 @@ class DiffusionDetector(BaseDetector):
         """
 
         assert self.with_bbox, 'Bbox head must be implemented.'
-        x = self.extract_feat(batch_inputs)
+        if self.tile_cfg is not None and not return_feature:
+            return self.predict_tiled(batch_inputs, batch_data_samples,
+                                      rescale=rescale)
+        store_keys = None
+        if getattr(self.backbone, 'with_feature_store', False):
+            store_keys = self.backbone.feature_store_keys(batch_data_samples)
+        x = self.extract_feat(batch_inputs, store_keys=store_keys)
         # If there are no pre-defined proposals, use RPN to get proposals
         if batch_data_samples[0].get('proposals', None) is None:
             rpn_results_list = self.rpn_head.predict(
@@ -442,3 +536,96 @@ class DiffusionDetector(BaseDetector):
             return batch_data_samples
         else:
             return batch_data_samples, x
+
+    def predict_tiled(self,
+                      batch_inputs: Tensor,
+                      batch_data_samples: SampleList,
+                      rescale: bool = True) -> SampleList:
+        """Predict on overlapping tiles of each image and merge the tile
+        detections by NMS.
+
+        Enabled by ``test_cfg.tile``, e.g.::
+
+            tile=dict(
+                size=(512, 512),
+                stride=(384, 384),
+                batch_size=8,
+                nms=dict(type='nms', iou_threshold=0.6),
+                max_per_img=100)
+
+        The backbone only sees ``size`` inputs, ``batch_size`` tiles at a
+        time, so its peak memory no longer grows with the image area. Tiles
+        of all images in the batch are run together. ``size`` should be a
+        multiple of the backbone stride (64).
+
+        Args:
+            batch_inputs (Tensor): Inputs with shape (N, C, H, W).
+            batch_data_samples (List[:obj:`DetDataSample`]): The Data
+                Samples of the images.
+            rescale (bool): Whether to rescale the results.
+                Defaults to True.
+
+        Returns:
+            list[:obj:`DetDataSample`]: Detection results of the input
+            images.
+        """
+        tile_h, tile_w = self.tile_cfg['size']
+        stride = self.tile_cfg.get('stride', (tile_h, tile_w))
+        tile_batch_size = self.tile_cfg.get('batch_size', 4)
+        nms_cfg = self.tile_cfg.get('nms',
+                                    dict(type='nms', iou_threshold=0.5))
+        max_per_img = self.tile_cfg.get('max_per_img',
+                                        self.test_cfg.rcnn.max_per_img)
+
+        tile_inputs, tile_data_samples = [], []
+        tile_owners, tile_offsets = [], []
+        for i, data_sample in enumerate(batch_data_samples):
+            img_h, img_w = data_sample.img_shape
+            for x, y in sliding_window_offsets((img_h, img_w),
+                                               (tile_h, tile_w), stride):
+                tile = batch_inputs[i, :, y:y + tile_h, x:x + tile_w]
+                # images smaller than a tile are padded like the batch
+                tile = F.pad(tile, (0, tile_w - tile.shape[2], 0,
+                                    tile_h - tile.shape[1]))
+                tile_shape = (min(tile_h, img_h - y), min(tile_w, img_w - x))
+                tile_inputs.append(tile)
+                tile_data_samples.append(
+                    DetDataSample(
+                        metainfo=dict(
+                            img_shape=tile_shape,
+                            ori_shape=tile_shape,
+                            pad_shape=(tile_h, tile_w),
+                            batch_input_shape=(tile_h, tile_w),
+                            scale_factor=(1., 1.))))
+                tile_owners.append(i)
+                tile_offsets.append((x, y))
+
+        tile_results = []
+        for start in range(0, len(tile_inputs), tile_batch_size):
+            inputs = torch.stack(tile_inputs[start:start + tile_batch_size])
+            data_samples = tile_data_samples[start:start + tile_batch_size]
+            x = self.extract_feat(inputs)
+            rpn_results_list = self.rpn_head.predict(
+                x, data_samples, rescale=False)
+            results_list = self.roi_head.predict(
+                x, rpn_results_list, data_samples, rescale=False)
+            tile_results.extend(
+                self.add_pred_to_datasample(data_samples, results_list))
+
+        results_list = []
+        for i, data_sample in enumerate(batch_data_samples):
+            idxs = [k for k, owner in enumerate(tile_owners) if owner == i]
+            merged = merge_results_by_nms(
+                [tile_results[k] for k in idxs],
+                [tile_offsets[k] for k in idxs],
+                src_image_shape=data_sample.img_shape,
+                nms_cfg=nms_cfg)
+            # batched_nms keeps the detections sorted by score
+            pred_instances = merged.pred_instances[:max_per_img]
+            if rescale:
+                scale_factor = [1 / s for s in data_sample.scale_factor]
+                pred_instances.bboxes = scale_boxes(pred_instances.bboxes,
+                                                    scale_factor)
+            results_list.append(pred_instances)
+
+        return self.add_pred_to_datasample(batch_data_samples, results_list)
@@ -1,11 +1,10 @@
 # Copyright (c) OpenMMLab. All rights reserved.
-import copy
-from typing import Dict, Tuple
+from typing import Dict, Optional, Tuple
 import torch
 from torch import Tensor
 
-from mmdet.models.utils import (rename_loss_dict,
-                                reweight_loss_dict)
+from mmdet.models.utils import (class_agnostic_data_samples,
+                                rename_loss_dict, reweight_loss_dict)
 from mmdet.registry import MODELS
 from mmdet.structures import SampleList
 from mmdet.utils import ConfigType, OptConfigType, OptMultiConfig
@@ -60,6 +59,10 @@ class DomainAdaptationDetector(BaseDetector):
         self.burn_up_iters = self.train_cfg.detector_cfg.get('burn_up_iters', 0)
         self.local_iter = 0
 
+        # set by TeacherPipelineTrainLoop to run the diffusion teacher ahead
+        self.teacher_producer = None
+        self.teacher_iter = 0
+
     @property
     def with_rpn(self):
         if self.with_student:
@@ -89,8 +92,25 @@ class DomainAdaptationDetector(BaseDetector):
             
         elif self.train_cfg.detector_cfg.get('type') in ['SemiBaseDiff']:
             if self.local_iter >= self.burn_up_iters:
-                semi_loss, diff_feature = self.model.loss_diff_adaptation(multi_batch_inputs, multi_batch_data_samples)
-                feature_loss = self.loss_feature(multi_batch_inputs['unsup_teacher'], diff_feature)
+                teacher_outputs = None
+                if self.teacher_producer is not None:
+                    teacher_outputs = self.teacher_producer.get(
+                        multi_batch_data_samples['unsup_teacher'])
+                student_feats = None
+                if self.model.semi_train_cfg.get('fused_student_forward',
+                                                 False):
+                    # one student forward for the sup, unsup and kd views
+                    student_feats = self.model.extract_student_feats(
+                        multi_batch_inputs,
+                        ('sup', 'unsup_student', 'unsup_teacher'))
+                semi_loss, diff_feature = self.model.loss_diff_adaptation(
+                    multi_batch_inputs, multi_batch_data_samples, teacher_outputs=teacher_outputs,
+                    student_feats=student_feats)
+                student_x = None if student_feats is None else \
+                    student_feats['unsup_teacher']
+                feature_loss = self.loss_feature(
+                    multi_batch_inputs['unsup_teacher'], diff_feature,
+                    student_x=student_x)
                 losses.update(**semi_loss)
                 losses.update(**feature_loss)
             else:
@@ -101,6 +121,30 @@ class DomainAdaptationDetector(BaseDetector):
             raise "detector type not in ['SemiBase','SoftTeacher','SemiBaseDiff'] "
         return losses
 
+    def build_teacher_producer(self, **kwargs):
+        """Build the producer running the diffusion detector one batch
+        ahead of the student, only used by ``SemiBaseDiff``."""
+        if self.train_cfg.detector_cfg.get('type') != 'SemiBaseDiff':
+            return None
+        self.teacher_producer = self.model.build_teacher_producer(**kwargs)
+        self.teacher_iter = self.local_iter
+        return self.teacher_producer
+
+    @torch.no_grad()
+    def submit_teacher(self, data: dict) -> None:
+        """Queue the diffusion detector on the ``unsup_teacher`` branch of a
+        preprocessed batch before its student step.
+
+        Batches of the burn-up stage are skipped, like in ``loss``.
+        """
+        use_teacher = self.teacher_iter >= self.burn_up_iters
+        self.teacher_iter += 1
+        if not use_teacher:
+            return
+        self.teacher_producer.submit('predict',
+                                     data['inputs']['unsup_teacher'],
+                                     data['data_samples']['unsup_teacher'])
+
     def predict(self, batch_inputs: Tensor,
                 batch_data_samples: SampleList) -> SampleList:
         """Predict results from a batch of inputs and data samples with post-
@@ -185,11 +229,8 @@ class DomainAdaptationDetector(BaseDetector):
         else:
             proposal_cfg = self.model.student.train_cfg.get(
                 'rpn_proposal', self.model.student.test_cfg.rpn)
-            rpn_data_samples = copy.deepcopy(batch_data_samples)
             # set cat_id of gt_labels to 0 in RPN
-            for data_sample in rpn_data_samples:
-                data_sample.gt_instances.labels = torch.zeros_like(
-                    data_sample.gt_instances.labels)
+            rpn_data_samples = class_agnostic_data_samples(batch_data_samples)
             rpn_losses, rpn_results_list = self.model.student.rpn_head.loss_and_predict(
                 diff_x, rpn_data_samples, proposal_cfg=proposal_cfg)
             # avoid get same name with roi_head loss
@@ -206,7 +247,10 @@ class DomainAdaptationDetector(BaseDetector):
         return losses, diff_x
 
 
-    def loss_feature(self, batch_inputs: Tensor, diff_feature) -> dict:
+    def loss_feature(self,
+                     batch_inputs: Tensor,
+                     diff_feature,
+                     student_x: Optional[Tuple[Tensor]] = None) -> dict:
         """Calculate losses from a batch of inputs and data samples.
 
         Args:
@@ -215,11 +259,14 @@ class DomainAdaptationDetector(BaseDetector):
             batch_data_samples (List[:obj:`DetDataSample`]): The batch
                 data samples. It usually includes information such
                 as `gt_instance` or `gt_panoptic_seg` or `gt_sem_seg`.
+            student_x (tuple[Tensor], optional): Student features of
+                ``batch_inputs``. Defaults to None.
 
         Returns:
             dict: A dictionary of loss components
         """
-        student_x = self.model.student.extract_feat(batch_inputs)
+        if student_x is None:
+            student_x = self.model.student.extract_feat(batch_inputs)
         diff_x = diff_feature
         losses = dict()
         feature_loss = dict()
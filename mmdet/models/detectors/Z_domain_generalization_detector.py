@@ -1,11 +1,10 @@
 # Copyright (c) OpenMMLab. All rights reserved.
-import copy
-from typing import Dict, Tuple
+from typing import Dict, Optional, Tuple
 import torch
 from torch import Tensor
 
-from mmdet.models.utils import (rename_loss_dict,
-                                reweight_loss_dict)
+from mmdet.models.utils import (class_agnostic_data_samples,
+                                rename_loss_dict, reweight_loss_dict)
 from mmdet.registry import MODELS
 from mmdet.structures import SampleList
 from mmdet.utils import ConfigType, OptConfigType, OptMultiConfig
@@ -64,6 +63,10 @@ class DomainGeneralizationDetector(BaseDetector):
         self.burn_up_iters = self.train_cfg.get('burn_up_iters', 0)
         self.local_iter = 0
 
+        # set by TeacherPipelineTrainLoop to run the diffusion teacher ahead
+        self.teacher_producer = None
+        self.teacher_iter = 0
+
     @property
     def with_rpn(self):
         if self.with_student:
@@ -93,6 +96,27 @@ class DomainGeneralizationDetector(BaseDetector):
         self.local_iter += 1
         return losses
 
+    def build_teacher_producer(self, **kwargs):
+        """Build the producer running the diffusion teacher one batch ahead
+        of the student, see :class:`TeacherProducer`."""
+        self.teacher_producer = self.model.build_teacher_producer(**kwargs)
+        self.teacher_iter = self.local_iter
+        return self.teacher_producer
+
+    @torch.no_grad()
+    def submit_teacher(self, data: dict) -> None:
+        """Queue the diffusion teacher on a preprocessed batch before its
+        student step.
+
+        Batches of the burn-up stage are skipped, like in ``loss``.
+        """
+        use_teacher = self.teacher_iter >= self.burn_up_iters
+        self.teacher_iter += 1
+        if not use_teacher:
+            return
+        self.teacher_producer.submit('extract_feat', data['inputs'],
+                                     data['data_samples'])
+
     def predict(self, batch_inputs: Tensor,
                 batch_data_samples: SampleList) -> SampleList:
         """Predict results from a batch of inputs and data samples with post-
@@ -188,11 +212,8 @@ class DomainGeneralizationDetector(BaseDetector):
             else:
                 proposal_cfg = self.model.student.train_cfg.get(
                     'rpn_proposal', self.model.student.test_cfg.rpn)
-                rpn_data_samples = copy.deepcopy(batch_data_samples)
                 # set cat_id of gt_labels to 0 in RPN
-                for data_sample in rpn_data_samples:
-                    data_sample.gt_instances.labels = torch.zeros_like(
-                        data_sample.gt_instances.labels)
+                rpn_data_samples = class_agnostic_data_samples(batch_data_samples)
                 rpn_losses, rpn_results_list = self.model.student.rpn_head.loss_and_predict(
                     diff_fpn, rpn_data_samples, proposal_cfg=proposal_cfg)
                 # avoid get same name with roi_head loss
@@ -224,7 +245,10 @@ class DomainGeneralizationDetector(BaseDetector):
             dict: A dictionary of loss components
         """
         student_x = self.model.student.extract_feat(batch_inputs)
-        diff_x = self.model.diff_detector.extract_feat(batch_inputs)
+        if self.teacher_producer is not None:
+            diff_x = self.teacher_producer.get(batch_data_samples)
+        else:
+            diff_x = self.model.diff_detector.extract_feat(batch_inputs)
         losses = dict()
 
         # cross model loss
@@ -250,11 +274,8 @@ class DomainGeneralizationDetector(BaseDetector):
         if self.with_rpn:
             proposal_cfg = self.model.student.train_cfg.get(
                 'rpn_proposal', self.model.student.test_cfg.rpn)
-            rpn_data_samples = copy.deepcopy(batch_data_samples)
             # set cat_id of gt_labels to 0 in RPN
-            for data_sample in rpn_data_samples:
-                data_sample.gt_instances.labels = torch.zeros_like(
-                    data_sample.gt_instances.labels)
+            rpn_data_samples = class_agnostic_data_samples(batch_data_samples)
             rpn_losses, rpn_results_list = self.model.student.rpn_head.loss_and_predict(student_x, rpn_data_samples,
                                                                             proposal_cfg=proposal_cfg)
                         # avoid get same name with roi_head loss
@@ -271,8 +292,11 @@ class DomainGeneralizationDetector(BaseDetector):
                 data_sample.proposals for data_sample in batch_data_samples
             ]
         
-        roi_losses = self.model.student.roi_head.loss(student_x, rpn_results_list,
-                                        batch_data_samples)
+        # the kd branch distills on the same sampled rois, keep them
+        roi_losses, sampling_results, stu_bbox_results = \
+            self.model.student.roi_head.loss(
+                student_x, rpn_results_list, batch_data_samples,
+                return_results=True)
         losses.update(roi_losses)
         ##############################################################################################################
 
@@ -280,7 +304,9 @@ class DomainGeneralizationDetector(BaseDetector):
         ##############################################################################################################
         # Apply cross-kd in ROI head
         roi_losses_kd = self.roi_head_loss_with_kd(
-            student_x, diff_x, rpn_results_list, batch_data_samples)
+            student_x, diff_x, rpn_results_list, batch_data_samples,
+            sampling_results=sampling_results,
+            stu_bbox_results=stu_bbox_results)
         losses.update(roi_losses_kd)
         ##############################################################################################################
 
@@ -290,44 +316,63 @@ class DomainGeneralizationDetector(BaseDetector):
                             student_x: Tuple[Tensor],
                             diff_x: Tuple[Tensor],
                             rpn_results_list,
-                            batch_data_samples):
+                            batch_data_samples,
+                            sampling_results=None,
+                            stu_bbox_results=None):
+        """KD from the diffusion roi head to the student features.
+
+        ``sampling_results`` and ``stu_bbox_results`` are the ones of the
+        student ``roi_head.loss``; when given, the rois are not assigned and
+        sampled again and the student bbox head is not run again.
+        """
         assert len(rpn_results_list) == len(batch_data_samples)
-        outputs = unpack_gt_instances(batch_data_samples)
-        batch_gt_instances, batch_gt_instances_ignore, _ = outputs
         roi_head = self.model.student.roi_head
 
         # assign gts and sample proposals
-        num_imgs = len(batch_data_samples)
-        sampling_results = []
-        for i in range(num_imgs):
-            # rename rpn_results.bboxes to rpn_results.priors
-            rpn_results = rpn_results_list[i]
-            # rpn_results.priors = rpn_results.pop('bboxes')
-
-            assign_result = roi_head.bbox_assigner.assign(
-                rpn_results, batch_gt_instances[i],
-                batch_gt_instances_ignore[i])
-            sampling_result = roi_head.bbox_sampler.sample(
-                assign_result,
-                rpn_results,
-                batch_gt_instances[i],
-                feats=[lvl_feat[i][None] for lvl_feat in student_x])
-            sampling_results.append(sampling_result)
+        if sampling_results is None:
+            outputs = unpack_gt_instances(batch_data_samples)
+            batch_gt_instances, batch_gt_instances_ignore, _ = outputs
+            num_imgs = len(batch_data_samples)
+            sampling_results = []
+            stu_bbox_results = None
+            for i in range(num_imgs):
+                # rename rpn_results.bboxes to rpn_results.priors
+                rpn_results = rpn_results_list[i]
+                # rpn_results.priors = rpn_results.pop('bboxes')
+
+                assign_result = roi_head.bbox_assigner.assign(
+                    rpn_results, batch_gt_instances[i],
+                    batch_gt_instances_ignore[i])
+                sampling_result = roi_head.bbox_sampler.sample(
+                    assign_result,
+                    rpn_results,
+                    batch_gt_instances[i],
+                    feats=[lvl_feat[i][None] for lvl_feat in student_x])
+                sampling_results.append(sampling_result)
 
         losses = dict()
         # bbox head loss
         if roi_head.with_bbox:
             bbox_results = self.bbox_loss_with_kd(
-                student_x, diff_x, sampling_results)
+                student_x, diff_x, sampling_results, stu_bbox_results)
             losses.update(bbox_results['loss_bbox_kd'])
 
         return losses
 
-    def bbox_loss_with_kd(self, student_x, diff_x, sampling_results):
+    def bbox_loss_with_kd(self, student_x, diff_x, sampling_results,
+                          stu_bbox_results=None):
         rois = bbox2roi([res.priors for res in sampling_results])
 
         student_head, diff_head = self.model.student.roi_head, self.model.diff_detector.roi_head
-        stu_bbox_results = student_head._bbox_forward(student_x, rois)
+        if stu_bbox_results is None:
+            stu_bbox_results = student_head._bbox_forward(student_x, rois)
+        else:
+            # reuse the outputs of roi_head.loss, minus its loss dict
+            stu_bbox_results = {
+                key: value
+                for key, value in stu_bbox_results.items()
+                if key != 'loss_bbox'
+            }
         diff_bbox_results = diff_head._bbox_forward(diff_x, rois)
         reused_bbox_results = diff_head._bbox_forward(student_x, rois)
 
@@ -1,5 +1,5 @@
 # Copyright (c) OpenMMLab. All rights reserved.
-from typing import List, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 from torch import Tensor
 
@@ -60,8 +60,10 @@ class SingleStageDetector(BaseDetector):
                                       strict, missing_keys, unexpected_keys,
                                       error_msgs)
 
-    def loss(self, batch_inputs: Tensor,
-             batch_data_samples: SampleList) -> Union[dict, list]:
+    def loss(self,
+             batch_inputs: Tensor,
+             batch_data_samples: SampleList,
+             feats: Optional[Tuple[Tensor]] = None) -> Union[dict, list]:
         """Calculate losses from a batch of inputs and data samples.
 
         Args:
@@ -70,11 +72,13 @@ class SingleStageDetector(BaseDetector):
             batch_data_samples (list[:obj:`DetDataSample`]): The batch
                 data samples. It usually includes information such
                 as `gt_instance` or `gt_panoptic_seg` or `gt_sem_seg`.
+            feats (tuple[Tensor], optional): Features of ``batch_inputs``
+                already extracted by ``extract_feat``. Defaults to None.
 
         Returns:
             dict: A dictionary of loss components.
         """
-        x = self.extract_feat(batch_inputs)
+        x = self.extract_feat(batch_inputs) if feats is None else feats
         losses = self.bbox_head.loss(x, batch_data_samples)
         return losses
 
@@ -6,7 +6,8 @@ import torch
 from mmengine.structures import InstanceData
 from torch import Tensor
 import torch.nn as nn
-from mmdet.models.utils import (filter_gt_instances, rename_loss_dict, filter_gt_instances_domain,
+from mmdet.models.utils import (class_agnostic_data_samples,
+                                filter_gt_instances, rename_loss_dict, filter_gt_instances_domain,
                                 reweight_loss_dict)
 from mmdet.registry import MODELS
 from mmdet.structures import SampleList
@@ -354,15 +355,12 @@ class SoftTeacher(BaseDetector):
             dict: A dictionary of rpn loss components
         """
 
-        rpn_data_samples = copy.deepcopy(batch_data_samples)
+        # set cat_id of gt_labels to 0 in RPN
+        rpn_data_samples = class_agnostic_data_samples(batch_data_samples)
         rpn_data_samples = filter_gt_instances(
             rpn_data_samples, score_thr=self.semi_train_cfg.rpn_pseudo_thr)
         proposal_cfg = self.student.train_cfg.get('rpn_proposal',
                                                   self.student.test_cfg.rpn)
-        # set cat_id of gt_labels to 0 in RPN
-        for data_sample in rpn_data_samples:
-            data_sample.gt_instances.labels = \
-                torch.zeros_like(data_sample.gt_instances.labels)
 
         rpn_losses, rpn_results_list = self.student.rpn_head.loss_and_predict(
             x, rpn_data_samples, proposal_cfg=proposal_cfg)
@@ -1,14 +1,13 @@
 # Copyright (c) OpenMMLab. All rights reserved.
-import copy
 import warnings
-from typing import List, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
-import torch
 from torch import Tensor
 
 from mmdet.registry import MODELS
 from mmdet.structures import SampleList
 from mmdet.utils import ConfigType, OptConfigType, OptMultiConfig
+from ..utils import class_agnostic_data_samples
 from .base import BaseDetector
 
 
@@ -145,7 +144,8 @@ class TwoStageDetector(BaseDetector):
 
     def loss(self, batch_inputs: Tensor,
              batch_data_samples: SampleList,
-             return_feature=False) -> dict:
+             return_feature=False,
+             feats: Optional[Tuple[Tensor]] = None) -> dict:
         """Calculate losses from a batch of inputs and data samples.
 
         Args:
@@ -154,11 +154,13 @@ class TwoStageDetector(BaseDetector):
             batch_data_samples (List[:obj:`DetDataSample`]): The batch
                 data samples. It usually includes information such
                 as `gt_instance` or `gt_panoptic_seg` or `gt_sem_seg`.
+            feats (tuple[Tensor], optional): Features of ``batch_inputs``
+                already extracted by ``extract_feat``. Defaults to None.
 
         Returns:
             dict: A dictionary of loss components
         """
-        x = self.extract_feat(batch_inputs)
+        x = self.extract_feat(batch_inputs) if feats is None else feats
 
         losses = dict()
 
@@ -166,11 +168,8 @@ class TwoStageDetector(BaseDetector):
         if self.with_rpn:
             proposal_cfg = self.train_cfg.get('rpn_proposal',
                                               self.test_cfg.rpn)
-            rpn_data_samples = copy.deepcopy(batch_data_samples)
             # set cat_id of gt_labels to 0 in RPN
-            for data_sample in rpn_data_samples:
-                data_sample.gt_instances.labels = \
-                    torch.zeros_like(data_sample.gt_instances.labels)
+            rpn_data_samples = class_agnostic_data_samples(batch_data_samples)
 
             rpn_losses, rpn_results_list = self.rpn_head.loss_and_predict(
                 x, rpn_data_samples, proposal_cfg=proposal_cfg)
@@ -91,8 +91,11 @@ class StandardRoIHead(BaseRoIHead):
             results = results + (mask_results['mask_preds'], )
         return results
 
-    def loss(self, x: Tuple[Tensor], rpn_results_list: InstanceList,
-             batch_data_samples: List[DetDataSample]) -> dict:
+    def loss(self,
+             x: Tuple[Tensor],
+             rpn_results_list: InstanceList,
+             batch_data_samples: List[DetDataSample],
+             return_results: bool = False) -> dict:
         """Perform forward propagation and loss calculation of the detection
         roi on the features of the upstream network.
 
@@ -103,9 +106,15 @@ class StandardRoIHead(BaseRoIHead):
             batch_data_samples (list[:obj:`DetDataSample`]): The batch
                 data samples. It usually includes information such
                 as `gt_instance` or `gt_panoptic_seg` or `gt_sem_seg`.
+            return_results (bool): Whether to also return the sampling
+                results and the bbox head outputs, so losses on the same
+                rois (e.g. distillation) need not assign, sample and forward
+                again. Defaults to False.
 
         Returns:
-            dict[str, Tensor]: A dictionary of loss components
+            dict[str, Tensor] or tuple: A dictionary of loss components. With
+            ``return_results``, also the list of :obj:`SamplingResult` and
+            the dict returned by ``bbox_loss`` (None without a bbox head).
         """
         assert len(rpn_results_list) == len(batch_data_samples)
         outputs = unpack_gt_instances(batch_data_samples)
@@ -130,6 +139,7 @@ class StandardRoIHead(BaseRoIHead):
             sampling_results.append(sampling_result)
 
         losses = dict()
+        bbox_results = None
         # bbox head loss
         if self.with_bbox:
             bbox_results = self.bbox_loss(x, sampling_results)
@@ -142,6 +152,8 @@ class StandardRoIHead(BaseRoIHead):
                                           batch_gt_instances)
             losses.update(mask_results['loss_mask'])
 
+        if return_results:
+            return losses, sampling_results, bbox_results
         return losses
 
     def _bbox_forward(self, x: Tuple[Tensor], rois: Tensor) -> dict:
@@ -6,7 +6,8 @@ from .image import imrenormalize
 from .make_divisible import make_divisible
 # Disable yapf because it conflicts with isort.
 # yapf: disable
-from .misc import (align_tensor, aligned_bilinear, center_of_mass, filter_gt_instances_domain,
+from .misc import (align_tensor, aligned_bilinear, center_of_mass,
+                   class_agnostic_data_samples, filter_gt_instances_domain,
                    empty_instances, filter_gt_instances, _filter_gt_instances_by_score_domain,
                    filter_scores_and_topk, flip_tensor, generate_coordinate,
                    images_to_levels, interpolate_as, levels_to_images,
@@ -18,6 +19,8 @@ from .misc import (align_tensor, aligned_bilinear, center_of_mass, filter_gt_ins
 from .panoptic_gt_processing import preprocess_panoptic_gt
 from .point_sample import (get_uncertain_point_coords_with_randomness,
                            get_uncertainty)
+from .pseudo_label_bank import PseudoLabelBank, PseudoLabelBankWriter
+from .teacher_producer import TeacherProducer
 from .vlfuse_helper import BertEncoderLayer, VLFuse, permute_and_flatten
 from .wbf import weighted_boxes_fusion
 
@@ -34,5 +37,7 @@ __all__ = [
     'reweight_loss_dict', 'relative_coordinate_maps', 'aligned_bilinear',
     'unfold_wo_center', 'imrenormalize', 'VLFuse', 'permute_and_flatten',
     'BertEncoderLayer', 'align_tensor', 'weighted_boxes_fusion',
-    '_filter_gt_instances_by_score_domain', 'filter_gt_instances_domain'
+    '_filter_gt_instances_by_score_domain', 'filter_gt_instances_domain',
+    'class_agnostic_data_samples',
+    'TeacherProducer', 'PseudoLabelBank', 'PseudoLabelBankWriter'
 ]
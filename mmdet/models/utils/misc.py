@@ -122,6 +122,44 @@ def unpack_gt_instances(batch_data_samples: SampleList) -> tuple:
     return batch_gt_instances, batch_gt_instances_ignore, batch_img_metas
 
 
+def class_agnostic_data_samples(batch_data_samples: SampleList) -> SampleList:
+    """Class-agnostic views of data samples, e.g. for the RPN.
+
+    Each view is a new data sample sharing the metainfo and the data fields
+    of the original one, except ``gt_instances`` whose ``labels`` are set to
+    0. Nothing is copied and the original data samples are left untouched,
+    so the views replace a ``copy.deepcopy`` of the batch as long as their
+    fields are reassigned rather than modified in place.
+
+    Args:
+        batch_data_samples (List[:obj:`DetDataSample`]): The Data
+            Samples. It usually includes information such as
+            `gt_instance`, `gt_panoptic_seg` and `gt_sem_seg`.
+
+    Returns:
+        List[:obj:`DetDataSample`]: The class-agnostic views.
+    """
+    rpn_data_samples = []
+    for data_sample in batch_data_samples:
+        rpn_data_sample = data_sample.__class__()
+        # set_metainfo deep-copies, set the fields one by one instead
+        for key, value in data_sample.metainfo_items():
+            rpn_data_sample.set_field(value, key, field_type='metainfo')
+        for key, value in data_sample.items():
+            setattr(rpn_data_sample, key, value)
+        if 'gt_instances' in data_sample:
+            gt_instances = data_sample.gt_instances
+            rpn_gt_instances = gt_instances.__class__()
+            for key, value in gt_instances.metainfo_items():
+                rpn_gt_instances.set_field(value, key, field_type='metainfo')
+            for key, value in gt_instances.items():
+                setattr(rpn_gt_instances, key, value)
+            rpn_gt_instances.labels = torch.zeros_like(gt_instances.labels)
+            rpn_data_sample.gt_instances = rpn_gt_instances
+        rpn_data_samples.append(rpn_data_sample)
+    return rpn_data_samples
+
+
 def empty_instances(batch_img_metas: List[dict],
                     device: torch.device,
                     task_type: str,
@@ -0,0 +1,233 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import json
+import os
+import os.path as osp
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from mmengine.structures import InstanceData
+from torch import Tensor
+
+from mmdet.structures import SampleList
+
+
+class PseudoLabelBank:
+    """Offline detections (and optionally FPN features) of a frozen teacher.
+
+    The detections of every image are stored column-wise in original image
+    coordinates, the rows of image ``i`` are ``offsets[i]:offsets[i + 1]``::
+
+        root/
+            meta.json       build settings
+            index.json      img_path -> image index
+            offsets.npy     (num_images + 1, ) int64
+            bboxes.npy      (num_dets, 4) float32
+            scores.npy      (num_dets, ) float32
+            labels.npy      (num_dets, ) int32
+            features/       optional, see ``get_features``
+
+    Columns are memory-mapped, so a bank is shared by all dataloader and
+    training processes through the page cache.
+
+    Args:
+        root (str): Directory of the bank.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        with open(osp.join(root, 'meta.json')) as f:
+            self.meta = json.load(f)
+        with open(osp.join(root, 'index.json')) as f:
+            self.index = json.load(f)
+        self.offsets = np.load(osp.join(root, 'offsets.npy'), mmap_mode='r')
+        self.bboxes = np.load(osp.join(root, 'bboxes.npy'), mmap_mode='r')
+        self.scores = np.load(osp.join(root, 'scores.npy'), mmap_mode='r')
+        self.labels = np.load(osp.join(root, 'labels.npy'), mmap_mode='r')
+        self.with_features = self.meta.get('with_features', False)
+        if self.with_features:
+            self.feat_scale_factor = np.load(
+                osp.join(root, 'features', 'scale_factor.npy'))
+            self.feat_pad_shape = np.load(
+                osp.join(root, 'features', 'pad_shape.npy'))
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, img_path: str) -> bool:
+        return img_path in self.index
+
+    def get_instances(self, img_path: str, device) -> InstanceData:
+        """Detections of one image in original image coordinates."""
+        i = self._image_index(img_path)
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        instances = InstanceData()
+        instances.bboxes = torch.from_numpy(
+            np.array(self.bboxes[start:end])).to(device)
+        instances.scores = torch.from_numpy(
+            np.array(self.scores[start:end])).to(device)
+        instances.labels = torch.from_numpy(
+            np.array(self.labels[start:end])).long().to(device)
+        return instances
+
+    def get_features(self, data_samples: SampleList,
+                     device) -> Tuple[Tensor]:
+        """FPN features of a batch of views, sampled from the stored ones.
+
+        The stored features were computed on the full image at a fixed
+        scale. Each view (resize, crop and flip of the original image, given
+        by its ``homography_matrix``) is mapped to them with one affine
+        ``grid_sample`` per level, so the result is aligned with the FPN
+        features of the view's padded batch input.
+        """
+        pad_h, pad_w = data_samples[0].batch_input_shape
+        norm_view = _normalize_matrix(pad_h, pad_w)
+        thetas = []
+        for data_sample in data_samples:
+            i = self._image_index(data_sample.img_path)
+            bank_h, bank_w = self.feat_pad_shape[i]
+            scale_x, scale_y = self.feat_scale_factor[i]
+            bank_homography = np.diag([scale_x, scale_y, 1.])
+            view_to_bank = bank_homography @ np.linalg.inv(
+                np.asarray(data_sample.homography_matrix, dtype=np.float64))
+            theta = _normalize_matrix(bank_h, bank_w) @ view_to_bank @ \
+                np.linalg.inv(norm_view)
+            thetas.append(torch.from_numpy(theta[:2]).float())
+
+        num_levels = self.meta['num_levels']
+        feats = []
+        for level in range(num_levels):
+            level_feats = []
+            for data_sample, theta in zip(data_samples, thetas):
+                i = self._image_index(data_sample.img_path)
+                bank_feat = torch.from_numpy(
+                    np.load(self._feature_file(i, level), mmap_mode='r')[None])
+                bank_feat = bank_feat.to(device, dtype=torch.float)
+                stride = self.feat_pad_shape[i][0] / bank_feat.shape[-2]
+                out_size = (1, bank_feat.shape[1], int(round(pad_h / stride)),
+                            int(round(pad_w / stride)))
+                grid = F.affine_grid(
+                    theta[None].to(device), out_size, align_corners=False)
+                level_feats.append(
+                    F.grid_sample(bank_feat, grid, align_corners=False))
+            feats.append(torch.cat(level_feats, dim=0))
+        return tuple(feats)
+
+    def _image_index(self, img_path: str) -> int:
+        i = self.index.get(img_path)
+        if i is None:
+            raise KeyError(
+                f'{img_path} is not in the pseudo-label bank '
+                f'{osp.join(self.root, "index.json")} '
+                f'({len(self.index)} images); the bank was built for other '
+                'images, regenerate it with '
+                'tools/misc/build_pseudo_label_bank.py')
+        return i
+
+    def _feature_file(self, i: int, level: int) -> str:
+        return osp.join(self.root, 'features', f'{i // 1000:04d}',
+                        f'{i}_level{level}.npy')
+
+
+def _normalize_matrix(h: float, w: float) -> np.ndarray:
+    """Pixel coordinates to ``grid_sample`` coordinates."""
+    return np.array([[2. / w, 0., -1.], [0., 2. / h, -1.], [0., 0., 1.]])
+
+
+class PseudoLabelBankWriter:
+    """Builds a :class:`PseudoLabelBank`.
+
+    Detections are collected in memory and written column-wise by
+    ``close``, features are written per image as they come.
+
+    Args:
+        root (str): Directory of the bank.
+        meta (dict): Build settings stored in ``meta.json``.
+        with_features (bool): Whether FPN features are stored.
+            Defaults to False.
+    """
+
+    def __init__(self,
+                 root: str,
+                 meta: dict,
+                 with_features: bool = False) -> None:
+        self.root = root
+        self.meta = dict(meta, with_features=with_features)
+        self.with_features = with_features
+        self.index = dict()
+        self.bboxes: List[np.ndarray] = []
+        self.scores: List[np.ndarray] = []
+        self.labels: List[np.ndarray] = []
+        self.feat_scale_factor: List[Sequence[float]] = []
+        self.feat_pad_shape: List[Sequence[int]] = []
+        os.makedirs(osp.join(root, 'features') if with_features else root,
+                    exist_ok=True)
+
+    def add(self,
+            img_path: str,
+            instances: InstanceData,
+            feats: Optional[Sequence[Tensor]] = None,
+            scale_factor: Optional[Sequence[float]] = None,
+            pad_shape: Optional[Sequence[int]] = None) -> None:
+        """Add the detections of one image.
+
+        Args:
+            img_path (str): Path of the image, the key of the bank.
+            instances (:obj:`InstanceData`): Detections in original image
+                coordinates.
+            feats (Sequence[Tensor], optional): FPN features of the image,
+                each with shape (C, h, w).
+            scale_factor (Sequence[float], optional): (w, h) scale of the
+                input the features were computed on.
+            pad_shape (Sequence[int], optional): (h, w) padded shape of the
+                input the features were computed on.
+        """
+        assert img_path not in self.index, f'{img_path} is added twice'
+        i = len(self.index)
+        self.index[img_path] = i
+        self.bboxes.append(instances.bboxes.cpu().numpy().astype(np.float32))
+        self.scores.append(instances.scores.cpu().numpy().astype(np.float32))
+        self.labels.append(instances.labels.cpu().numpy().astype(np.int32))
+        if self.with_features:
+            assert feats is not None
+            self.meta['num_levels'] = len(feats)
+            self.feat_scale_factor.append(list(scale_factor))
+            self.feat_pad_shape.append(list(pad_shape))
+            for level, feat in enumerate(feats):
+                file = osp.join(self.root, 'features', f'{i // 1000:04d}',
+                                f'{i}_level{level}.npy')
+                os.makedirs(osp.dirname(file), exist_ok=True)
+                np.save(file, feat.detach().to('cpu', torch.float16).numpy())
+
+    def close(self) -> None:
+        """Write the columns and the index."""
+        lengths = [len(bboxes) for bboxes in self.bboxes]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        np.save(osp.join(self.root, 'offsets.npy'), offsets)
+        np.save(
+            osp.join(self.root, 'bboxes.npy'),
+            np.concatenate(self.bboxes).reshape(-1, 4)
+            if self.bboxes else np.zeros((0, 4), np.float32))
+        np.save(
+            osp.join(self.root, 'scores.npy'),
+            np.concatenate(self.scores)
+            if self.scores else np.zeros(0, np.float32))
+        np.save(
+            osp.join(self.root, 'labels.npy'),
+            np.concatenate(self.labels)
+            if self.labels else np.zeros(0, np.int32))
+        if self.with_features:
+            np.save(
+                osp.join(self.root, 'features', 'scale_factor.npy'),
+                np.array(self.feat_scale_factor, dtype=np.float64))
+            np.save(
+                osp.join(self.root, 'features', 'pad_shape.npy'),
+                np.array(self.feat_pad_shape, dtype=np.int64))
+        with open(osp.join(self.root, 'index.json'), 'w') as f:
+            json.dump(self.index, f)
+        self.meta['num_images'] = len(self.index)
+        self.meta['num_dets'] = int(offsets[-1])
+        with open(osp.join(self.root, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f, indent=2)
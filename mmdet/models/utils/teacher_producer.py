@@ -0,0 +1,225 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, List, Optional
+
+import torch
+from mmengine.structures import BaseDataElement
+
+from mmdet.structures import DetDataSample, SampleList
+
+# teacher of a process-mode worker, built once by ``_init_worker``
+_worker_teacher = None
+
+
+def run_teacher(teacher, method: str, inputs: torch.Tensor,
+                data_samples: SampleList) -> Any:
+    """Run the frozen diffusion teacher.
+
+    Args:
+        teacher (nn.Module): A ``DiffusionDetector``.
+        method (str): ``'extract_feat'`` returns the FPN features,
+            ``'predict'`` returns the predicted instances of each image
+            (not rescaled) and the FPN features.
+        inputs (Tensor): Preprocessed inputs with shape (N, C, H, W).
+        data_samples (list[:obj:`DetDataSample`]): Data samples holding
+            the meta information of the inputs.
+    """
+    with torch.no_grad():
+        if method == 'extract_feat':
+            return teacher.extract_feat(inputs)
+        elif method == 'predict':
+            results_list, feats = teacher.predict(
+                inputs, data_samples, rescale=False, return_feature=True)
+            return [results.pred_instances for results in results_list], feats
+    raise NotImplementedError(f'teacher method {method}')
+
+
+def apply_to_tensors(obj: Any, fn) -> Any:
+    """Apply ``fn`` to every tensor of nested tuples, lists, dicts and data
+    elements."""
+    if isinstance(obj, torch.Tensor):
+        return fn(obj)
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(apply_to_tensors(item, fn) for item in obj)
+    if isinstance(obj, dict):
+        return {key: apply_to_tensors(value, fn) for key, value in obj.items()}
+    if isinstance(obj, BaseDataElement):
+        obj = obj.clone()
+        for key, value in obj.items():
+            obj.set_field(apply_to_tensors(value, fn), key)
+        return obj
+    return obj
+
+
+def _init_worker(config: str, checkpoint: Optional[str], device: str):
+    """Build the teacher once in a process-mode worker."""
+    global _worker_teacher
+    from mmengine.config import Config
+    from mmengine.registry import init_default_scope
+    from mmengine.runner import load_checkpoint
+
+    from mmdet.registry import MODELS
+
+    init_default_scope('mmdet')
+    cfg = Config.fromfile(config)
+    _worker_teacher = MODELS.build(cfg.model)
+    if checkpoint:
+        load_checkpoint(_worker_teacher, checkpoint, map_location='cpu')
+    _worker_teacher.to(device)
+    _worker_teacher.eval()
+
+
+def _run_in_worker(method: str, inputs: torch.Tensor,
+                   data_samples: SampleList) -> Any:
+    device = next(_worker_teacher.parameters()).device
+    outputs = run_teacher(_worker_teacher, method,
+                          inputs.to(device), data_samples)
+    # cpu tensors go back through shared memory
+    return apply_to_tensors(outputs, lambda x: x.cpu())
+
+
+class TeacherProducer:
+    """Runs a frozen teacher ahead of the student.
+
+    The training loop submits the teacher inputs of batch k+1 before the
+    student step of batch k, the student step then takes the teacher
+    outputs of its own batch. Outputs are handed over in submission order
+    and checked against the image paths of the batch, so a batch is never
+    paired with the outputs of another one.
+
+    Args:
+        teacher (nn.Module): The frozen teacher, used by the ``thread`` and
+            ``sync`` modes.
+        mode (str): ``'thread'`` runs the teacher in a background thread on
+            a separate CUDA stream of the same device. ``'process'`` runs a
+            copy of the teacher, built from ``teacher_config`` and
+            ``teacher_checkpoint``, in a worker process on ``device``; it
+            also runs on cpu-only hosts. ``'sync'`` runs it at submission.
+            Defaults to 'thread'.
+        max_pending (int): Maximum number of batches submitted and not yet
+            taken. Defaults to 2.
+        device (str, optional): Device of the process-mode teacher.
+            Defaults to the device of ``teacher``.
+        teacher_config (str, optional): Config file of the teacher, used by
+            the process mode.
+        teacher_checkpoint (str, optional): Checkpoint of the teacher, used
+            by the process mode.
+    """
+
+    def __init__(self,
+                 teacher,
+                 mode: str = 'thread',
+                 max_pending: int = 2,
+                 device: Optional[str] = None,
+                 teacher_config: Optional[str] = None,
+                 teacher_checkpoint: Optional[str] = None) -> None:
+        assert mode in ('thread', 'process', 'sync'), \
+            f'mode should be thread, process or sync, got {mode}'
+        self.teacher = teacher
+        self.device = next(teacher.parameters()).device
+        self.mode = mode
+        self.max_pending = max_pending
+        self.pending = deque()
+        self.stream = None
+        if mode == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers=1)
+            if self.device.type == 'cuda':
+                self.stream = torch.cuda.Stream(self.device)
+        elif mode == 'process':
+            assert teacher_config is not None, \
+                'the process mode builds the teacher from teacher_config'
+            self.executor = ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=torch.multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(teacher_config, teacher_checkpoint,
+                          device or str(self.device)))
+        else:
+            self.executor = None
+
+    @staticmethod
+    def batch_keys(data_samples: SampleList) -> List[str]:
+        return [data_sample.img_path for data_sample in data_samples]
+
+    def submit(self, method: str, inputs: torch.Tensor,
+               data_samples: SampleList) -> None:
+        """Queue the teacher on one batch.
+
+        Args:
+            method (str): See :func:`run_teacher`.
+            inputs (Tensor): Preprocessed inputs of the batch.
+            data_samples (list[:obj:`DetDataSample`]): Data samples of the
+                batch, only their meta information is passed on.
+        """
+        if len(self.pending) >= self.max_pending:
+            raise RuntimeError(
+                f'{self.max_pending} teacher batches are pending, the '
+                'student does not take the teacher outputs')
+        keys = self.batch_keys(data_samples)
+        data_samples = [
+            DetDataSample(metainfo=data_sample.metainfo)
+            for data_sample in data_samples
+        ]
+        if self.mode == 'sync':
+            future = Future()
+            future.set_result(
+                run_teacher(self.teacher, method, inputs, data_samples))
+        elif self.mode == 'process':
+            future = self.executor.submit(_run_in_worker, method,
+                                          inputs.cpu(), data_samples)
+        else:
+            ready = None
+            if self.stream is not None:
+                ready = torch.cuda.Event()
+                ready.record()
+            future = self.executor.submit(self._run_in_thread, method, inputs,
+                                          data_samples, ready)
+        self.pending.append((keys, future))
+
+    def _run_in_thread(self, method, inputs, data_samples, ready):
+        if self.stream is None:
+            return run_teacher(self.teacher, method, inputs, data_samples)
+        with torch.cuda.stream(self.stream):
+            # the inputs were preprocessed on the main stream
+            self.stream.wait_event(ready)
+            inputs.record_stream(self.stream)
+            outputs = run_teacher(self.teacher, method, inputs, data_samples)
+        self.stream.synchronize()
+        return outputs
+
+    def get(self, data_samples: SampleList) -> Any:
+        """Take the teacher outputs of the oldest submitted batch.
+
+        Args:
+            data_samples (list[:obj:`DetDataSample`]): Data samples of the
+                batch the outputs are used for.
+        """
+        if not self.pending:
+            raise RuntimeError('no teacher batch was submitted')
+        keys, future = self.pending.popleft()
+        if keys != self.batch_keys(data_samples):
+            raise RuntimeError(
+                'teacher outputs belong to another batch: '
+                f'{keys} vs {self.batch_keys(data_samples)}')
+        outputs = future.result()
+        if self.mode == 'process':
+            outputs = apply_to_tensors(
+                outputs, lambda x: x.to(self.device, non_blocking=True))
+        elif self.stream is not None:
+            # memory of the teacher stream is now used by the main stream
+            current_stream = torch.cuda.current_stream(self.device)
+            apply_to_tensors(outputs,
+                             lambda x: x.record_stream(current_stream) or x)
+        return outputs
+
+    def reset(self) -> None:
+        """Drop the pending batches."""
+        for _, future in self.pending:
+            future.cancel()
+        self.pending.clear()
+
+    def shutdown(self) -> None:
+        self.reset()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
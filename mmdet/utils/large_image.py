@@ -1,5 +1,5 @@
 # Copyright (c) OpenMMLab. All rights reserved.
-from typing import Sequence, Tuple
+from typing import List, Sequence, Tuple
 
 import torch
 from mmcv.ops import batched_nms
@@ -24,6 +24,50 @@ def shift_rbboxes(bboxes: torch.Tensor, offset: Sequence[int]):
     return shifted_bboxes
 
 
+def shift_hbboxes(bboxes: torch.Tensor, offset: Sequence[int]):
+    """Shift horizontal bboxes with offset.
+
+    Args:
+        bboxes (Tensor): The horizontal bboxes need to be translated.
+            With shape (n, 4), which means (x1, y1, x2, y2).
+        offset (Sequence[int]): The translation offsets with shape of (2, ).
+    Returns:
+        Tensor: Shifted horizontal bboxes.
+    """
+    offset_tensor = bboxes.new_tensor(offset).repeat(2)
+    return bboxes + offset_tensor
+
+
+def sliding_window_offsets(image_shape: Tuple[int, int],
+                           window_size: Tuple[int, int],
+                           stride: Tuple[int, int]) -> List[Tuple[int, int]]:
+    """Positions of the left top points of sliding windows over an image.
+
+    The last window of each row and column is aligned to the image border,
+    so every pixel is covered and no window leaves the image unless the
+    image is smaller than the window.
+
+    Args:
+        image_shape (Tuple[int, int]): A (height, width) tuple of the image.
+        window_size (Tuple[int, int]): A (height, width) tuple of the window.
+        stride (Tuple[int, int]): A (height, width) tuple of the window
+            stride.
+    Returns:
+        List[Tuple[int, int]]: (x, y) offsets of the windows, row-major.
+    """
+
+    def starts(length, window, step):
+        if length <= window:
+            return [0]
+        positions = list(range(0, length - window, step))
+        positions.append(length - window)
+        return positions
+
+    ys = starts(image_shape[0], window_size[0], stride[0])
+    xs = starts(image_shape[1], window_size[1], stride[1])
+    return [(x, y) for y in ys for x in xs]
+
+
 def shift_predictions(det_data_samples: SampleList,
                       offsets: Sequence[Tuple[int, int]],
                       src_image_shape: Tuple[int, int]) -> SampleList:
@@ -38,12 +82,6 @@ def shift_predictions(det_data_samples: SampleList,
     Returns:
         (List[:obj:`DetDataSample`]): shifted results.
     """
-    try:
-        from sahi.slicing import shift_bboxes, shift_masks
-    except ImportError:
-        raise ImportError('Please run "pip install -U sahi" '
-                          'to install sahi first for large image inference.')
-
     assert len(det_data_samples) == len(
         offsets), 'The `results` should has the ' 'same length with `offsets`.'
     shifted_predictions = []
@@ -53,7 +91,7 @@ def shift_predictions(det_data_samples: SampleList,
         # Check bbox type
         if pred_inst.bboxes.size(-1) == 4:
             # Horizontal bboxes
-            shifted_bboxes = shift_bboxes(pred_inst.bboxes, offset)
+            shifted_bboxes = shift_hbboxes(pred_inst.bboxes, offset)
         elif pred_inst.bboxes.size(-1) == 5:
             # Rotated bboxes
             shifted_bboxes = shift_rbboxes(pred_inst.bboxes, offset)
@@ -63,6 +101,12 @@ def shift_predictions(det_data_samples: SampleList,
         # shift bboxes and masks
         pred_inst.bboxes = shifted_bboxes
         if 'masks' in det_data_sample:
+            try:
+                from sahi.slicing import shift_masks
+            except ImportError:
+                raise ImportError(
+                    'Please run "pip install -U sahi" '
+                    'to install sahi first for large image inference.')
             pred_inst.masks = shift_masks(pred_inst.masks, offset,
                                           src_image_shape)
 
@@ -0,0 +1,124 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import os
+import os.path as osp
+import tempfile
+from unittest import TestCase
+
+from mmdet.datasets import XMLDataset
+
+XML = """<annotation>
+    <size><width>{width}</width><height>20</height><depth>3</depth></size>
+    <object>
+        <name>{name}</name>
+        <difficult>0</difficult>
+        <bndbox>
+            <xmin>2</xmin><ymin>3</ymin><xmax>8</xmax><ymax>9</ymax>
+        </bndbox>
+    </object>
+</annotation>
+"""
+
+
+class CountingXMLDataset(XMLDataset):
+    """Counts the data lists loaded from the annotation files."""
+
+    num_loads = 0
+
+    def load_data_list(self):
+        CountingXMLDataset.num_loads += 1
+        return super().load_data_list()
+
+
+class TestDataListCache(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+        self.cache = osp.join(self.root, 'cache')
+        os.makedirs(osp.join(self.root, 'Annotations'))
+        self.ann_file = osp.join(self.root, 'train.txt')
+        self._write_ann_file(['a', 'b'])
+        self._write_xml('a', 'car')
+        self._write_xml('b', 'person')
+        CountingXMLDataset.num_loads = 0
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _write_ann_file(self, img_ids):
+        with open(self.ann_file, 'w') as f:
+            f.write('\n'.join(img_ids) + '\n')
+
+    def _write_xml(self, img_id, name, width=30, mtime_ns=None):
+        xml_path = osp.join(self.root, 'Annotations', f'{img_id}.xml')
+        with open(xml_path, 'w') as f:
+            f.write(XML.format(name=name, width=width))
+        if mtime_ns is not None:
+            os.utime(xml_path, ns=(mtime_ns, mtime_ns))
+
+    def _dataset(self, **kwargs):
+        return CountingXMLDataset(
+            ann_file=self.ann_file,
+            data_prefix=dict(sub_data_root=self.root),
+            metainfo=dict(classes=('car', 'person')),
+            test_mode=True,
+            data_list_cache=self.cache,
+            pipeline=[],
+            **kwargs)
+
+    def _data_infos(self, dataset):
+        return [dataset.get_data_info(i) for i in range(len(dataset))]
+
+    def test_round_trip(self):
+        dataset = self._dataset()
+        self.assertEqual(CountingXMLDataset.num_loads, 1)
+        self.assertEqual(len(os.listdir(self.cache)), 1)
+
+        # the entry is stored serialized, either layout reads it
+        for serialize_data in (True, False):
+            cached = self._dataset(serialize_data=serialize_data)
+            self.assertEqual(CountingXMLDataset.num_loads, 1)
+            self.assertEqual(
+                self._data_infos(cached), self._data_infos(dataset))
+            self.assertEqual([
+                info['instances'][0]['bbox_label']
+                for info in self._data_infos(cached)
+            ], [0, 1])
+            # attributes set while loading come with the data list
+            self.assertEqual(cached.cat2label, dict(car=0, person=1))
+
+    def test_unserialized_save(self):
+        dataset = self._dataset(serialize_data=False)
+        cached = self._dataset()
+        self.assertEqual(CountingXMLDataset.num_loads, 1)
+        self.assertEqual(self._data_infos(cached), self._data_infos(dataset))
+
+    def test_settings_invalidate(self):
+        self._dataset()
+        self._dataset(filter_cfg=dict(filter_empty_gt=True))
+        self.assertEqual(CountingXMLDataset.num_loads, 2)
+        self.assertEqual(len(os.listdir(self.cache)), 2)
+
+    def test_ann_file_invalidates(self):
+        self._dataset()
+        self._write_xml('c', 'car')
+        self._write_ann_file(['a', 'b', 'c'])
+        dataset = self._dataset()
+        self.assertEqual(CountingXMLDataset.num_loads, 2)
+        self.assertEqual(len(dataset), 3)
+
+    def test_xml_file_invalidates(self):
+        self._write_xml('b', 'person', mtime_ns=10**18)
+        self._dataset()
+        # an in-place edit of one of the listed XML files
+        self._write_xml('b', 'car', mtime_ns=10**18 + 10**9)
+        dataset = self._dataset()
+        self.assertEqual(CountingXMLDataset.num_loads, 2)
+        self.assertEqual(dataset.get_data_info(1)['instances'][0]
+                         ['bbox_label'], 0)
+
+        # the mtime is enough, e.g. for an edit of the same size
+        self._write_xml('b', 'car', width=31, mtime_ns=10**18 + 2 * 10**9)
+        dataset = self._dataset()
+        self.assertEqual(CountingXMLDataset.num_loads, 3)
+        self.assertEqual(dataset.get_data_info(1)['width'], 31)
@@ -0,0 +1,141 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import os.path as osp
+import tempfile
+from unittest import TestCase
+
+import cv2
+import mmcv
+import numpy as np
+
+from mmdet.datasets.transforms import LoadImageFromCache, Resize
+from mmdet.datasets.transforms.image_cache import (ImageShardCache,
+                                                   ImageShardCacheWriter)
+
+RESIZE = dict(
+    type='Resize',
+    scale=[16, 12],
+    keep_ratio=False,
+    interpolation='bilinear',
+    backend='cv2')
+
+
+def _image(h=24, w=32):
+    # smooth, so that JPEG stays close to the image
+    ys, xs = np.mgrid[0:h, 0:w]
+    img = np.stack([ys * 8, xs * 6, (ys + xs) * 4], axis=-1)
+    return img.astype(np.uint8)
+
+
+def _build_cache(root, images, **kwargs):
+    writer = ImageShardCacheWriter(root, resize=RESIZE, **kwargs)
+    for img_path, img in images.items():
+        resized = mmcv.imresize(img, tuple(RESIZE['scale']))
+        writer.add(img_path, writer.encode(resized), resized.shape,
+                   img.shape[:2])
+    writer.close()
+
+
+class TestImageShardCache(TestCase):
+
+    def test_round_trip(self):
+        images = {f'img{i}.jpg': _image() + i for i in range(5)}
+        for format in ('raw', 'png', 'jpeg'):
+            with tempfile.TemporaryDirectory() as root:
+                # a small shard size spreads the images over shards
+                _build_cache(root, images, format=format, shard_size=1000)
+                cache = ImageShardCache(root)
+                self.assertEqual(len(cache), 5)
+                self.assertEqual(cache.meta['format'], format)
+                self.assertEqual(cache.resize, RESIZE)
+                for img_path, img in images.items():
+                    self.assertIn(img_path, cache)
+                    cached, ori_shape = cache.get(img_path)
+                    expected = mmcv.imresize(img, tuple(RESIZE['scale']))
+                    self.assertEqual(ori_shape, (24, 32))
+                    self.assertEqual(cached.shape, expected.shape)
+                    self.assertEqual(cached.dtype, np.uint8)
+                    diff = np.abs(
+                        cached.astype(np.int32) - expected.astype(np.int32))
+                    if format == 'jpeg':
+                        # lossy
+                        self.assertLess(diff.mean(), 4)
+                    else:
+                        self.assertEqual(diff.max(), 0)
+
+    def test_grayscale(self):
+        img = cv2.cvtColor(_image(), cv2.COLOR_BGR2GRAY)
+        for format in ('raw', 'png'):
+            with tempfile.TemporaryDirectory() as root:
+                _build_cache(
+                    root, {'a.jpg': img},
+                    format=format,
+                    color_type='grayscale')
+                cached, _ = ImageShardCache(root).get('a.jpg')
+                self.assertEqual(cached.shape, (12, 16))
+
+    def test_missing(self):
+        with tempfile.TemporaryDirectory() as root:
+            _build_cache(root, {'a.jpg': _image()})
+            cache = ImageShardCache(root)
+            self.assertNotIn('b.jpg', cache)
+            self.assertIsNone(cache.get('b.jpg'))
+
+    def test_add_twice(self):
+        with tempfile.TemporaryDirectory() as root:
+            writer = ImageShardCacheWriter(root, resize=RESIZE)
+            record = writer.encode(_image())
+            writer.add('a.jpg', record, (24, 32, 3), (24, 32))
+            with self.assertRaises(AssertionError):
+                writer.add('a.jpg', record, (24, 32, 3), (24, 32))
+
+
+class TestLoadImageFromCache(TestCase):
+
+    def test_load(self):
+        with tempfile.TemporaryDirectory() as root:
+            cache_root = osp.join(root, 'cache')
+            img = _image()
+            _build_cache(cache_root, {'a.jpg': img})
+            transform = LoadImageFromCache(cache_root=cache_root)
+            results = transform(dict(img_path='a.jpg'))
+            self.assertEqual(results['img_shape'], (12, 16))
+            self.assertEqual(results['ori_shape'], (24, 32))
+            self.assertEqual(results['cached_resize']['scale_factor'],
+                             (0.5, 0.5))
+
+            # the matching resize keeps the image
+            resize = Resize(scale=(16, 12), keep_ratio=False)
+            resized = resize(results)
+            self.assertNotIn('cached_resize', resized)
+            self.assertEqual(resized['img'].shape, (12, 16, 3))
+            self.assertEqual(resized['scale_factor'], (0.5, 0.5))
+
+    def test_resize_mismatch(self):
+        with tempfile.TemporaryDirectory() as root:
+            _build_cache(root, {'a.jpg': _image()})
+            results = LoadImageFromCache(cache_root=root)(
+                dict(img_path='a.jpg'))
+            with self.assertRaises(ValueError):
+                Resize(scale=(16, 12), keep_ratio=True)(results)
+
+    def test_fallback(self):
+        with tempfile.TemporaryDirectory() as root:
+            img_path = osp.join(root, 'b.png')
+            cv2.imwrite(img_path, _image())
+            cache_root = osp.join(root, 'cache')
+            _build_cache(cache_root, {'a.jpg': _image()})
+
+            # images missing from the cache are loaded from file
+            results = LoadImageFromCache(cache_root=cache_root)(
+                dict(img_path=img_path))
+            self.assertEqual(results['img'].shape, (24, 32, 3))
+            self.assertNotIn('cached_resize', results)
+            resized = Resize(scale=(16, 12), keep_ratio=False)(results)
+            self.assertEqual(resized['img'].shape, (12, 16, 3))
+
+            # so are all images without a cache
+            with self.assertWarns(UserWarning):
+                transform = LoadImageFromCache(
+                    cache_root=osp.join(root, 'missing'))
+            results = transform(dict(img_path=img_path))
+            self.assertTrue(np.array_equal(results['img'], _image()))
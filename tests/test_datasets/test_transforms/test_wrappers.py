@@ -0,0 +1,82 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from unittest import TestCase
+
+import numpy as np
+
+from mmdet.datasets.transforms import MultiBranch
+from mmdet.datasets.transforms.transforms import writeable
+from mmdet.structures.mask import BitmapMasks
+from mmdet.utils import register_all_modules
+
+register_all_modules()
+
+
+class TestMultiBranch(TestCase):
+
+    def setUp(self):
+        self.results = dict(
+            img=np.zeros((8, 8, 3), dtype=np.uint8),
+            gt_seg_map=np.zeros((8, 8), dtype=np.uint8),
+            gt_masks=BitmapMasks(np.zeros((2, 8, 8), dtype=np.uint8), 8, 8),
+            img_shape=(8, 8))
+        # a writing branch and a branch keeping the image
+        self.branches = dict(
+            cutout=[
+                dict(
+                    type='CutOut',
+                    n_holes=1,
+                    cutout_shape=(8, 8),
+                    fill_in=(255, 255, 255))
+            ],
+            identity=[])
+
+    def test_copy_on_write(self):
+        transform = MultiBranch(
+            branch_field=['cutout', 'identity'],
+            copy_on_write=True,
+            **self.branches)
+        outputs = transform(self.results)
+
+        # the branch keeping the image shares it read-only
+        img = outputs['img']['identity']
+        self.assertTrue(np.shares_memory(img, self.results['img']))
+        self.assertFalse(img.flags.writeable)
+        gt_seg_map = outputs['gt_seg_map']['identity']
+        self.assertTrue(
+            np.shares_memory(gt_seg_map, self.results['gt_seg_map']))
+        gt_masks = outputs['gt_masks']['identity']
+        self.assertTrue(
+            np.shares_memory(gt_masks.masks, self.results['gt_masks'].masks))
+        with self.assertRaises(ValueError):
+            img[0, 0] = 1
+
+        # the writing branch copied the image, the others are unchanged
+        self.assertGreater(outputs['img']['cutout'].sum(), 0)
+        self.assertFalse(
+            np.shares_memory(outputs['img']['cutout'], self.results['img']))
+        self.assertEqual(img.sum(), 0)
+        self.assertEqual(self.results['img'].sum(), 0)
+        self.assertTrue(self.results['img'].flags.writeable)
+        # the fields no transform writes are still copies
+        self.assertIsNot(outputs['gt_masks']['identity'],
+                         self.results['gt_masks'])
+
+    def test_deepcopy(self):
+        transform = MultiBranch(
+            branch_field=['cutout', 'identity'], **self.branches)
+        outputs = transform(self.results)
+        img = outputs['img']['identity']
+        self.assertFalse(np.shares_memory(img, self.results['img']))
+        self.assertTrue(img.flags.writeable)
+        self.assertGreater(outputs['img']['cutout'].sum(), 0)
+        self.assertEqual(self.results['img'].sum(), 0)
+
+    def test_writeable(self):
+        array = np.zeros(4)
+        self.assertIs(writeable(array), array)
+        view = array.view()
+        view.flags.writeable = False
+        copy = writeable(view)
+        self.assertIsNot(copy, view)
+        self.assertTrue(copy.flags.writeable)
+        self.assertFalse(np.shares_memory(copy, array))
@@ -0,0 +1,87 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import copy
+from unittest import TestCase
+
+import torch
+import torch.nn as nn
+
+from mmdet.engine.hooks.mean_teacher_hook import ForeachEMA
+
+
+def reference_ema(student, teacher, momentum, skip_buffers):
+    """The per-tensor update ``ForeachEMA`` replaces."""
+    if skip_buffers:
+        pairs = zip(student.named_parameters(), teacher.named_parameters())
+    else:
+        pairs = zip(student.state_dict().items(),
+                    teacher.state_dict().items())
+    for (_, src), (_, dst) in pairs:
+        if dst.dtype.is_floating_point:
+            dst.data.mul_(1 - momentum).add_(src.data, alpha=momentum)
+
+
+class TestForeachEMA(TestCase):
+
+    def _models(self):
+        torch.manual_seed(0)
+        student = nn.Sequential(
+            nn.Conv2d(3, 4, 3), nn.BatchNorm2d(4), nn.Linear(2, 2))
+        teacher = copy.deepcopy(student)
+        for param in teacher.parameters():
+            param.data.normal_()
+        # buffers of the student differ from the teacher
+        student[1].running_mean.fill_(1.)
+        student[1].running_var.fill_(2.)
+        student[1].num_batches_tracked.fill_(7)
+        return student, teacher
+
+    def _assert_equal_state(self, model, expected):
+        for (key, value), (_, other) in zip(model.state_dict().items(),
+                                            expected.state_dict().items()):
+            self.assertTrue(torch.allclose(value, other), key)
+
+    def test_update(self):
+        for skip_buffers in (True, False):
+            student, teacher = self._models()
+            expected = copy.deepcopy(teacher)
+            ema = ForeachEMA(student, teacher, skip_buffers=skip_buffers)
+            for momentum in (0.1, 0.5, 0.0002):
+                ema.update(momentum)
+                ema.wait()
+                reference_ema(student, expected, momentum, skip_buffers)
+            self._assert_equal_state(teacher, expected)
+
+    def test_skip_buffers(self):
+        student, teacher = self._models()
+        running_mean = teacher[1].running_mean.clone()
+        ForeachEMA(student, teacher, skip_buffers=True).update(0.5)
+        self.assertTrue(torch.equal(teacher[1].running_mean, running_mean))
+
+        student, teacher = self._models()
+        ForeachEMA(student, teacher, skip_buffers=False).update(0.5)
+        self.assertTrue(
+            torch.allclose(teacher[1].running_mean, torch.full((4, ), 0.5)))
+        # integer buffers are never averaged
+        self.assertEqual(teacher[1].num_batches_tracked.item(), 0)
+
+    def test_tracks_student(self):
+        # the tensors are bound once, later student updates are followed
+        student, teacher = self._models()
+        ema = ForeachEMA(student, teacher)
+        for param in student.parameters():
+            param.data.fill_(3.)
+        ema.update(1.)
+        for param in teacher.parameters():
+            self.assertTrue(torch.equal(param, torch.full_like(param, 3.)))
+
+    def test_side_stream(self):
+        if not torch.cuda.is_available():
+            return
+        student, teacher = self._models()
+        student, teacher = student.cuda(), teacher.cuda()
+        expected = copy.deepcopy(teacher)
+        ema = ForeachEMA(student, teacher, side_stream=True)
+        ema.update(0.5)
+        ema.wait()
+        reference_ema(student, expected, 0.5, True)
+        self._assert_equal_state(teacher, expected)
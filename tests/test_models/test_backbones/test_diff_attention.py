@@ -0,0 +1,99 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from unittest import TestCase
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from mmdet.models.backbones.diff.src.archs.stable_diffusion.attention import (
+    ChunkedAttnProcessor, merge_tokens, set_attention_backend)
+
+
+class SelfAttention(nn.Module):
+    """The attributes of a diffusers ``Attention`` the processors use."""
+
+    def __init__(self, channels=16, heads=2):
+        super().__init__()
+        self.heads = heads
+        self.spatial_norm = None
+        self.group_norm = None
+        self.norm_cross = False
+        self.residual_connection = False
+        self.rescale_output_factor = 1.0
+        self.to_q = nn.Linear(channels, channels, bias=False)
+        self.to_k = nn.Linear(channels, channels, bias=False)
+        self.to_v = nn.Linear(channels, channels, bias=False)
+        self.to_out = nn.ModuleList(
+            [nn.Linear(channels, channels),
+             nn.Dropout(0.0)])
+
+    def full_attention(self, hidden_states):
+        """Reference SDPA over all tokens at once."""
+        batch_size, seq_len, channels = hidden_states.shape
+        head_dim = channels // self.heads
+
+        def heads(x):
+            return x.view(batch_size, -1, self.heads,
+                          head_dim).transpose(1, 2)
+
+        out = F.scaled_dot_product_attention(
+            heads(self.to_q(hidden_states)), heads(self.to_k(hidden_states)),
+            heads(self.to_v(hidden_states)))
+        out = out.transpose(1, 2).reshape(batch_size, seq_len, channels)
+        return self.to_out[0](out)
+
+
+class TestChunkedAttnProcessor(TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.attn = SelfAttention().eval()
+        self.hidden_states = torch.randn(2, 23, 16)
+
+    @torch.no_grad()
+    def test_chunks(self):
+        expected = self.attn.full_attention(self.hidden_states)
+        for chunk_size in (None, 5, 23, 64):
+            processor = ChunkedAttnProcessor(chunk_size=chunk_size)
+            out = processor(self.attn, self.hidden_states)
+            self.assertTrue(torch.allclose(out, expected, atol=1e-6))
+
+    @torch.no_grad()
+    def test_no_merge(self):
+        expected = self.attn.full_attention(self.hidden_states)
+        processor = ChunkedAttnProcessor(
+            chunk_size=5, merge_ratio=0.0, merge_min_tokens=0)
+        out = processor(self.attn, self.hidden_states)
+        self.assertTrue(torch.allclose(out, expected, atol=1e-6))
+
+    @torch.no_grad()
+    def test_merge_duplicates(self):
+        # tokens repeated in groups of the merge stride merge into their
+        # group, proportional attention then matches the full attention
+        hidden_states = torch.randn(2, 8, 16).repeat_interleave(4, dim=1)
+        expected = self.attn.full_attention(hidden_states)
+        for chunk_size in (None, 7):
+            processor = ChunkedAttnProcessor(
+                chunk_size=chunk_size,
+                merge_ratio=0.75,
+                merge_stride=4,
+                merge_min_tokens=0)
+            out = processor(self.attn, hidden_states)
+            self.assertTrue(torch.allclose(out, expected, atol=1e-5))
+
+    @torch.no_grad()
+    def test_merge_tokens(self):
+        x = torch.randn(2, 8, 16).repeat_interleave(4, dim=1)
+        merged, size = merge_tokens(x, 24, stride=4)
+        self.assertEqual(merged.shape, (2, 8, 16))
+        self.assertTrue(torch.equal(size, torch.full((2, 8), 4.)))
+        self.assertTrue(torch.allclose(merged, x[:, ::4], atol=1e-6))
+
+        # r is bounded by the number of source tokens
+        merged, size = merge_tokens(torch.randn(1, 10, 4), 100, stride=4)
+        self.assertEqual(merged.shape, (1, 3, 4))
+        self.assertEqual(size.sum().item(), 10)
+
+    def test_invalid_backend(self):
+        with self.assertRaisesRegex(ValueError, 'sliced'):
+            set_attention_backend(nn.Module(), backend='flash')
@@ -0,0 +1,63 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from unittest import TestCase
+
+import torch
+from mmengine.structures import InstanceData
+
+from mmdet.models.detectors.Z_diffusion_detector import bbox_to_mask
+from mmdet.structures import DetDataSample
+
+
+def _data_sample(bboxes, labels):
+    data_sample = DetDataSample()
+    data_sample.gt_instances = InstanceData(
+        bboxes=torch.tensor(bboxes, dtype=torch.float32).reshape(-1, 4),
+        labels=torch.tensor(labels, dtype=torch.long))
+    return data_sample
+
+
+class TestBboxToMask(TestCase):
+
+    class_names = ('car', 'bicycle', 'person')
+
+    def test_masks(self):
+        batch_data_samples = [
+            _data_sample([[1.7, 2.2, 4.9, 5.0], [3, 0, 6, 1]], [2, 0]),
+            _data_sample([[0, 0, 8, 6]], [1]),
+        ]
+        masks, _ = bbox_to_mask(batch_data_samples, 2, 6, 8,
+                                self.class_names)
+        self.assertEqual(masks.shape, (2, 6, 8))
+        self.assertEqual(masks.dtype, torch.bool)
+
+        # box corners are truncated, the far corners are exclusive
+        expected = torch.zeros(6, 8, dtype=torch.bool)
+        expected[2:5, 1:4] = True
+        expected[0:1, 3:6] = True
+        self.assertTrue(torch.equal(masks[0], expected))
+        self.assertTrue(masks[1].all())
+
+    def test_prompts(self):
+        batch_data_samples = [
+            _data_sample([[0, 0, 1, 1], [0, 0, 2, 2], [1, 1, 2, 2]],
+                         [2, 0, 2]),
+            _data_sample([[0, 0, 1, 1]], [1]),
+            _data_sample([], []),
+        ]
+        masks, prompts = bbox_to_mask(batch_data_samples, 3, 4, 4,
+                                      self.class_names)
+        # sorted and deduplicated class names, empty for no boxes
+        self.assertEqual(
+            prompts, ['A photo of car, person', 'A photo of bicycle', ''])
+        self.assertFalse(masks[2].any())
+
+    def test_first_n(self):
+        batch_data_samples = [
+            _data_sample([[0, 0, 2, 2]], [0]),
+            _data_sample([[0, 0, 4, 4]], [1]),
+        ]
+        masks, prompts = bbox_to_mask(batch_data_samples, 1, 4, 4,
+                                      self.class_names)
+        self.assertEqual(masks.shape, (1, 4, 4))
+        self.assertEqual(prompts, ['A photo of car'])
+        self.assertEqual(int(masks.sum()), 4)
@@ -0,0 +1,62 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from unittest import TestCase
+
+import torch
+from mmengine.structures import InstanceData, PixelData
+
+from mmdet.models.utils import class_agnostic_data_samples
+from mmdet.structures import DetDataSample
+
+
+class TestClassAgnosticDataSamples(TestCase):
+
+    def _data_sample(self):
+        data_sample = DetDataSample(
+            metainfo=dict(img_shape=(32, 32), img_path='a.jpg'))
+        gt_instances = InstanceData(metainfo=dict(img_shape=(32, 32)))
+        gt_instances.bboxes = torch.rand(3, 4)
+        gt_instances.labels = torch.tensor([2, 0, 5])
+        data_sample.gt_instances = gt_instances
+        data_sample.gt_sem_seg = PixelData(sem_seg=torch.zeros(1, 32, 32))
+        return data_sample
+
+    def test_labels_zeroed(self):
+        data_sample = self._data_sample()
+        views = class_agnostic_data_samples([data_sample])
+        self.assertEqual(len(views), 1)
+        view = views[0]
+        self.assertIsInstance(view, DetDataSample)
+        self.assertTrue(
+            torch.equal(view.gt_instances.labels, torch.zeros(3).long()))
+        self.assertEqual(view.gt_instances.labels.dtype,
+                         data_sample.gt_instances.labels.dtype)
+
+    def test_fields_shared(self):
+        data_sample = self._data_sample()
+        view = class_agnostic_data_samples([data_sample])[0]
+        self.assertEqual(view.metainfo, data_sample.metainfo)
+        self.assertEqual(view.gt_instances.img_shape, (32, 32))
+        self.assertIs(view.gt_instances.bboxes,
+                      data_sample.gt_instances.bboxes)
+        self.assertIs(view.gt_sem_seg, data_sample.gt_sem_seg)
+
+    def test_original_untouched(self):
+        data_sample = self._data_sample()
+        view = class_agnostic_data_samples([data_sample])[0]
+        self.assertIsNot(view, data_sample)
+        self.assertIsNot(view.gt_instances, data_sample.gt_instances)
+        self.assertTrue(
+            torch.equal(data_sample.gt_instances.labels,
+                        torch.tensor([2, 0, 5])))
+        # reassigning a field of the view leaves the original as it is
+        view.gt_instances.bboxes = torch.zeros(3, 4)
+        view.set_metainfo(dict(img_shape=(16, 16)))
+        self.assertFalse(
+            torch.equal(data_sample.gt_instances.bboxes, torch.zeros(3, 4)))
+        self.assertEqual(data_sample.img_shape, (32, 32))
+
+    def test_without_gt_instances(self):
+        data_sample = DetDataSample(metainfo=dict(img_shape=(8, 8)))
+        view = class_agnostic_data_samples([data_sample])[0]
+        self.assertNotIn('gt_instances', view)
+        self.assertEqual(view.img_shape, (8, 8))
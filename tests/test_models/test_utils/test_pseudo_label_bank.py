@@ -0,0 +1,131 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import tempfile
+from types import SimpleNamespace
+from unittest import TestCase
+
+import numpy as np
+import torch
+from mmengine.structures import InstanceData
+
+from mmdet.models.detectors.Z_diff_semi_base import SemiBaseDiffDetector
+from mmdet.models.utils import PseudoLabelBank, PseudoLabelBankWriter
+from mmdet.structures import DetDataSample
+
+# the original image is 40x60 (h, w), the bank features were computed on
+# it resized by 0.5 and padded to 32x32, at strides 2 and 4
+ORI_SHAPE = (40, 60)
+BANK_SCALE = 0.5
+BANK_PAD_SHAPE = (32, 32)
+STRIDES = (2, 4)
+
+
+def _coordinate_feature(stride):
+    """Feature whose channels are the original image (x, y) of the centre
+    of each cell, linear so that bilinear sampling is exact."""
+    h, w = BANK_PAD_SHAPE[0] // stride, BANK_PAD_SHAPE[1] // stride
+    ys, xs = torch.meshgrid(
+        (torch.arange(h) + 0.5) * stride, (torch.arange(w) + 0.5) * stride,
+        indexing='ij')
+    return torch.stack([xs, ys]) / BANK_SCALE
+
+
+def _view_homography(flip):
+    """Resize by 0.75 to 30x45, crop 24x32 at (6, 3), optionally flip, with
+    the homography conventions of the mmdet transforms."""
+    resize = np.diag([0.75, 0.75, 1.])
+    crop = np.array([[1., 0., -6.], [0., 1., -3.], [0., 0., 1.]])
+    homography = crop @ resize
+    if flip:
+        homography = np.array([[-1., 0., 32.], [0., 1., 0.], [0., 0., 1.]
+                               ]) @ homography
+    return homography.astype(np.float32)
+
+
+def _view(flip):
+    return DetDataSample(
+        metainfo=dict(
+            img_path='a.jpg',
+            ori_shape=ORI_SHAPE,
+            img_shape=(24, 32),
+            batch_input_shape=(24, 32),
+            homography_matrix=_view_homography(flip)))
+
+
+class TestPseudoLabelBank(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        writer = PseudoLabelBankWriter(
+            self.tmp_dir.name, meta=dict(), with_features=True)
+        for img_path, bboxes in (('b.jpg', [[1., 1., 5., 5.]]),
+                                 ('a.jpg', [[10., 8., 30., 20.],
+                                            [0., 0., 12., 8.]])):
+            instances = InstanceData(
+                bboxes=torch.tensor(bboxes),
+                scores=torch.full((len(bboxes), ), 0.9),
+                labels=torch.arange(len(bboxes)))
+            writer.add(
+                img_path,
+                instances,
+                feats=[_coordinate_feature(stride) for stride in STRIDES],
+                scale_factor=(BANK_SCALE, BANK_SCALE),
+                pad_shape=BANK_PAD_SHAPE)
+        writer.close()
+        self.bank = PseudoLabelBank(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_instances(self):
+        self.assertEqual(len(self.bank), 2)
+        instances = self.bank.get_instances('a.jpg', 'cpu')
+        self.assertTrue(
+            torch.equal(instances.bboxes,
+                        torch.tensor([[10., 8., 30., 20.], [0., 0., 12.,
+                                                            8.]])))
+        self.assertTrue(torch.equal(instances.labels, torch.tensor([0, 1])))
+        with self.assertRaises(KeyError):
+            self.bank.get_instances('c.jpg', 'cpu')
+
+    def test_features(self):
+        views = [_view(flip=False), _view(flip=True)]
+        feats = self.bank.get_features(views, 'cpu')
+        self.assertEqual(len(feats), len(STRIDES))
+        for feat, stride in zip(feats, STRIDES):
+            out_h, out_w = 24 // stride, 32 // stride
+            self.assertEqual(feat.shape, (2, 2, out_h, out_w))
+            for view, view_feat in zip(views, feat):
+                # the original (x, y) of the centre of every view cell
+                ys, xs = np.meshgrid((np.arange(out_h) + 0.5) * stride,
+                                     (np.arange(out_w) + 0.5) * stride,
+                                     indexing='ij')
+                points = np.stack([xs, ys, np.ones_like(xs)]).reshape(3, -1)
+                ori_points = np.linalg.inv(
+                    view.homography_matrix.astype(np.float64)) @ points
+                expected = torch.from_numpy(ori_points[:2].reshape(
+                    2, out_h, out_w)).float()
+                # the bank stores float16 features
+                self.assertTrue(torch.allclose(view_feat, expected, atol=0.05))
+
+    def test_projected_instances(self):
+        # boxes a teacher predicts on each view, i.e. the boxes of the
+        # original image resized, cropped (and clipped) and flipped
+        online_bboxes = [
+            torch.tensor([[1.5, 3., 16.5, 12.], [0., 0., 3., 3.]]),
+            torch.tensor([[15.5, 3., 30.5, 12.], [29., 0., 32., 3.]])
+        ]
+        views = [_view(flip=False), _view(flip=True)]
+        pseudo_instances = []
+        for view in views:
+            pseudo_instance = DetDataSample()
+            pseudo_instance.gt_instances = self.bank.get_instances(
+                view.img_path, 'cpu')
+            pseudo_instances.append(pseudo_instance)
+        detector = SimpleNamespace(
+            data_preprocessor=SimpleNamespace(device='cpu'),
+            semi_train_cfg=dict())
+        views = SemiBaseDiffDetector.project_pseudo_instances(
+            detector, pseudo_instances, views)
+        for view, bboxes in zip(views, online_bboxes):
+            self.assertTrue(
+                torch.allclose(view.gt_instances.bboxes, bboxes, atol=1e-4))
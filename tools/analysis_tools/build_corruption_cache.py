@@ -0,0 +1,156 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+"""Build the corrupted test images of the corruption benchmark.
+
+Every test image is corrupted once per corruption and severity, resized
+with the ``Resize`` of the test pipeline and written to the image shard
+cache ``<out>/<corruption>/<severity>``. ``test_robustness.py
+--corruption-cache <out>`` then evaluates these variants instead of
+corrupting the images on the fly. Images are corrupted in a process pool,
+with the random state of each image seeded from ``--seed``, the corruption,
+the severity and the image path, so the cache does not depend on
+``--nproc``. Variants already in the cache are skipped, an interrupted run
+is continued by starting it again.
+
+Example:
+    python tools/analysis_tools/build_corruption_cache.py \
+        DG/_base_/datasets/domain_generalization/test_cityscapes.py \
+        --corruptions benchmark --out data/corruption_cache/cityscapes
+"""
+import argparse
+import os
+import os.path as osp
+import shutil
+import zlib
+from multiprocessing import Pool
+
+import mmcv
+import numpy as np
+from mmengine.config import Config
+from mmengine.fileio import get
+from mmengine.registry import init_default_scope
+from mmengine.utils import ProgressBar
+
+from mmdet.datasets.transforms.image_cache import (ImageShardCacheWriter,
+                                                   encode_image)
+from mmdet.datasets.transforms.transforms import Corrupt
+from mmdet.registry import DATASETS
+from tools.analysis_tools.test_robustness import get_corruptions
+from tools.misc.build_image_cache import find_transform
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Build the corrupted test images of a config')
+    parser.add_argument('config', help='test config file path')
+    parser.add_argument('--out', required=True, help='cache directory')
+    parser.add_argument(
+        '--corruptions',
+        type=str,
+        nargs='+',
+        default=['benchmark'],
+        help='corruptions or corruption groups, as in test_robustness.py')
+    parser.add_argument(
+        '--severities',
+        type=int,
+        nargs='+',
+        default=[1, 2, 3, 4, 5],
+        help='corruption severity levels')
+    parser.add_argument(
+        '--format',
+        default='png',
+        choices=['raw', 'png', 'jpeg'],
+        help='storage of the corrupted images, JPEG changes the corruption')
+    parser.add_argument('--quality', type=int, default=95)
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--nproc', type=int, default=8)
+    return parser.parse_args()
+
+
+def corrupt_and_resize(args):
+    img_path, load, resize, corruption, severity, image_format, quality, \
+        seed = args
+    np.random.seed(
+        zlib.crc32(f'{seed}/{corruption}/{severity}/{img_path}'.encode()))
+    img = mmcv.imfrombytes(
+        get(img_path, backend_args=load.get('backend_args')),
+        flag=load.get('color_type', 'color'),
+        backend=load.get('imdecode_backend', 'cv2'))
+    ori_shape = img.shape[:2]
+    img = Corrupt(corruption, severity).transform(dict(img=img))['img']
+    if resize['keep_ratio']:
+        img = mmcv.imrescale(
+            img,
+            resize['scale'],
+            interpolation=resize['interpolation'],
+            backend=resize['backend'])
+    else:
+        img = mmcv.imresize(
+            img,
+            resize['scale'],
+            interpolation=resize['interpolation'],
+            backend=resize['backend'])
+    return img_path, encode_image(img, image_format,
+                                  quality), img.shape, ori_shape
+
+
+def main():
+    args = parse_args()
+
+    cfg = Config.fromfile(args.config)
+    init_default_scope(cfg.get('default_scope', 'mmdet'))
+    dataset_cfg = cfg.test_dataloader.dataset
+    load = find_transform(dataset_cfg, 'LoadImageFromFile')
+    resize = find_transform(dataset_cfg, 'Resize')
+    assert load is not None and resize is not None, \
+        f'{args.config} does not load and resize its images'
+    resize = dict(
+        type='Resize',
+        scale=list(resize['scale']),
+        keep_ratio=resize.get('keep_ratio', False),
+        interpolation=resize.get('interpolation', 'bilinear'),
+        backend=resize.get('backend', 'cv2'))
+    dataset = DATASETS.build(dataset_cfg)
+    img_paths = list(
+        dict.fromkeys(
+            dataset.get_data_info(i)['img_path']
+            for i in range(len(dataset))))
+
+    variants = [(corruption, severity)
+                for corruption in get_corruptions(args.corruptions)
+                if corruption != 'None'
+                for severity in args.severities if severity > 0]
+    with Pool(args.nproc) as pool:
+        for corruption, severity in variants:
+            root = osp.join(args.out, corruption, str(severity))
+            if osp.exists(osp.join(root, 'meta.json')):
+                print(f'{corruption} at severity {severity} is cached')
+                continue
+            print(f'\nCorrupting with {corruption} at severity {severity}')
+            # written aside and renamed, an interrupted variant is rebuilt
+            tmp_root = f'{root}.tmp'
+            shutil.rmtree(tmp_root, ignore_errors=True)
+            writer = ImageShardCacheWriter(
+                tmp_root,
+                resize=resize,
+                format=args.format,
+                quality=args.quality,
+                color_type=load.get('color_type', 'color'))
+            writer.meta.update(
+                corruption=corruption, severity=severity, seed=args.seed)
+            progress_bar = ProgressBar(len(img_paths))
+            tasks = [(img_path, dict(load), resize, corruption, severity,
+                      args.format, args.quality, args.seed)
+                     for img_path in img_paths]
+            for img_path, record, shape, ori_shape in pool.imap(
+                    corrupt_and_resize, tasks, chunksize=4):
+                writer.add(img_path, record, shape, ori_shape)
+                progress_bar.update()
+            writer.close()
+            shutil.rmtree(root, ignore_errors=True)
+            os.rename(tmp_root, root)
+    print(f'\n{len(variants)} variants of {len(img_paths)} images -> '
+          f'{args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,13 +3,16 @@ import argparse
 import copy
 import os
 import os.path as osp
+import warnings
 
 from mmengine.config import Config, DictAction
+from mmengine.dataset import Compose
 from mmengine.dist import get_dist_info
 from mmengine.evaluator import DumpResults
-from mmengine.fileio import dump
+from mmengine.fileio import dump, load
 from mmengine.runner import Runner
 
+from mmdet.datasets.transforms.image_cache import ImageShardCache
 from mmdet.engine.hooks.utils import trigger_visualization_hook
 from mmdet.registry import RUNNERS
 from tools.analysis_tools.robustness_eval import get_results
@@ -46,6 +49,16 @@ def parse_args():
         nargs='+',
         default=[0, 1, 2, 3, 4, 5],
         help='corruption severity levels')
+    parser.add_argument(
+        '--corruption-cache',
+        help='root of the corrupted test images, see '
+        'tools/analysis_tools/build_corruption_cache.py. Variants missing '
+        'from it are corrupted on the fly')
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='skip the corruptions and severities already in the results '
+        'file of "--out"')
     parser.add_argument(
         '--summaries',
         type=bool,
@@ -92,12 +105,71 @@ def parse_args():
     return args
 
 
+def is_cached(cache_root, dataset, corruption, severity):
+    """Whether the image cache at ``cache_root`` holds every image of
+    ``dataset`` with ``corruption`` at ``severity``.
+
+    Raises a ValueError if the cache holds another corruption variant.
+    """
+    if not osp.exists(osp.join(cache_root, 'meta.json')):
+        return False
+    cache = ImageShardCache(cache_root)
+    cached = (cache.meta.get('corruption'), cache.meta.get('severity'))
+    if cached != (corruption, severity):
+        raise ValueError(
+            f'{cache_root} holds {cached[0]} at severity {cached[1]}, not '
+            f'{corruption} at severity {severity}')
+    return all(
+        dataset.get_data_info(i)['img_path'] in cache
+        for i in range(len(dataset)))
+
+
+def get_corruptions(names):
+    """Corruptions of the ``--corruptions`` names, expanding the groups."""
+    if 'all' in names:
+        corruptions = [
+            'gaussian_noise', 'shot_noise', 'impulse_noise', 'defocus_blur',
+            'glass_blur', 'motion_blur', 'zoom_blur', 'snow', 'frost', 'fog',
+            'brightness', 'contrast', 'elastic_transform', 'pixelate',
+            'jpeg_compression', 'speckle_noise', 'gaussian_blur', 'spatter',
+            'saturate'
+        ]
+    elif 'benchmark' in names:
+        corruptions = [
+            'gaussian_noise', 'shot_noise', 'impulse_noise', 'defocus_blur',
+            'glass_blur', 'motion_blur', 'zoom_blur', 'snow', 'frost', 'fog',
+            'brightness', 'contrast', 'elastic_transform', 'pixelate',
+            'jpeg_compression'
+        ]
+    elif 'noise' in names:
+        corruptions = ['gaussian_noise', 'shot_noise', 'impulse_noise']
+    elif 'blur' in names:
+        corruptions = [
+            'defocus_blur', 'glass_blur', 'motion_blur', 'zoom_blur'
+        ]
+    elif 'weather' in names:
+        corruptions = ['snow', 'frost', 'fog', 'brightness']
+    elif 'digital' in names:
+        corruptions = [
+            'contrast', 'elastic_transform', 'pixelate', 'jpeg_compression'
+        ]
+    elif 'holdout' in names:
+        corruptions = ['speckle_noise', 'gaussian_blur', 'spatter', 'saturate']
+    elif 'None' in names:
+        corruptions = ['None']
+    else:
+        corruptions = list(names)
+    return corruptions
+
+
 def main():
     args = parse_args()
 
     assert args.out or args.show or args.show_dir, \
         ('Please specify at least one operation (save or show the results) '
          'with the argument "--out", "--show" or "show-dir"')
+    assert args.out or not args.resume, \
+        'resuming needs the results file of "--out"'
 
     # load config
     cfg = Config.fromfile(args.config)
@@ -137,62 +209,63 @@ def main():
         runner.test_evaluator.metrics.append(
             DumpResults(out_file_path=args.out))
 
-    if 'all' in args.corruptions:
-        corruptions = [
-            'gaussian_noise', 'shot_noise', 'impulse_noise', 'defocus_blur',
-            'glass_blur', 'motion_blur', 'zoom_blur', 'snow', 'frost', 'fog',
-            'brightness', 'contrast', 'elastic_transform', 'pixelate',
-            'jpeg_compression', 'speckle_noise', 'gaussian_blur', 'spatter',
-            'saturate'
-        ]
-    elif 'benchmark' in args.corruptions:
-        corruptions = [
-            'gaussian_noise', 'shot_noise', 'impulse_noise', 'defocus_blur',
-            'glass_blur', 'motion_blur', 'zoom_blur', 'snow', 'frost', 'fog',
-            'brightness', 'contrast', 'elastic_transform', 'pixelate',
-            'jpeg_compression'
-        ]
-    elif 'noise' in args.corruptions:
-        corruptions = ['gaussian_noise', 'shot_noise', 'impulse_noise']
-    elif 'blur' in args.corruptions:
-        corruptions = [
-            'defocus_blur', 'glass_blur', 'motion_blur', 'zoom_blur'
-        ]
-    elif 'weather' in args.corruptions:
-        corruptions = ['snow', 'frost', 'fog', 'brightness']
-    elif 'digital' in args.corruptions:
-        corruptions = [
-            'contrast', 'elastic_transform', 'pixelate', 'jpeg_compression'
-        ]
-    elif 'holdout' in args.corruptions:
-        corruptions = ['speckle_noise', 'gaussian_blur', 'spatter', 'saturate']
-    elif 'None' in args.corruptions:
-        corruptions = ['None']
+    if 'None' in args.corruptions:
         args.severities = [0]
-    else:
-        corruptions = args.corruptions
+    corruptions = get_corruptions(args.corruptions)
 
+    eval_results_filename = None
     aggregated_results = {}
+    if args.out:
+        eval_results_filename = (
+            osp.splitext(args.out)[0] + '_results' + osp.splitext(args.out)[1])
+        if args.resume and osp.exists(eval_results_filename):
+            aggregated_results = load(eval_results_filename)
+            print(f'Resuming from {eval_results_filename}')
+
+    # the annotations are loaded once, every variant only swaps the pipeline
+    dataset = runner.test_loop.dataloader.dataset
     for corr_i, corruption in enumerate(corruptions):
-        aggregated_results[corruption] = {}
+        aggregated_results.setdefault(corruption, {})
         for sev_i, corruption_severity in enumerate(args.severities):
+            if corruption_severity in aggregated_results[corruption]:
+                print(f'\n{corruption} at severity {corruption_severity} '
+                      'is already evaluated')
+                continue
             # evaluate severity 0 (= no corruption) only once
             if corr_i > 0 and corruption_severity == 0:
                 aggregated_results[corruption][0] = \
                     aggregated_results[corruptions[0]][0]
                 continue
 
-            test_loader_cfg = copy.deepcopy(cfg.test_dataloader)
+            pipeline = copy.deepcopy(cfg.test_dataloader.dataset.pipeline)
             # assign corruption and severity
             if corruption_severity > 0:
-                corruption_trans = dict(
-                    type='Corrupt',
-                    corruption=corruption,
-                    severity=corruption_severity)
-                # TODO: hard coded "1", we assume that the first step is
-                # loading images, which needs to be fixed in the future
-                test_loader_cfg.dataset.pipeline.insert(1, corruption_trans)
+                cache_root = None
+                if args.corruption_cache is not None:
+                    cache_root = osp.join(args.corruption_cache, corruption,
+                                          str(corruption_severity))
+                # TODO: hard coded "0" and "1", we assume that the first step
+                # is loading images, which needs to be fixed in the future
+                if cache_root is not None and is_cached(
+                        cache_root, dataset, corruption, corruption_severity):
+                    pipeline[0] = dict(
+                        pipeline[0],
+                        type='LoadImageFromCache',
+                        cache_root=cache_root)
+                else:
+                    if cache_root is not None:
+                        warnings.warn(f'{cache_root} does not hold all test '
+                                      'images, they are corrupted on the fly')
+                    pipeline.insert(
+                        1,
+                        dict(
+                            type='Corrupt',
+                            corruption=corruption,
+                            severity=corruption_severity))
+            dataset.pipeline = Compose(pipeline)
 
+            test_loader_cfg = copy.deepcopy(cfg.test_dataloader)
+            test_loader_cfg.dataset = dataset
             test_loader = runner.build_dataloader(test_loader_cfg)
 
             runner.test_loop.dataloader = test_loader
@@ -205,17 +278,12 @@ def main():
 
             eval_results = runner.test()
             if args.out:
-                eval_results_filename = (
-                    osp.splitext(args.out)[0] + '_results' +
-                    osp.splitext(args.out)[1])
                 aggregated_results[corruption][
                     corruption_severity] = eval_results
                 dump(aggregated_results, eval_results_filename)
 
     rank, _ = get_dist_info()
     if rank == 0:
-        eval_results_filename = (
-            osp.splitext(args.out)[0] + '_results' + osp.splitext(args.out)[1])
         # print final results
         print('\nAggregated results:')
         prints = args.final_prints
@@ -0,0 +1,120 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+"""Populate the on-disk feature store of a ``DiffusionDetector``.
+
+The frozen diffusion features of every test image are computed once and
+written to the store, later evaluations with ``--feature-store`` start from
+the aggregation network. Run it with ``--launcher pytorch`` under
+``torch.distributed.launch`` to shard the images across GPUs, each rank
+decoding with ``--num-workers`` dataloader workers.
+
+Example:
+    python tools/misc/build_diffusion_feature_store.py \
+        DG/Ours/cityscapes/diffusion_detector_cityscapes.py \
+        --store work_dirs/feature_store \
+        --test-configs \
+            DG/_base_/datasets/domain_generalization/test_cityscapes.py \
+            DG/_base_/datasets/domain_generalization/test_bdd100k.py
+"""
+import argparse
+import os
+
+import torch
+from mmengine.config import Config, DictAction
+from mmengine.device import get_device
+from mmengine.dist import get_dist_info, init_dist
+from mmengine.registry import init_default_scope
+from mmengine.runner import Runner
+from mmengine.utils import ProgressBar
+
+from mmdet.models.backbones.diff.src.archs.feature_store import (
+    DiffusionFeatureStore, pipeline_hash)
+from mmdet.registry import MODELS
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Build the diffusion feature store of a DIFF backbone')
+    parser.add_argument('config', help='DiffusionDetector config file path')
+    parser.add_argument('--store', required=True, help='feature store root')
+    parser.add_argument(
+        '--test-configs',
+        nargs='+',
+        required=True,
+        help='test dataset configs whose images are stored')
+    parser.add_argument(
+        '--num-workers',
+        type=int,
+        default=None,
+        help='dataloader workers per rank, defaults to the test config')
+    parser.add_argument(
+        '--cfg-options',
+        nargs='+',
+        action=DictAction,
+        help='override some settings in the used config, the key-value pair '
+        'in xxx=yyy format will be merged into config file.')
+    parser.add_argument(
+        '--launcher',
+        choices=['none', 'pytorch', 'slurm', 'mpi'],
+        default='none',
+        help='job launcher')
+    parser.add_argument('--local_rank', '--local-rank', type=int, default=0)
+    args = parser.parse_args()
+    if 'LOCAL_RANK' not in os.environ:
+        os.environ['LOCAL_RANK'] = str(args.local_rank)
+    return args
+
+
+def main():
+    args = parse_args()
+
+    cfg = Config.fromfile(args.config)
+    if args.cfg_options is not None:
+        cfg.merge_from_dict(args.cfg_options)
+    assert cfg.model.type == 'DiffusionDetector', \
+        'the feature store is built for DiffusionDetector configs'
+    init_default_scope(cfg.get('default_scope', 'mmdet'))
+    if args.launcher != 'none':
+        init_dist(args.launcher)
+    rank, _ = get_dist_info()
+
+    # the stored features do not depend on the trained weights, only on the
+    # frozen Stable Diffusion model, so no checkpoint is loaded
+    model = MODELS.build(cfg.model)
+    model.to(get_device())
+    model.eval()
+    diff_config = cfg.model.backbone.diff_config
+    extractor = model.backbone.diff_model.diffusion_extractor
+
+    for test_config in args.test_configs:
+        test_cfg = Config.fromfile(test_config)
+        dataloader_cfg = test_cfg.test_dataloader
+        if args.num_workers is not None:
+            dataloader_cfg.num_workers = args.num_workers
+            dataloader_cfg.persistent_workers = args.num_workers > 0
+
+        extractor.feature_store = DiffusionFeatureStore(
+            root=args.store,
+            model_id=diff_config['model_id'],
+            idxs_resnet=extractor.idxs_resnet,
+            idxs_ca=extractor.idxs_ca,
+            save_timestep=extractor.save_timestep,
+            scheduler_timesteps=diff_config['scheduler_timesteps'],
+            pipeline_hash=pipeline_hash(dataloader_cfg.dataset.pipeline),
+            settings=extractor.feature_store_settings(diff_config))
+        if rank == 0:
+            print(f'{test_config} -> {extractor.feature_store.root}')
+
+        dataloader = Runner.build_dataloader(dataloader_cfg)
+        progress_bar = ProgressBar(len(dataloader)) if rank == 0 else None
+        for data in dataloader:
+            with torch.no_grad():
+                data = model.data_preprocessor(data, False)
+                store_keys = model.backbone.feature_store_keys(
+                    data['data_samples'])
+                model.backbone(data['inputs'], store_keys=store_keys)
+            if progress_bar is not None:
+                progress_bar.update()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+"""Build an image shard cache of the images of dataset configs.
+
+Every image of the ``--split`` dataset of each config is decoded once,
+resized with the ``Resize`` of its pipeline and written to the shards of
+one cache. Pipelines then load them with
+``dict(type='LoadImageFromCache', cache_root=...)`` in place of
+``LoadImageFromFile``, see also ``tools/test_dg.py --image-cache``.
+
+Images are stored as lossless PNG by default, so cached evaluation sees
+the pixels of the uncached one. ``--format raw`` is faster to read but
+larger, ``--format jpeg`` is smallest but lossy: cached results then differ
+slightly from uncached ones.
+
+Example:
+    python tools/misc/build_image_cache.py \
+        DG/_base_/datasets/domain_generalization/test_cityscapes.py \
+        DG/_base_/datasets/domain_generalization/test_bdd100k.py \
+        DG/_base_/datasets/domain_generalization/test_foggy_cityscapes.py \
+        --split test --out data/image_cache/city_test
+"""
+import argparse
+from multiprocessing import Pool
+
+import mmcv
+from mmengine.config import Config
+from mmengine.fileio import get
+from mmengine.registry import init_default_scope
+from mmengine.utils import ProgressBar
+
+from mmdet.datasets.transforms.image_cache import (ImageShardCacheWriter,
+                                                   encode_image)
+from mmdet.registry import DATASETS
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Build an image shard cache of dataset configs')
+    parser.add_argument('configs', nargs='+', help='config file paths')
+    parser.add_argument('--out', required=True, help='cache directory')
+    parser.add_argument(
+        '--split',
+        default='test',
+        choices=['train', 'val', 'test'],
+        help='dataloader whose images are cached')
+    parser.add_argument(
+        '--format',
+        default='png',
+        choices=['raw', 'png', 'jpeg'],
+        help='raw uint8 pixels, PNG or JPEG of the resized images, JPEG is '
+        'lossy')
+    parser.add_argument('--quality', type=int, default=95)
+    parser.add_argument('--nproc', type=int, default=8)
+    return parser.parse_args()
+
+
+def find_transform(cfg, transform_type):
+    """First transform of ``transform_type`` in a (nested) dataset config."""
+    if isinstance(cfg, dict):
+        if cfg.get('type') == transform_type:
+            return cfg
+        values = cfg.values()
+    elif isinstance(cfg, (list, tuple)):
+        values = cfg
+    else:
+        return None
+    for value in values:
+        found = find_transform(value, transform_type)
+        if found is not None:
+            return found
+    return None
+
+
+def load_and_resize(args):
+    img_path, load, resize, image_format, quality = args
+    img = mmcv.imfrombytes(
+        get(img_path, backend_args=load.get('backend_args')),
+        flag=load.get('color_type', 'color'),
+        backend=load.get('imdecode_backend', 'cv2'))
+    ori_shape = img.shape[:2]
+    if resize['keep_ratio']:
+        img = mmcv.imrescale(
+            img,
+            resize['scale'],
+            interpolation=resize['interpolation'],
+            backend=resize['backend'])
+    else:
+        img = mmcv.imresize(
+            img,
+            resize['scale'],
+            interpolation=resize['interpolation'],
+            backend=resize['backend'])
+    return img_path, encode_image(img, image_format,
+                                  quality), img.shape, ori_shape
+
+
+def main():
+    args = parse_args()
+
+    img_paths = []
+    load, resize = None, None
+    for config in args.configs:
+        cfg = Config.fromfile(config)
+        init_default_scope(cfg.get('default_scope', 'mmdet'))
+        dataset_cfg = cfg.get(f'{args.split}_dataloader').dataset
+        cfg_load = find_transform(dataset_cfg, 'LoadImageFromFile')
+        cfg_resize = find_transform(dataset_cfg, 'Resize')
+        assert cfg_load is not None and cfg_resize is not None, \
+            f'{config} does not load and resize its images'
+        cfg_resize = dict(
+            type='Resize',
+            scale=list(cfg_resize['scale']),
+            keep_ratio=cfg_resize.get('keep_ratio', False),
+            interpolation=cfg_resize.get('interpolation', 'bilinear'),
+            backend=cfg_resize.get('backend', 'cv2'))
+        if resize is None:
+            load, resize = cfg_load, cfg_resize
+        assert cfg_resize == resize, \
+            f'{config} resizes with {cfg_resize}, not {resize}'
+        dataset = DATASETS.build(dataset_cfg)
+        for i in range(len(dataset)):
+            img_paths.append(dataset.get_data_info(i)['img_path'])
+    # images shared by several datasets are stored once
+    img_paths = list(dict.fromkeys(img_paths))
+
+    writer = ImageShardCacheWriter(
+        args.out,
+        resize=resize,
+        format=args.format,
+        quality=args.quality,
+        color_type=load.get('color_type', 'color'))
+    progress_bar = ProgressBar(len(img_paths))
+    with Pool(args.nproc) as pool:
+        tasks = [(img_path, dict(load), resize, args.format, args.quality)
+                 for img_path in img_paths]
+        for img_path, record, shape, ori_shape in pool.imap(
+                load_and_resize, tasks, chunksize=16):
+            writer.add(img_path, record, shape, ori_shape)
+            progress_bar.update()
+    writer.close()
+    print(f'\n{len(writer.index)} images -> {args.out}')
+
+
+if __name__ == '__main__':
+    main()
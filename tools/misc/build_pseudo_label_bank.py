@@ -0,0 +1,124 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+"""Build the pseudo-label bank of a diffusion-guided adaptation config.
+
+The frozen diffusion detector of ``model.detector.diff_model`` predicts
+every image of ``unlabeled_dataset`` once, on the full image with the test
+pipeline. Training with ``semi_train_cfg.pseudo_label_bank`` then projects
+these detections onto the ``unsup_teacher`` views instead of running the
+diffusion detector. ``--with-features`` also stores the FPN features for
+the feature KD term (about 35MB per 1333x800 image).
+
+Example:
+    python tools/misc/build_pseudo_label_bank.py \
+        DA/Ours/city_to_foggy/diffuison_guided_adaptation_faster-rcnn_r101_fpn_city_to_foggy.py \
+        --out work_dirs/pseudo_label_bank/city_to_foggy
+"""
+import argparse
+
+import torch
+from mmengine.config import Config, DictAction
+from mmengine.device import get_device
+from mmengine.registry import init_default_scope
+from mmengine.runner import Runner, load_checkpoint
+from mmengine.utils import ProgressBar
+
+from mmdet.models.utils import PseudoLabelBankWriter
+from mmdet.registry import MODELS
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Build the pseudo-label bank of a diffusion detector')
+    parser.add_argument('config', help='adaptation config file path')
+    parser.add_argument('--out', required=True, help='bank directory')
+    parser.add_argument(
+        '--checkpoint',
+        default=None,
+        help='diffusion detector checkpoint, defaults to '
+        'model.detector.diff_model.pretrained_model')
+    parser.add_argument(
+        '--with-features',
+        action='store_true',
+        help='also store the FPN features of every image')
+    parser.add_argument(
+        '--score-thr',
+        type=float,
+        default=0.0,
+        help='drop detections below this score')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--num-workers', type=int, default=4)
+    parser.add_argument(
+        '--cfg-options',
+        nargs='+',
+        action=DictAction,
+        help='override some settings in the used config, the key-value pair '
+        'in xxx=yyy format will be merged into config file.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    cfg = Config.fromfile(args.config)
+    if args.cfg_options is not None:
+        cfg.merge_from_dict(args.cfg_options)
+    init_default_scope(cfg.get('default_scope', 'mmdet'))
+
+    diff_model = cfg.model.detector.diff_model
+    assert diff_model.config, \
+        'the bank is built from model.detector.diff_model.config'
+    checkpoint = args.checkpoint or diff_model.get('pretrained_model')
+    teacher_cfg = Config.fromfile(diff_model.config)
+    model = MODELS.build(teacher_cfg.model)
+    if checkpoint:
+        load_checkpoint(model, checkpoint, map_location='cpu')
+    model.to(get_device())
+    model.eval()
+
+    # full images with the test pipeline, not the augmented training views
+    dataset = cfg.unlabeled_dataset.copy()
+    dataset.pipeline = cfg.test_pipeline
+    dataloader = Runner.build_dataloader(
+        dict(
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            persistent_workers=False,
+            sampler=dict(type='DefaultSampler', shuffle=False),
+            dataset=dataset))
+
+    writer = PseudoLabelBankWriter(
+        args.out,
+        meta=dict(
+            config=diff_model.config,
+            checkpoint=checkpoint,
+            score_thr=args.score_thr,
+            classes=list(dataloader.dataset.metainfo['classes'])),
+        with_features=args.with_features)
+    progress_bar = ProgressBar(len(dataloader.dataset))
+    for data in dataloader:
+        with torch.no_grad():
+            data = model.data_preprocessor(data, False)
+            results_list, feats = model.predict(
+                data['inputs'],
+                data['data_samples'],
+                rescale=True,
+                return_feature=True)
+        for i, results in enumerate(results_list):
+            progress_bar.update()
+            # a repeated or concatenated dataset lists images more than once
+            if results.img_path in writer.index:
+                continue
+            instances = results.pred_instances
+            instances = instances[instances.scores >= args.score_thr]
+            writer.add(
+                results.img_path,
+                instances,
+                feats=[feat[i] for feat in feats],
+                scale_factor=results.scale_factor,
+                pad_shape=results.batch_input_shape)
+    writer.close()
+    print(f'\n{len(writer.index)} images -> {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+"""Options of ``tools/test_dg.py`` and ``tools/test_dg_coco.py`` to test
+the target domains of a config with one model load, from an image shard
+cache and with a diffusion feature store."""
+import os.path as osp
+
+from mmengine.config import Config
+from mmengine.runner import Runner
+
+from mmdet.engine.hooks.utils import trigger_visualization_hook
+from mmdet.evaluation import DumpDetResults
+from mmdet.models.backbones.diff.src.archs.feature_store import pipeline_hash
+from mmdet.registry import RUNNERS
+from mmdet.utils import setup_cache_size_limit_of_dynamo
+
+
+def add_dg_test_args(parser):
+    """Add ``--multi-target``, ``--interleave``, ``--image-cache`` and
+    ``--feature-store`` to the parser of a test script."""
+    parser.add_argument(
+        '--multi-target',
+        action='store_true',
+        help='build the model once and test every target domain with it, '
+        'writing one combined results table')
+    parser.add_argument(
+        '--interleave',
+        action='store_true',
+        help='with --multi-target, take batches from the targets in turn')
+    parser.add_argument(
+        '--image-cache',
+        help='root of an image shard cache of the test images, see '
+        'tools/misc/build_image_cache.py')
+    parser.add_argument(
+        '--feature-store',
+        help='root of the diffusion feature store (DiffusionDetector only), '
+        'stored features skip the VAE and the UNet')
+
+
+def use_image_cache(dataloader_cfg, cache_root):
+    """Load the images of ``dataloader_cfg`` from an image shard cache."""
+    for transform in dataloader_cfg.dataset.pipeline:
+        if transform['type'] == 'LoadImageFromFile':
+            transform['type'] = 'LoadImageFromCache'
+            transform['cache_root'] = cache_root
+
+
+def use_feature_store(cfg, store_root):
+    """Read and write the diffusion features of the test dataloader of
+    ``cfg`` in the feature store at ``store_root``."""
+    if cfg.model.type == 'DiffusionDetector':
+        cfg.model.backbone.diff_config.feature_store = dict(
+            root=store_root,
+            pipeline_hash=pipeline_hash(cfg.test_dataloader.dataset.pipeline))
+
+
+def test_multi_target(args, config_list):
+    """Test all target domains of ``config_list`` with one runner."""
+    setup_cache_size_limit_of_dynamo()
+
+    cfg = Config.fromfile(args.config)
+    targets = []
+    for test_config in config_list:
+        test_cfg = Config.fromfile(test_config)
+        if args.image_cache is not None:
+            use_image_cache(test_cfg.test_dataloader, args.image_cache)
+        targets.append(
+            dict(
+                name=osp.splitext(osp.basename(test_config))[0],
+                dataloader=test_cfg.test_dataloader,
+                evaluator=test_cfg.test_evaluator))
+    if args.feature_store is not None:
+        # every target reads and writes the namespace of its own pipeline
+        for target in targets:
+            target['pipeline_hash'] = pipeline_hash(
+                target['dataloader'].dataset.pipeline)
+    # the runner needs a test dataloader/evaluator, the loop builds the rest
+    cfg.test_dataloader = targets[0]['dataloader']
+    cfg.test_evaluator = targets[0]['evaluator']
+    cfg.test_cfg = dict(
+        type='MultiTargetTestLoop',
+        targets=targets,
+        interleave=args.interleave)
+    cfg.launcher = args.launcher
+    if args.feature_store is not None:
+        use_feature_store(cfg, args.feature_store)
+    if args.cfg_options is not None:
+        cfg.merge_from_dict(args.cfg_options)
+
+    if args.work_dir is not None:
+        cfg.work_dir = args.work_dir
+    else:
+        cfg.work_dir = osp.join('./work_dirs',
+                                osp.splitext(osp.basename(args.config))[0],
+                                'multi_target')
+    cfg.load_from = args.checkpoint
+
+    if args.show or args.show_dir:
+        cfg = trigger_visualization_hook(cfg, args)
+
+    if 'runner_type' not in cfg:
+        runner = Runner.from_cfg(cfg)
+    else:
+        runner = RUNNERS.build(cfg)
+
+    if args.out is not None:
+        assert args.out.endswith(('.pkl', '.pickle')), \
+            'The dump file must be a pkl file.'
+        for name, evaluator in runner.test_loop.evaluators.items():
+            out_file = osp.splitext(args.out)[0] + f'_{name}.pkl'
+            evaluator.metrics.append(DumpDetResults(out_file_path=out_file))
+
+    runner.test()
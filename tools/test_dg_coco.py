@@ -15,6 +15,8 @@ from mmdet.engine.hooks.utils import trigger_visualization_hook
 from mmdet.evaluation import DumpDetResults
 from mmdet.registry import RUNNERS
 from mmdet.utils import setup_cache_size_limit_of_dynamo
+from tools.misc.dg_test_utils import (add_dg_test_args, test_multi_target,
+                                      use_feature_store, use_image_cache)
 
 
 # TODO: support fuse_conv_bn and format_only
@@ -55,6 +57,7 @@ def parse_args():
         default='none',
         help='job launcher')
     parser.add_argument('--tta', action='store_true')
+    add_dg_test_args(parser)
     # When using PyTorch version >= 2.0.0, the `torch.distributed.launch`
     # will pass the `--local-rank` parameter to `tools/train.py` instead
     # of `--local_rank`.
@@ -89,6 +92,11 @@ def main():
         'DG/_base_/datasets/domain_generalization_coco/test_night-sunny.py'
     ]
 
+    if args.multi_target:
+        assert not args.tta, '--tta is not supported with --multi-target'
+        test_multi_target(args, config_list)
+        return
+
     for test_config in config_list:
         print("****************************************************************************************" * 10)
         print("test data: ", test_config)
@@ -104,7 +112,11 @@ def main():
         cfg.test_dataloader = test_cfg.test_dataloader
         cfg.val_evaluator = test_cfg.val_evaluator
         cfg.val_dataloader = test_cfg.val_dataloader
+        if args.image_cache is not None:
+            use_image_cache(cfg.test_dataloader, args.image_cache)
         cfg.launcher = args.launcher
+        if args.feature_store is not None:
+            use_feature_store(cfg, args.feature_store)
         if args.cfg_options is not None:
             cfg.merge_from_dict(args.cfg_options)
 